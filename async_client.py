@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+import threading
+from multiprocessing.pool import ThreadPool
+
+from .transport import HttpTransport
+from .wechat import WechatEnterprise
+
+# 提供非阻塞版本 (方法名加 _async 后缀) 的接口方法
+ASYNC_METHODS = (
+    'get_access_token', 'get_jsapi_ticket', 'get_user_info', 'check_group_auth', 'auth_succ',
+    # 消息
+    'send_text', 'send_image', 'send_voice', 'send_video', 'send_file', 'send_news',
+    # 通讯录
+    'create_department', 'update_department', 'delete_department', 'get_departments',
+    'create_user', 'update_user', 'delete_user', 'delete_users', 'get_user', 'get_simple_user', 'get_user_list',
+    'convert_2_open_id', 'convert_2_user_id',
+    # 标签
+    'create_tag', 'update_tag', 'delete_tag', 'get_tag', 'add_tag_users', 'delete_tag_users', 'get_tag_list',
+    # 菜单
+    'create_menu', 'get_menu', 'delete_menu',
+    # 素材
+    'upload_media',
+    # 异步任务
+    'batch_invite_user', 'batch_sync_user', 'batch_replace_user', 'batch_replace_party', 'get_batch_result',
+    # 生成 CSV 并上传后提交异步任务, 整个过程在线程池中执行
+    'sync_users', 'replace_users', 'replace_parties',
+    # 应用
+    'get_agent', 'set_agent', 'get_agent_list',
+)
+
+
+class AsyncWechatEnterprise(WechatEnterprise):
+    """
+    非阻塞企业号客户端
+    ASYNC_METHODS 中的方法另有加 _async 后缀的版本, 如 get_user_async, 立即返回 multiprocessing.pool.AsyncResult,
+    调用 get() 获取 JSON 数据包
+    原名方法保持同步, 因此本对象也可以交给 Directory / JobTracker / IngestPool 等调用同步方法的组件使用
+    Python 2.7 没有 asyncio, 这里由有界线程池执行请求, 所有线程共用同一个 keep-alive 连接池,
+    token 的获取与刷新由 TokenManager 保证并发安全
+    """
+
+    def __init__(self, *args, **kwargs):
+        """
+        :param workers: 同时执行请求的线程数
+        :param max_pending: 最多允许的未完成调用数, 超出时提交方阻塞等待, 默认为 workers 的 8 倍
+        """
+        workers = kwargs.pop('workers', 16)
+        max_pending = kwargs.pop('max_pending', workers * 8)
+        kwargs.setdefault('transport', HttpTransport(pool_maxsize=workers))
+        super(AsyncWechatEnterprise, self).__init__(*args, **kwargs)
+        self._pool = ThreadPool(workers)
+        self._pending = threading.BoundedSemaphore(max_pending)
+
+    def submit(self, func, *args, **kwargs):
+        """
+        在线程池中执行 func, 未完成调用数达到 max_pending 时阻塞
+        :return: AsyncResult
+        """
+        self._pending.acquire()
+
+        def run():
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._pending.release()
+
+        return self._pool.apply_async(run)
+
+    def gather(self, results, timeout=None):
+        """
+        等待一组 AsyncResult 完成, 按顺序返回结果
+        """
+        return [result.get(timeout) for result in results]
+
+    def close(self):
+        """
+        不再接受新的调用, 等待已提交的调用完成
+        """
+        self._pool.close()
+        self._pool.join()
+
+
+def _async_method(name):
+    def wrapper(self, *args, **kwargs):
+        # 从对象上取方法, 子类覆盖的方法同样生效
+        return self.submit(getattr(self, name), *args, **kwargs)
+
+    wrapper.__name__ = name + '_async'
+    wrapper.__doc__ = getattr(WechatEnterprise, name).__doc__
+    return wrapper
+
+
+for _name in ASYNC_METHODS:
+    setattr(AsyncWechatEnterprise, _name + '_async', _async_method(_name))
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+import csv
+import tempfile
+
+from .exceptions import APIError
+
+# 异步任务接口要求的 CSV 列, (字段名, 表头)
+USER_COLUMNS = (
+    ('name', u'姓名'),
+    ('userid', u'帐号'),
+    ('weixinid', u'微信号'),
+    ('mobile', u'手机号'),
+    ('email', u'邮箱'),
+    ('department', u'所在部门'),
+    ('position', u'职位'),
+)
+PARTY_COLUMNS = (
+    ('name', u'部门名称'),
+    ('id', u'部门ID'),
+    ('parentid', u'父部门ID'),
+    ('order', u'排序'),
+)
+
+# CSV 超过该大小后写入磁盘临时文件
+SPOOL_SIZE = 1024 * 1024
+
+STATUS_DONE = 3
+
+
+def _cell(value):
+    if value is None:
+        return ''
+    if isinstance(value, (list, tuple)):
+        # 多个部门用 ; 分隔
+        return ';'.join(_cell(item) for item in value)
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def write_csv(records, columns, fileobj):
+    """
+    逐行写入 CSV, 不保留已写入的记录
+    :param records: dict 的可迭代对象, 缺少的字段写为空
+    :param columns: USER_COLUMNS 或 PARTY_COLUMNS
+    :param fileobj: 以二进制方式写入的文件对象
+    :return: 写入的记录数
+    """
+    writer = csv.writer(fileobj, lineterminator='\r\n')
+    writer.writerow([_cell(title) for _, title in columns])
+    count = 0
+    for record in records:
+        writer.writerow([_cell(record.get(name)) for name, _ in columns])
+        count += 1
+    return count
+
+
+def build_csv(records, columns, spool_size=SPOOL_SIZE):
+    """
+    :return: (文件对象, 记录数), 文件对象已定位到开头, 使用后需要关闭
+    """
+    fileobj = tempfile.SpooledTemporaryFile(max_size=spool_size)
+    try:
+        count = write_csv(records, columns, fileobj)
+    except Exception:
+        fileobj.close()
+        raise
+    fileobj.seek(0)
+    return fileobj, count
+
+
+class BatchJob(object):
+    """
+    已提交的异步任务, poll() 查询任务结果
+    """
+
+    def __init__(self, wechat, jobid, type, rows=None, media_id=None):
+        """
+        :param type: sync_user / replace_user / replace_party
+        :param rows: 上传的记录数
+        """
+        self.wechat = wechat
+        self.jobid = jobid
+        self.type = type
+        self.rows = rows
+        self.media_id = media_id
+        self.result = None
+
+    def poll(self):
+        """
+        :return: get_batch_result 的返回结果
+        :raises APIError: 接口返回错误
+        """
+        resp = self.wechat.get_batch_result(self.jobid)
+        if resp.get('errcode', 0) != 0:
+            raise APIError('Failed to get result of job %s: %s' % (self.jobid, resp.get('errmsg')),
+                           errcode=resp.get('errcode'))
+        self.result = resp
+        return resp
+
+    @property
+    def done(self):
+        return self.result is not None and self.result.get('status') == STATUS_DONE
+
+    def __repr__(self):
+        return '<BatchJob %s %s>' % (self.type, self.jobid)
+
+
+# 任务类型: (CSV 列, 提交任务的方法, 上传的文件名)
+JOB_TYPES = {
+    'sync_user': (USER_COLUMNS, 'batch_sync_user', 'users.csv'),
+    'replace_user': (USER_COLUMNS, 'batch_replace_user', 'users.csv'),
+    'replace_party': (PARTY_COLUMNS, 'batch_replace_party', 'parties.csv'),
+}
+
+
+def submit(wechat, type, records, callback=None, spool_size=SPOOL_SIZE):
+    """
+    生成 CSV, 上传后提交异步任务
+    CSV 超过 spool_size 后写入临时文件, 上传时分块读取, 内存占用与记录数无关
+    :param type: sync_user / replace_user / replace_party
+    :param records: 成员或部门 dict 的可迭代对象, 可以是生成器
+    :param callback: 任务完成后的回调设置 {"url": "xxx", "token": "xxx", "encodingaeskey": "xxx"}
+    :return: BatchJob
+    :raises APIError: 上传或提交任务失败
+    """
+    columns, method, filename = JOB_TYPES[type]
+    fileobj, rows = build_csv(records, columns, spool_size)
+    try:
+        resp = wechat.upload_media('file', fileobj, filename=filename, content_type='text/csv')
+    finally:
+        fileobj.close()
+    if resp.get('errcode', 0) != 0:
+        raise APIError('Failed to upload %s: %s' % (filename, resp.get('errmsg')), errcode=resp.get('errcode'))
+    kwargs = {'media_id': resp['media_id']}
+    if callback is not None:
+        kwargs['callback'] = callback
+    resp = getattr(wechat, method)(**kwargs)
+    if resp.get('errcode', 0) != 0:
+        raise APIError('Failed to submit %s: %s' % (type, resp.get('errmsg')), errcode=resp.get('errcode'))
+    return BatchJob(wechat, resp['jobid'], type, rows=rows, media_id=kwargs['media_id'])
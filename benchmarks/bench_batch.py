@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+全量同步成员: 在内存中生成 CSV 并用 requests 的 files= 上传, 与 sync_users 流式生成并上传的峰值内存
+桩服务分块读取上传的文件, 每种方式在独立的进程中运行
+python benchmarks/bench_batch.py [成员数]
+"""
+
+import resource
+import subprocess
+import sys
+import time
+from StringIO import StringIO
+
+from wechat_enterprise_sdk.wechat import WechatEnterprise
+from wechat_enterprise_sdk.batch import USER_COLUMNS, write_csv
+
+from stub import StubHandler, start_stub
+
+
+class UploadHandler(StubHandler):
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        while length > 0:
+            length -= len(self.rfile.read(min(length, 64 * 1024)))
+        self._reply({'errcode': 0, 'errmsg': 'ok', 'type': 'file', 'media_id': 'media-1', 'jobid': 'job-1'})
+
+
+def users(n):
+    for i in xrange(n):
+        yield {'userid': 'user%d' % i, 'name': u'成员%d' % i, 'department': [1, i % 50 + 2],
+               'position': u'工程师', 'mobile': '139%08d' % i, 'email': 'user%d@example.com' % i}
+
+
+def run(mode, n):
+    server, api_url = start_stub(UploadHandler)
+    wechat = WechatEnterprise(token='token', corpid='corpid', corpsecret='secret',
+                              encoding_aes_key='abcdefghijklmnopqrstuvwxyz0123456789ABCDEFG')
+    wechat.api_url = api_url
+    start = time.time()
+    if mode == 'memory':
+        buf = StringIO()
+        write_csv(users(n), USER_COLUMNS, buf)
+        wechat.transport.request('POST', api_url + '/media/upload', params={'type': 'file'},
+                                 files={'media': ('users.csv', buf.getvalue(), 'text/csv')})
+    else:
+        wechat.sync_users(users(n))
+    cost = time.time() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print '%-8s %7d users  %.2fs  peak RSS %6.1f MB' % (mode, n, cost, peak / 1024.0)
+    server.shutdown()
+
+
+def main():
+    if len(sys.argv) > 2:
+        return run(sys.argv[2], int(sys.argv[1]))
+    n = sys.argv[1] if len(sys.argv) > 1 else '100000'
+    for mode in ('memory', 'stream'):
+        subprocess.check_call([sys.executable, __file__, n, mode])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+回调加解密耗时
+python benchmarks/bench_crypto.py [次数]
+"""
+
+import sys
+import time
+
+from wechat_enterprise_sdk.tencent.WXBizMsgCrypt import WXBizMsgCrypt
+
+ENCODING_AES_KEY = 'abcdefghijklmnopqrstuvwxyz0123456789ABCDEFG'
+
+MESSAGE = ('<xml><ToUserName><![CDATA[corpid]]></ToUserName>'
+           '<FromUserName><![CDATA[zhangsan]]></FromUserName>'
+           '<CreateTime>1348831860</CreateTime><MsgType><![CDATA[text]]></MsgType>'
+           '<Content><![CDATA[%s]]></Content><MsgId>1234567890123456</MsgId>'
+           '<AgentID>1</AgentID></xml>') % ('\xe4\xbd\xa0\xe5\xa5\xbd' * 50)
+
+
+def bench(name, func, n):
+    start = time.time()
+    for _ in xrange(n):
+        func()
+    cost = time.time() - start
+    print '%-8s %6d ops  %.3fs  %.1fus/op' % (name, n, cost, cost * 1000000 / n)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    crypt = WXBizMsgCrypt('token', ENCODING_AES_KEY, 'corpid')
+    ret, encrypted = crypt.EncryptMsg(MESSAGE, 'nonce', '1409304348')
+    assert ret == 0
+    encrypt = encrypted.split('<Encrypt><![CDATA[')[1].split(']]>')[0]
+    signature = encrypted.split('<MsgSignature><![CDATA[')[1].split(']]>')[0]
+    post_data = ('<xml><ToUserName><![CDATA[corpid]]></ToUserName><AgentID><![CDATA[1]]></AgentID>'
+                 '<Encrypt><![CDATA[%s]]></Encrypt></xml>') % encrypt
+    assert crypt.DecryptMsg(post_data, signature, '1409304348', 'nonce') == (0, MESSAGE)
+
+    bench('encrypt', lambda: crypt.EncryptMsg(MESSAGE, 'nonce', '1409304348'), n)
+    bench('decrypt', lambda: crypt.DecryptMsg(post_data, signature, '1409304348', 'nonce'), n)
+
+
+if __name__ == '__main__':
+    main()
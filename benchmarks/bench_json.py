@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+请求的 JSON 编码与响应的解码耗时
+old 为原来的 json.dumps().decode('unicode-escape').encode('utf-8') 与 response.json()
+fanout 为同一图文消息分 20 组发送时的组装与序列化, per-chunk 为每组重新组装, prepared 为 PreparedMessage
+python benchmarks/bench_json.py [次数]
+"""
+
+import json
+import sys
+import time
+
+from wechat_enterprise_sdk.lib import jsonutil
+from wechat_enterprise_sdk.fanout import chunk_recipients
+from wechat_enterprise_sdk.send import Article, ArticleSend, PreparedMessage
+
+
+def news():
+    send = ArticleSend(agent_id=1, to_user=['user%d' % i for i in range(1000)])
+    for i in range(8):
+        send.add_article(Article(title=u'标题%d' % i, description=u'活动说明' * 100,
+                                 picurl='http://example.com/%d.jpg' % i, url='http://example.com/%d' % i))
+    return send.apply()
+
+
+def fanout_per_chunk(chunks, articles):
+    for chunk in chunks:
+        send = ArticleSend(1, **chunk)
+        for article in articles:
+            send.add_article(Article(**article))
+        jsonutil.dumps(send.apply())
+
+
+def fanout_prepared(chunks, articles):
+    send = ArticleSend(1)
+    for article in articles:
+        send.add_article(Article(**article))
+    prepared = PreparedMessage(send.apply())
+    for chunk in chunks:
+        prepared.body(**chunk)
+
+
+def user():
+    return {'userid': 'zhangsan', 'name': u'张三', 'department': [1, 2, 3], 'position': u'产品经理',
+            'mobile': '13800000000', 'gender': '1', 'email': 'zhangsan@example.com', 'weixinid': 'zhangsan',
+            'extattr': {'attrs': [{'name': u'爱好%d' % i, 'value': u'旅游' * 10} for i in range(20)]}}
+
+
+def old_dumps(data):
+    return json.dumps(data).decode('unicode-escape').encode('utf-8')
+
+
+def old_loads(data):
+    # requests 的 response.json(): 先按编码解码为 unicode 再解析
+    return json.loads(data.decode('utf-8'))
+
+
+def bench(name, func, n):
+    start = time.time()
+    for _ in xrange(n):
+        func()
+    cost = time.time() - start
+    print '%-20s %6d ops  %.3fs  %.1fus/op' % (name, n, cost, cost * 1000000 / n)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    print 'backend: %s' % jsonutil.BACKEND
+    payloads = [('send_news', news()), ('create_user', user())]
+    for name, data in payloads:
+        bench(name + ' old', lambda: old_dumps(data), n)
+        bench(name + ' dumps', lambda: jsonutil.dumps(data), n)
+    chunks = list(chunk_recipients(['user%d' % i for i in range(20000)]))
+    articles = [dict(title=u'标题%d' % i, description=u'活动说明' * 100, picurl='http://example.com/%d.jpg' % i,
+                     url='http://example.com/%d' % i) for i in range(8)]
+    bench('fanout per-chunk', lambda: fanout_per_chunk(chunks, articles), n / 20)
+    bench('fanout prepared', lambda: fanout_prepared(chunks, articles), n / 20)
+    response = json.dumps({'errcode': 0, 'errmsg': 'ok', 'userlist': [dict(user(), userid='user%d' % i)
+                                                                      for i in range(100)]})
+    bench('user/list old', lambda: old_loads(response), n / 10)
+    bench('user/list loads', lambda: jsonutil.loads(response), n / 10)
+
+
+if __name__ == '__main__':
+    main()
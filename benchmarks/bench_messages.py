@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+缓存大量回调消息对象时的内存占用 (进程 RSS 的增量)
+build 只读取路由字段, build+access 另外访问一个需要解析 XML 的字段
+python benchmarks/bench_messages.py [消息数]
+"""
+
+import gc
+import os
+import sys
+import time
+
+from wechat_enterprise_sdk.messages import build_message
+
+MESSAGES = {
+    'text': ('<xml><ToUserName><![CDATA[wx5823bf96d3bd56c7]]></ToUserName>'
+             '<FromUserName><![CDATA[user%d]]></FromUserName><CreateTime>1348831860</CreateTime>'
+             '<MsgType><![CDATA[text]]></MsgType><Content><![CDATA[/cmd%d hello world]]></Content>'
+             '<MsgId>1234567890123456</MsgId><AgentID>1</AgentID></xml>'),
+    'location': ('<xml><ToUserName><![CDATA[wx5823bf96d3bd56c7]]></ToUserName>'
+                 '<FromUserName><![CDATA[user%d]]></FromUserName><CreateTime>1351776360</CreateTime>'
+                 '<MsgType><![CDATA[location]]></MsgType><Location_X>23.134521</Location_X>'
+                 '<Location_Y>113.358803</Location_Y><Scale>20</Scale><Label><![CDATA[place %d]]></Label>'
+                 '<MsgId>1234567890123456</MsgId><AgentID>1</AgentID></xml>'),
+    'click': ('<xml><ToUserName><![CDATA[wx5823bf96d3bd56c7]]></ToUserName>'
+              '<FromUserName><![CDATA[user%d]]></FromUserName><CreateTime>1348831860</CreateTime>'
+              '<MsgType><![CDATA[event]]></MsgType><Event><![CDATA[click]]></Event>'
+              '<EventKey><![CDATA[menu%d]]></EventKey><AgentID>1</AgentID></xml>'),
+}
+
+
+def rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    for name, template in sorted(MESSAGES.items()):
+        for access in (False, True):
+            raws = [template % (i, i) for i in xrange(n)]
+            gc.collect()
+            before = rss()
+            start = time.time()
+            messages = [build_message(xml) for xml in raws]
+            if access:
+                for message in messages:
+                    message.ToUserName
+            cost = time.time() - start
+            gc.collect()
+            print '%-10s %-12s %7d messages  %6.1f bytes/message  %5.1fus/message' % (
+                name, 'build+access' if access else 'build', n, float(rss() - before) / n, cost * 1000000 / n)
+            del messages, raws
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""
+回调消息 XML 解析耗时
+python benchmarks/bench_parser.py [次数]
+"""
+
+import sys
+import time
+
+from wechat_enterprise_sdk.lib.parser import parse_xml
+
+TEXT = ('<xml><ToUserName><![CDATA[corpid]]></ToUserName>'
+        '<FromUserName><![CDATA[zhangsan]]></FromUserName>'
+        '<CreateTime>1348831860</CreateTime><MsgType><![CDATA[text]]></MsgType>'
+        '<Content><![CDATA[\xe4\xbd\xa0\xe5\xa5\xbd]]></Content><MsgId>1234567890123456</MsgId>'
+        '<AgentID>1</AgentID></xml>')
+
+PICS = ('<xml><ToUserName><![CDATA[corpid]]></ToUserName>'
+        '<FromUserName><![CDATA[zhangsan]]></FromUserName>'
+        '<CreateTime>1408090816</CreateTime><MsgType><![CDATA[event]]></MsgType>'
+        '<Event><![CDATA[pic_weixin]]></Event><EventKey><![CDATA[6]]></EventKey>'
+        '<SendPicsInfo><Count>2</Count><PicList>'
+        '<item><PicMd5Sum><![CDATA[5a75aaca956d97be686719218f275c6b]]></PicMd5Sum></item>'
+        '<item><PicMd5Sum><![CDATA[0f275c6b5a75aaca956d97be68671921]]></PicMd5Sum></item>'
+        '</PicList></SendPicsInfo><AgentID>1</AgentID></xml>')
+
+
+def bench(name, data, n):
+    start = time.time()
+    for _ in xrange(n):
+        parse_xml(data)
+    cost = time.time() - start
+    print '%-6s %6d ops  %.3fs  %.1fus/op' % (name, n, cost, cost * 1000000 / n)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    bench('text', TEXT, n)
+    bench('pics', PICS, n)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+被动回复消息的渲染与加密耗时
+python benchmarks/bench_reply.py [次数]
+"""
+
+import sys
+import time
+
+from wechat_enterprise_sdk.messages import TextMessage
+from wechat_enterprise_sdk.reply import TextReply, VideoReply, MusicReply, Article, ArticleReply
+from wechat_enterprise_sdk.tencent.WXBizMsgCrypt import WXBizMsgCrypt
+
+ENCODING_AES_KEY = 'abcdefghijklmnopqrstuvwxyz0123456789ABCDEFG'
+
+
+def news(message):
+    reply = ArticleReply(message)
+    for i in range(8):
+        reply.add_article(Article(title=u'标题%d' % i, description=u'描述' * 20,
+                                  picurl='http://example.com/%d.jpg' % i, url='http://example.com/%d' % i))
+    return reply
+
+
+def bench(name, func, n):
+    start = time.time()
+    for _ in xrange(n):
+        func()
+    cost = time.time() - start
+    print '%-16s %6d ops  %.3fs  %.1fus/op' % (name, n, cost, cost * 1000000 / n)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    crypt = WXBizMsgCrypt('token', ENCODING_AES_KEY, 'corpid')
+    message = TextMessage({'ToUserName': 'corpid', 'FromUserName': 'zhangsan', 'CreateTime': '1348831860',
+                           'MsgId': '1', 'AgentID': '1', 'Content': u'你好', 'type': 'text'})
+    replies = [
+        ('text', lambda: TextReply(message, content=u'收到, 谢谢' * 10)),
+        ('news', lambda: news(message)),
+        ('music', lambda: MusicReply(message, title=u'歌曲', description=u'描述', music_url='http://example.com/a.mp3',
+                                     thumb_media_id='media')),
+        ('video', lambda: VideoReply(message, media_id='media', title=u'视频', description=u'描述')),
+    ]
+    for name, build in replies:
+        bench(name, lambda: build().render_bytes(), n)
+        bench(name + '+encrypt', lambda: crypt.EncryptMsg(build().render_bytes(), 'nonce', '1409304348'), n)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+消息路由的分发耗时随路由个数的变化, 与逐条比较前缀 / EventKey 的线性查找对比
+python benchmarks/bench_router.py [次数]
+"""
+
+import sys
+import time
+
+from wechat_enterprise_sdk.messages import TextMessage, EventMessage
+from wechat_enterprise_sdk.router import Router
+
+
+def bench(name, func, messages, n):
+    start = time.time()
+    for _ in xrange(n):
+        for message in messages:
+            func(message)
+    cost = time.time() - start
+    print '%-24s %.2fus/dispatch' % (name, cost * 1000000 / n / len(messages))
+
+
+def linear(commands, keys):
+    def dispatch(message):
+        if isinstance(message, EventMessage):
+            for key, handler in keys:
+                if message.type == 'click' and message.key == key:
+                    return handler
+        else:
+            for prefix, handler in commands:
+                if message.content.startswith(prefix):
+                    return handler
+    return dispatch
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    for size in (10, 100, 500):
+        router = Router()
+        commands = [(u'/cmd%d ' % i, i) for i in range(size)]
+        keys = [('menu%d' % i, i) for i in range(size)]
+        for prefix, handler in commands:
+            router.add(handler, 'text', prefix=prefix)
+        for key, handler in keys:
+            router.add(handler, 'event', event='click', key=key)
+        messages = [TextMessage({'type': 'text', 'Content': u'/cmd%d arg' % (size - 1), 'AgentID': '1'}),
+                    EventMessage({'type': 'event', 'Event': 'click', 'EventKey': 'menu%d' % (size - 1),
+                                  'AgentID': '1'})]
+        bench('router, %d routes' % size, router.match, messages, n)
+        bench('linear, %d routes' % size, linear(commands, keys), messages, n)
+
+
+if __name__ == '__main__':
+    main()
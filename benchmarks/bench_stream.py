@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+大部门成员列表: 一次性 json.loads 与 iter_json_array 流式解码的峰值内存
+响应体分块生成, 不计入内存, 每种方式在独立的进程中运行
+python benchmarks/bench_stream.py [成员数]
+"""
+
+import json
+import resource
+import subprocess
+import sys
+import time
+
+from wechat_enterprise_sdk.lib.jsonstream import iter_json_array
+
+CHUNK_SIZE = 64 * 1024
+
+
+def user(i):
+    return {'userid': 'user%d' % i, 'name': u'成员%d' % i, 'department': [1, i % 50 + 2], 'position': u'工程师',
+            'mobile': '139%08d' % i, 'gender': '1', 'email': 'user%d@example.com' % i, 'status': 1,
+            'avatar': 'http://p.qlogo.cn/bizmail/%d/0' % i, 'extattr': {'attrs': []}}
+
+
+def chunks(n):
+    """按 CHUNK_SIZE 分块生成 {"errcode": 0, "errmsg": "ok", "userlist": [...]}"""
+    buf = ['{"errcode": 0, "errmsg": "ok", "userlist": [']
+    size = len(buf[0])
+    for i in xrange(n):
+        item = (',' if i else '') + json.dumps(user(i))
+        buf.append(item)
+        size += len(item)
+        if size >= CHUNK_SIZE:
+            yield ''.join(buf)
+            buf, size = [], 0
+    buf.append(']}')
+    yield ''.join(buf)
+
+
+def run(mode, n):
+    start = time.time()
+    if mode == 'loads':
+        count = len(json.loads(''.join(chunks(n)))['userlist'])
+    else:
+        count = sum(1 for _ in iter_json_array(chunks(n), 'userlist'))
+    cost = time.time() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print '%-8s %7d users  %.2fs  peak RSS %6.1f MB' % (mode, count, cost, peak / 1024.0)
+
+
+def main():
+    if len(sys.argv) > 2:
+        return run(sys.argv[2], int(sys.argv[1]))
+    n = sys.argv[1] if len(sys.argv) > 1 else '100000'
+    for mode in ('loads', 'stream'):
+        subprocess.check_call([sys.executable, __file__, n, mode])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+"""
+对比每次调用新建连接 (requests.get) 与共享连接池 (HttpTransport) 的调用耗时
+python benchmarks/bench_transport.py [调用次数]
+"""
+
+import sys
+import time
+
+import requests
+
+from stub import start_stub
+from wechat_enterprise_sdk.transport import HttpTransport
+
+
+def bench(name, get, url, n):
+    start = time.time()
+    for _ in xrange(n):
+        get(url, params={'access_token': 'stub-token'}).json()
+    cost = time.time() - start
+    print '%-12s %6d calls  %.3fs  %.3fms/call' % (name, n, cost, cost * 1000 / n)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    server, api_url = start_stub()
+    url = api_url + '/user/get'
+
+    bench('requests.get', requests.get, url, n)
+    transport = HttpTransport()
+    bench('transport', transport.get, url, n)
+    print transport.stats()
+    transport.close()
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
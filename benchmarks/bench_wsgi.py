@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+回调 WSGI 应用的吞吐量, 以及只读取路由字段 (peek_request) 与完整解析 (parse_request) 的单次耗时
+负载由进程内的多个线程直接调用 WSGI 应用产生, 请求体预先加密, 只计入应用自身的开销
+python benchmarks/bench_wsgi.py [请求数] [线程数]
+"""
+
+import sys
+import threading
+import time
+import urllib
+from urlparse import parse_qs
+from StringIO import StringIO
+
+from wechat_enterprise_sdk.wechat import WechatEnterprise
+from wechat_enterprise_sdk.wsgi import CallbackApp
+
+ENCODING_AES_KEY = 'abcdefghijklmnopqrstuvwxyz0123456789ABCDEFG'
+
+TEXT = ('<xml><ToUserName><![CDATA[corpid]]></ToUserName><FromUserName><![CDATA[zhangsan]]></FromUserName>'
+        '<CreateTime>1348831860</CreateTime><MsgType><![CDATA[text]]></MsgType>'
+        '<Content><![CDATA[hello]]></Content><MsgId>1234567890123456</MsgId><AgentID>1</AgentID></xml>')
+CLICK = ('<xml><ToUserName><![CDATA[corpid]]></ToUserName><FromUserName><![CDATA[zhangsan]]></FromUserName>'
+         '<CreateTime>1348831860</CreateTime><MsgType><![CDATA[event]]></MsgType>'
+         '<Event><![CDATA[click]]></Event><EventKey><![CDATA[menu1]]></EventKey><AgentID>1</AgentID></xml>')
+
+
+def make_environ(wechat, xml):
+    encrypted = wechat.wxcpt.EncryptMsg(xml, 'nonce', '1409304348')[1]
+    fields = dict((name, encrypted.split('<%s><![CDATA[' % name)[1].split(']]>')[0])
+                  for name in ('Encrypt', 'MsgSignature'))
+    body = ('<xml><ToUserName><![CDATA[corpid]]></ToUserName><AgentID><![CDATA[1]]></AgentID>'
+            '<Encrypt><![CDATA[%s]]></Encrypt></xml>') % fields['Encrypt']
+    query = urllib.urlencode({'msg_signature': fields['MsgSignature'], 'timestamp': '1409304348',
+                              'nonce': 'nonce'})
+    return {'REQUEST_METHOD': 'POST', 'QUERY_STRING': query, 'CONTENT_LENGTH': str(len(body)), 'body': body}
+
+
+def start_response(status, headers):
+    pass
+
+
+def run(app, environ, n, threads):
+    def worker(count):
+        for _ in xrange(count):
+            env = dict(environ, **{'wsgi.input': StringIO(environ['body'])})
+            result = app(env, start_response)
+            ''.join(result)
+            if hasattr(result, 'close'):
+                result.close()
+
+    workers = [threading.Thread(target=worker, args=(n // threads,)) for _ in range(threads)]
+    start = time.time()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return n // threads * threads / (time.time() - start)
+
+
+def per_callback(wechat, environ, n):
+    query = parse_qs(environ['QUERY_STRING'])
+    args = (environ['body'], query['msg_signature'][0], query['timestamp'][0], query['nonce'][0])
+    for name in ('parse_request', 'peek_request'):
+        func = getattr(wechat, name)
+        start = time.time()
+        for _ in xrange(n):
+            func(*args)
+        print '  %-14s %6.1fus/callback' % (name, (time.time() - start) * 1000000 / n)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    wechat = WechatEnterprise(token='token', corpid='corpid', encoding_aes_key=ENCODING_AES_KEY)
+    app = CallbackApp(wechat)
+    app.register('text', lambda request: request.response_text(u'收到'))
+    app.register('event', lambda request: None, event='click', defer=True)
+
+    for name, xml in (('text reply', TEXT), ('deferred click', CLICK)):
+        environ = make_environ(wechat, xml)
+        print '%-16s %8.0f req/s' % (name, run(app, environ, n, threads))
+        per_callback(wechat, environ, n)
+
+
+if __name__ == '__main__':
+    main()
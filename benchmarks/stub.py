@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+本地企业号接口桩服务, 仅供 benchmark 使用
+所有请求都返回 {"errcode": 0, "errmsg": "ok"}, gettoken 返回固定 token
+"""
+
+import json
+import socket
+import threading
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        # 头部与正文分开写入, 不关闭 Nagle 会被 delayed ACK 拖慢 keep-alive 连接
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def _reply(self, data):
+        body = json.dumps(data)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.startswith('/cgi-bin/gettoken'):
+            self._reply({'access_token': 'stub-token', 'expires_in': 7200})
+        else:
+            self._reply({'errcode': 0, 'errmsg': 'ok'})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self.rfile.read(length)
+        self._reply({'errcode': 0, 'errmsg': 'ok', 'invaliduser': ''})
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_stub(handler=StubHandler):
+    """
+    启动桩服务, 返回 (server, api_url)
+    """
+    server = StubServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:%d/cgi-bin' % server.server_address[1]
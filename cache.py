@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+
+class TTLCache(object):
+    """
+    线程安全的 LRU 缓存, 每项有过期时间
+    最多保存 maxsize 项, 超出时淘汰最久未使用的项, 内存占用有上限
+    """
+
+    def __init__(self, maxsize=1024, ttl=None, clock=time.time):
+        """
+        :param maxsize: 最多保存的项数
+        :param ttl: 默认的有效期 (秒), None 为不过期
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _expires_at(self, ttl):
+        ttl = self.ttl if ttl is None else ttl
+        return self._clock() + ttl if ttl is not None else None
+
+    def _get(self, key):
+        # 调用方持有锁, 返回 (是否命中, 值)
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return False, None
+        if entry[1] is not None and entry[1] <= self._clock():
+            return False, None
+        self._data[key] = entry
+        return True, entry[0]
+
+    def _set(self, key, value, ttl):
+        self._data.pop(key, None)
+        self._data[key] = (value, self._expires_at(ttl))
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def get(self, key, default=None):
+        with self._lock:
+            found, value = self._get(key)
+        return value if found else default
+
+    def set(self, key, value, ttl=None):
+        """
+        :param ttl: 本项的有效期 (秒), 默认使用构造参数
+        """
+        with self._lock:
+            self._set(key, value, ttl)
+
+    def add(self, key, value=True, ttl=None):
+        """
+        不存在或已过期时保存
+        :return: 是否保存
+        """
+        with self._lock:
+            found, _ = self._get(key)
+            if not found:
+                self._set(key, value, ttl)
+            return not found
+
+    def pop(self, key, default=None):
+        with self._lock:
+            found, value = self._get(key)
+            self._data.pop(key, None)
+        return value if found else default
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._get(key)[0]
+
+
+class DirectoryCache(object):
+    """
+    通讯录读缓存, 缓存 get_user / get_departments / get_tag / get_agent 的返回结果
+    SDK 自身的 create_* / update_* / delete_* 等写操作会使相关的缓存失效
+    每类数据有一个版本号, 需要整类失效时 (如删除成员后所有标签的成员列表) 只更换版本号, 旧数据由 LRU 淘汰
+    版本号与数据一起保存在存储后端中, 多个进程共享同一个后端 (如 Redis) 时整类失效对所有进程生效
+    缓存的数据包由多个调用方共享, 不要修改
+    """
+    KINDS = ('user', 'department', 'tag', 'agent')
+
+    def __init__(self, cache=None, ttl=300, maxsize=10000):
+        """
+        :param cache: 存储后端, 需提供 get(key) / set(key, value, ttl=None) / pop(key) / clear(), 默认为 TTLCache
+        :param ttl: 缓存有效期 (秒)
+        :param maxsize: 默认 TTLCache 最多保存的项数
+        """
+        self.cache = cache if cache is not None else TTLCache(maxsize, ttl)
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+    def _version(self, corpid, kind):
+        key = u'%s:%s:version' % (corpid, kind)
+        version = self.cache.get(key)
+        if version is None:
+            # 版本号过期或被淘汰时换用新的版本号, 之前的数据随之失效
+            version = uuid.uuid4().hex
+            self.cache.set(key, version)
+        return version
+
+    def _key(self, corpid, kind, key):
+        return u'%s:%s:%s:%s' % (corpid, kind, self._version(corpid, kind), key)
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def lookup(self, corpid, kind, key):
+        """
+        查询缓存, 同时记下当前的版本号与查询时间, 调用接口后把结果和 snapshot 一起交给 set
+        查询之后发生的失效 (整类或单个 ID) 会使 set 不写入, 避免把失效前取得的旧数据写入缓存
+        :return: (缓存的数据包, snapshot), 没有缓存时数据包为 None
+        """
+        cache_key = self._key(corpid, kind, key)
+        value = self.cache.get(cache_key)
+        self._count('hits' if value is not None else 'misses')
+        return value, (cache_key, time.time())
+
+    def get(self, corpid, kind, key):
+        """
+        :return: 缓存的数据包, 没有缓存时返回 None
+        """
+        return self.lookup(corpid, kind, key)[0]
+
+    def set(self, corpid, kind, key, value, snapshot=None):
+        """
+        :param snapshot: lookup 返回的 snapshot, 不指定时按当前版本号写入
+        """
+        if snapshot is None:
+            self.cache.set(self._key(corpid, kind, key), value, ttl=self.ttl)
+            return
+        # 整类失效后版本号已经改变, 按旧版本号写入的数据不会再被读到
+        cache_key, looked_up = snapshot
+        invalidated = self.cache.get(cache_key + u':invalidated')
+        if invalidated is not None and invalidated >= looked_up:
+            return
+        self.cache.set(cache_key, value, ttl=self.ttl)
+
+    def invalidate(self, corpid, kind, key=None):
+        """
+        :param key: 需要失效的 ID, None 为整类失效
+        """
+        self._count('invalidations')
+        if key is not None:
+            cache_key = self._key(corpid, kind, key)
+            self.cache.pop(cache_key)
+            # 记录失效时间, 失效前开始的查询不再写入
+            self.cache.set(cache_key + u':invalidated', time.time(), ttl=self.ttl)
+            return
+        self.cache.set(u'%s:%s:version' % (corpid, kind), uuid.uuid4().hex)
+
+    def clear(self):
+        self.cache.clear()
+
+    def stats(self):
+        """
+        :return: dict, hits / misses / invalidations 计数与 hit_rate 命中率
+        """
+        with self._lock:
+            stats = dict(self._counters)
+        total = stats['hits'] + stats['misses']
+        stats['hit_rate'] = float(stats['hits']) / total if total else 0.0
+        stats['size'] = len(self.cache) if hasattr(self.cache, '__len__') else None
+        return stats
@@ -1 +1,111 @@
 # -*- coding: utf-8 -*-
+
+import cgi
+from collections import namedtuple
+
+from .exceptions import EncryptError
+from .reply import TextReply, ImageReply, VoiceReply, VideoReply, MusicReply, Article, ArticleReply
+
+
+class CallbackPeek(namedtuple('CallbackPeek',
+                              'wechat raw msg_type event agentid source msg_signature timestamp nonce')):
+    """
+    只读取了路由字段的回调请求, 由 WechatEnterprise.peek_request 创建
+    raw 为解密后的 XML, 需要完整消息时调用 parse(), 不会重复解密
+    """
+    __slots__ = ()
+
+    def parse(self):
+        """
+        :return: CallbackRequest 对象
+        :raises ParseError: 解析微信服务器数据错误, 数据不合法
+        """
+        return self.wechat._build_request(self.raw, self.msg_signature, self.timestamp, self.nonce)
+
+
+class CallbackRequest(namedtuple('CallbackRequest', 'wechat message msg_signature timestamp nonce')):
+    """
+    一次回调请求的解析结果, 由 WechatEnterprise.parse_request 创建, 创建后不可修改
+    回复方法只读取本对象的字段, 同一个 WechatEnterprise 可以在多个线程 / greenlet 中同时处理不同的请求
+
+    request = wechat.parse_request(body, msg_signature, timestamp, nonce)
+    if request.message.type == 'text':
+        return request.response_text(u'收到')
+    """
+    __slots__ = ()
+
+    def _encrypt(self, response):
+        """
+        :param response: 回复消息的 UTF-8 字节串
+        """
+        ok, encrypt_msg = self.wechat.encrypt_message(response, self.nonce, self.timestamp)
+        if not ok:
+            raise EncryptError()
+        return encrypt_msg
+
+    def response_text(self, content, escape=False):
+        """
+        将文字信息 content 组装为符合微信服务器要求的响应数据
+        :param content: 回复文字
+        :param escape: 是否转义该文本内容 (默认不转义)
+        :return: 符合微信服务器要求的 XML 响应数据
+        """
+        content = self.wechat._transcoding(content)
+        if escape:
+            content = cgi.escape(content)
+        return self._encrypt(TextReply(message=self.message, content=content).render_bytes())
+
+    def response_image(self, media_id):
+        """
+        将 media_id 所代表的图片组装为符合微信服务器要求的响应数据
+        :param media_id: 图片的 MediaID
+        :return: 符合微信服务器要求的 XML 响应数据
+        """
+        return self._encrypt(ImageReply(message=self.message, media_id=media_id).render_bytes())
+
+    def response_voice(self, media_id):
+        """
+        将 media_id 所代表的语音组装为符合微信服务器要求的响应数据
+        :param media_id: 语音的 MediaID
+        :return: 符合微信服务器要求的 XML 响应数据
+        """
+        return self._encrypt(VoiceReply(message=self.message, media_id=media_id).render_bytes())
+
+    def response_video(self, media_id, title=None, description=None):
+        """
+        将 media_id 所代表的视频组装为符合微信服务器要求的响应数据
+        :param media_id: 视频的 MediaID
+        :param title: 视频消息的标题
+        :param description: 视频消息的描述
+        :return: 符合微信服务器要求的 XML 响应数据
+        """
+        transcoding = self.wechat._transcoding
+        return self._encrypt(VideoReply(message=self.message, media_id=media_id, title=transcoding(title),
+                                        description=transcoding(description)).render_bytes())
+
+    def response_music(self, music_url, title=None, description=None, hq_music_url=None, thumb_media_id=None):
+        """
+        将音乐信息组装为符合微信服务器要求的响应数据
+        :param music_url: 音乐链接
+        :param title: 音乐标题
+        :param description: 音乐描述
+        :param hq_music_url: 高质量音乐链接, WIFI环境优先使用该链接播放音乐
+        :param thumb_media_id: 缩略图的 MediaID
+        :return: 符合微信服务器要求的 XML 响应数据
+        """
+        transcoding = self.wechat._transcoding
+        return self._encrypt(MusicReply(message=self.message, title=transcoding(title),
+                                        description=transcoding(description), music_url=transcoding(music_url),
+                                        hq_music_url=transcoding(hq_music_url),
+                                        thumb_media_id=thumb_media_id).render_bytes())
+
+    def response_news(self, articles):
+        """
+        将新闻信息组装为符合微信服务器要求的响应数据
+        :param articles: list 对象, 每个元素为一个 dict 对象, key 包含 `title`, `description`, `picurl`, `url`
+        :return: 符合微信服务器要求的 XML 响应数据
+        """
+        news = ArticleReply(message=self.message)
+        for article in articles:
+            news.add_article(Article(**self.wechat._transcoding_dict(article)))
+        return self._encrypt(news.render_bytes())
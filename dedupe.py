@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+import itertools
+import sqlite3
+import time
+
+from .cache import TTLCache
+
+# 微信在 5 秒内没有收到响应时重试, 共重试三次
+DEFAULT_TTL = 60
+
+
+def message_key(message):
+    """
+    回调消息的去重键: 普通消息为 MsgId, 没有 MsgId 的事件为 FromUserName + CreateTime + Event
+    """
+    if message.id:
+        return u'%s:%d' % (message.target, message.id)
+    return u'%s:%s:%d:%s:%s' % (message.target, message.source, message.time, message.type,
+                                getattr(message, 'key', None) or u'')
+
+
+class DedupeStore(object):
+    """
+    去重键的存储后端, 可在多个进程之间共享
+    """
+
+    def add(self, key, ttl):
+        """
+        记录 key, ttl 秒内有效
+        :return: key 不存在 (或已过期) 时返回 True
+        """
+        raise NotImplementedError()
+
+    def delete(self, key):
+        raise NotImplementedError()
+
+
+class MemoryDedupeStore(DedupeStore):
+    """
+    进程内存储, 最多保存 maxsize 个键, 超出时淘汰最久未使用的键
+    """
+
+    def __init__(self, maxsize=10000):
+        self._cache = TTLCache(maxsize)
+
+    def add(self, key, ttl):
+        return self._cache.add(key, ttl=ttl)
+
+    def delete(self, key):
+        self._cache.pop(key)
+
+
+class SQLiteDedupeStore(DedupeStore):
+    """
+    SQLite 存储, 同一主机的多个进程共享去重记录
+    每 prune_interval 次写入清理一次过期记录, 并只保留最新的 maxsize 条
+    """
+
+    def __init__(self, path, maxsize=100000, prune_interval=1000, timeout=10):
+        """
+        :param path: 数据库文件路径
+        :param maxsize: 最多保存的记录数
+        :param prune_interval: 清理间隔 (写入次数)
+        :param timeout: SQLite 的 busy timeout (秒)
+        """
+        self.path = path
+        self.maxsize = maxsize
+        self.prune_interval = prune_interval
+        self.timeout = timeout
+        # 多个请求线程同时写入, next() 在 C 实现中完成, 不会丢失计数
+        self._writes = itertools.count(1)
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('CREATE TABLE IF NOT EXISTS callbacks (key TEXT PRIMARY KEY, expires_at REAL)')
+                conn.execute('CREATE INDEX IF NOT EXISTS callbacks_expires_at ON callbacks (expires_at)')
+        finally:
+            conn.close()
+
+    def _connect(self):
+        # 每次操作使用独立连接, fork 之后也不会共享连接
+        return sqlite3.connect(self.path, timeout=self.timeout)
+
+    def add(self, key, ttl):
+        now = time.time()
+        writes = next(self._writes)
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('DELETE FROM callbacks WHERE key = ? AND expires_at <= ?', (key, now))
+                cursor = conn.execute('INSERT OR IGNORE INTO callbacks (key, expires_at) VALUES (?, ?)',
+                                      (key, now + ttl))
+                if writes % self.prune_interval == 0:
+                    conn.execute('DELETE FROM callbacks WHERE expires_at <= ?', (now,))
+                    conn.execute('DELETE FROM callbacks WHERE key NOT IN '
+                                 '(SELECT key FROM callbacks ORDER BY expires_at DESC LIMIT ?)', (self.maxsize,))
+        finally:
+            conn.close()
+        return cursor.rowcount == 1
+
+    def delete(self, key):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('DELETE FROM callbacks WHERE key = ?', (key,))
+        finally:
+            conn.close()
+
+
+class Deduplicator(object):
+    """
+    过滤微信重试导致的重复回调
+    """
+
+    def __init__(self, store=None, ttl=DEFAULT_TTL):
+        """
+        :param store: DedupeStore 对象, 默认为 MemoryDedupeStore
+        :param ttl: 去重记录的有效期 (秒), 需要覆盖微信的重试时间
+        """
+        self.store = store or MemoryDedupeStore()
+        self.ttl = ttl
+
+    def is_duplicate(self, message):
+        """
+        记录消息, 已经记录过时返回 True
+        """
+        return not self.store.add(message_key(message), self.ttl)
+
+    def forget(self, message):
+        """
+        删除消息的记录, 处理失败时调用, 使微信的重试可以再次处理
+        """
+        self.store.delete(message_key(message))
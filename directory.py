@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from .exceptions import APIError
+
+
+def _check(resp, what):
+    if resp.get('errcode', 0) != 0:
+        raise APIError('Failed to fetch %s: %s' % (what, resp.get('errmsg')), errcode=resp.get('errcode'))
+    return resp
+
+
+class DirectorySnapshot(object):
+    """
+    某一时刻的通讯录索引, 创建后不再修改, 可在多个线程中同时读取
+    - departments: {部门ID: 部门数据}, children: {部门ID: (子部门ID, ...)}
+    - subtree: {部门ID: frozenset(该部门及所有下级部门ID)}
+    - users: {成员ID: 成员数据}, user_departments: {成员ID: (所在部门ID, ...)}
+    - members: {部门ID: frozenset(直属成员ID)}, subtree_members: {部门ID: frozenset(该部门及下级部门的成员ID)}
+    """
+
+    def __init__(self, departments, users, created_at=None):
+        """
+        :param departments: department/list 返回的部门列表
+        :param users: user/list 返回的成员列表
+        """
+        self.created_at = created_at or time.time()
+        self.departments = dict((dept['id'], dept) for dept in departments)
+        children = {}
+        for dept in departments:
+            parent = dept.get('parentid')
+            if parent in self.departments and parent != dept['id']:
+                children.setdefault(parent, []).append(dept['id'])
+        self.children = dict((key, tuple(value)) for key, value in children.items())
+
+        self.users = {}
+        self.user_departments = {}
+        members = {}
+        for user in users:
+            self.users[user['userid']] = user
+            dept_ids = tuple(user.get('department') or ())
+            self.user_departments[user['userid']] = dept_ids
+            for dept_id in dept_ids:
+                members.setdefault(dept_id, set()).add(user['userid'])
+        self.members = dict((key, frozenset(value)) for key, value in members.items())
+
+        self.subtree = {}
+        self.subtree_members = {}
+        for dept_id in self.departments:
+            self._close(dept_id)
+
+    def _close(self, dept_id):
+        # 按后序遍历计算闭包, 用显式栈避免层级很深时超出递归深度
+        stack = [(dept_id, False)]
+        visiting = set()
+        while stack:
+            node, expanded = stack.pop()
+            if node in self.subtree:
+                continue
+            children = self.children.get(node, ())
+            if not expanded:
+                if node in visiting:
+                    continue
+                visiting.add(node)
+                stack.append((node, True))
+                stack.extend((child, False) for child in children if child not in self.subtree)
+                continue
+            depts = set([node])
+            users = set(self.members.get(node, ()))
+            for child in children:
+                depts.update(self.subtree.get(child, ()))
+                users.update(self.subtree_members.get(child, ()))
+            self.subtree[node] = frozenset(depts)
+            self.subtree_members[node] = frozenset(users)
+
+    def users_under(self, dept_id, recursive=True):
+        """
+        :return: frozenset, 部门 (及下级部门) 的成员ID
+        """
+        index = self.subtree_members if recursive else self.members
+        return index.get(dept_id, frozenset())
+
+    def is_member(self, user_id, dept_id, recursive=True):
+        """
+        成员是否属于部门 (及下级部门)
+        """
+        index = self.subtree_members if recursive else self.members
+        return user_id in index.get(dept_id, ())
+
+    def is_descendant(self, dept_id, ancestor_id):
+        """
+        dept_id 是否为 ancestor_id 或其下级部门
+        """
+        return dept_id in self.subtree.get(ancestor_id, ())
+
+    def ancestors(self, dept_id):
+        """
+        :return: 上级部门ID列表, 由近及远
+        """
+        result = []
+        dept = self.departments.get(dept_id)
+        while dept is not None and dept.get('parentid') in self.departments and dept['parentid'] not in result:
+            result.append(dept['parentid'])
+            dept = self.departments[dept['parentid']]
+        return result
+
+
+class Directory(object):
+    """
+    通讯录快照, 并发抓取部门与各部门的成员后建立 DirectorySnapshot
+    refresh() 建立新快照后整体替换, 读取方始终拿到完整的快照, 不需要加锁
+
+    directory = Directory(wechat, workers=8)
+    directory.refresh()
+    directory.snapshot.users_under(2)
+    """
+
+    def __init__(self, wechat, root=None, workers=8, status=0):
+        """
+        :param wechat: WechatEnterprise 对象
+        :param root: 抓取该部门及其下级部门, 默认为全部部门
+        :param workers: 并发抓取成员的线程数
+        :param status: user/list 的 status 参数, 0 为全部成员
+        """
+        self.wechat = wechat
+        self.root = root
+        self.workers = workers
+        self.status = status
+        self.snapshot = None
+        self._refresh_lock = threading.Lock()
+
+    def _fetch_users(self, dept_id):
+        resp = self.wechat.get_user_list(department_id=dept_id, fetch_child=0, status=self.status)
+        return _check(resp, 'users of department %s' % dept_id).get('userlist', [])
+
+    def crawl(self):
+        """
+        抓取通讯录, 不修改当前快照
+        :return: DirectorySnapshot
+        :raises APIError: 接口返回错误
+        """
+        departments = _check(self.wechat.get_departments(self.root), 'departments').get('department', [])
+        pool = ThreadPool(max(1, min(self.workers, len(departments))))
+        try:
+            user_lists = pool.map(self._fetch_users, [dept['id'] for dept in departments])
+        finally:
+            pool.close()
+            pool.join()
+        users = {}
+        for user_list in user_lists:
+            for user in user_list:
+                # 成员属于多个部门时会出现在多个列表中
+                users[user['userid']] = user
+        return DirectorySnapshot(departments, users.values())
+
+    def refresh(self):
+        """
+        重新抓取并替换快照, 同一时间只有一个刷新在执行
+        :return: 新的 DirectorySnapshot
+        """
+        with self._refresh_lock:
+            snapshot = self.crawl()
+            self.snapshot = snapshot
+        return snapshot
@@ -49,3 +49,24 @@ class NeedParseError(WechatSDKException):
     """尚未解析微信服务器请求数据异常"""
     pass
 
+
+class RateLimitExceeded(WechatSDKException):
+    """超出客户端限流异常"""
+    def __init__(self, message='', wait=0):
+        """
+        :param message: 错误内容描述，可选
+        :param wait: 需要等待的秒数
+        """
+        super(RateLimitExceeded, self).__init__(message)
+        self.wait = wait
+
+
+class APIError(WechatSDKException):
+    """接口返回错误异常"""
+    def __init__(self, message='', errcode=0):
+        """
+        :param message: 错误内容描述，可选
+        :param errcode: 接口返回的 errcode
+        """
+        super(APIError, self).__init__(message)
+        self.errcode = errcode
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+import cgi
+from multiprocessing.pool import ThreadPool
+
+from .send import TextSend, ImageSend, VoiceSend, VideoSend, FileSend, Article, ArticleSend, PreparedMessage
+
+# message/send 单次调用的接收者上限
+MAX_USERS = 1000
+MAX_PARTIES = 100
+
+
+def _chunks(items, size):
+    items = list(items or [])
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def chunk_recipients(to_user=None, to_party=None, to_tag=None):
+    """
+    将接收者拆分为符合接口上限的分组
+    标签只放在第一组, 避免重复发送
+    """
+    users = _chunks(to_user, MAX_USERS)
+    parties = _chunks(to_party, MAX_PARTIES)
+    for i in range(max(len(users), len(parties), 1)):
+        yield {
+            'to_user': users[i] if i < len(users) else [],
+            'to_party': parties[i] if i < len(parties) else [],
+            'to_tag': list(to_tag or []) if i == 0 else [],
+        }
+
+
+class FanoutResult(object):
+    """
+    分组发送结果
+    invaliduser / invalidparty / invalidtag 为所有分组返回的无效接收者
+    errors 为失败的分组: (分组, 返回的 JSON 数据包或异常)
+    """
+
+    def __init__(self):
+        self.invaliduser = []
+        self.invalidparty = []
+        self.invalidtag = []
+        self.responses = []
+        self.errors = []
+
+    @property
+    def ok(self):
+        return not self.errors
+
+    def add(self, chunk, resp):
+        if isinstance(resp, Exception):
+            self.errors.append((chunk, resp))
+            return
+        self.responses.append(resp)
+        if resp.get('errcode', 0) != 0:
+            self.errors.append((chunk, resp))
+        for key in ('invaliduser', 'invalidparty', 'invalidtag'):
+            if resp.get(key):
+                getattr(self, key).extend(item for item in resp[key].split('|') if item)
+
+
+class FanoutSender(object):
+    """
+    超出单次接收者上限的消息发送
+    按 MAX_USERS / MAX_PARTIES 拆分接收者, 在有界线程池中并发发送, 并合并各分组的结果
+    线程池在每次发送时创建, 发送完成后释放
+    """
+
+    def __init__(self, wechat, workers=8):
+        """
+        :param wechat: WechatEnterprise 对象
+        :param workers: 并发发送的线程数
+        """
+        self.wechat = wechat
+        self.workers = workers
+
+    def send(self, send_cls, agent_id, to_all=False, to_user=None, to_party=None, to_tag=None, safe=False,
+             articles=None, **content):
+        """
+        消息内容只组装与序列化一次, 各分组只拼接接收者
+        :param send_cls: WechatSend 子类, 如 TextSend
+        :param agent_id: 企业应用的id，整型
+        :param to_all: 是否发送给所有人
+        :param to_user: 成员ID列表, 不限个数
+        :param to_party: 部门ID列表, 不限个数
+        :param to_tag: 标签ID列表
+        :param safe: 是否加密
+        :param articles: ArticleSend 的 Article 列表
+        :param content: send_cls.apply 的参数
+        :return: FanoutResult
+        """
+        message = send_cls(agent_id, safe=safe)
+        for article in articles or []:
+            message.add_article(article)
+        message.apply(**content)
+        return self.send_prepared(PreparedMessage(message), to_all=to_all, to_user=to_user, to_party=to_party,
+                                  to_tag=to_tag)
+
+    def send_prepared(self, prepared, to_all=False, to_user=None, to_party=None, to_tag=None):
+        """
+        发送 PreparedMessage, 同一内容多次发送时可以复用
+        :param prepared: PreparedMessage 对象
+        :return: FanoutResult
+        """
+        if to_all:
+            chunks = [{'to_all': True}]
+        else:
+            chunks = list(chunk_recipients(to_user, to_party, to_tag))
+
+        def send_chunk(chunk):
+            try:
+                return self.wechat._post_prepared(prepared, **chunk)
+            except Exception as e:
+                return e
+
+        if len(chunks) == 1:
+            responses = [send_chunk(chunks[0])]
+        else:
+            pool = ThreadPool(min(self.workers, len(chunks)))
+            try:
+                responses = pool.map(send_chunk, chunks)
+            finally:
+                pool.close()
+                pool.join()
+
+        result = FanoutResult()
+        for chunk, resp in zip(chunks, responses):
+            result.add(chunk, resp)
+        return result
+
+    def send_text(self, content, escape=False, **kwargs):
+        content = self.wechat._transcoding(content)
+        if escape:
+            content = cgi.escape(content)
+        return self.send(TextSend, content=content, **kwargs)
+
+    def send_image(self, media_id, **kwargs):
+        return self.send(ImageSend, media_id=media_id, **kwargs)
+
+    def send_voice(self, media_id, **kwargs):
+        return self.send(VoiceSend, media_id=media_id, **kwargs)
+
+    def send_video(self, media_id, title=None, description=None, **kwargs):
+        return self.send(VideoSend, media_id=media_id, title=self.wechat._transcoding(title),
+                         description=self.wechat._transcoding(description), **kwargs)
+
+    def send_file(self, media_id, **kwargs):
+        return self.send(FileSend, media_id=media_id, **kwargs)
+
+    def send_news(self, articles, **kwargs):
+        """
+        :param articles: list 对象, 每个元素为一个 dict 对象, key 包含 `title`, `description`, `picurl`, `url`
+        """
+        items = [Article(**self.wechat._transcoding_dict(article)) for article in articles]
+        return self.send(ArticleSend, articles=items, **kwargs)
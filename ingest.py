@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+import time
+from Queue import Queue, Full
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+def deliver(wechat, message, answer):
+    """
+    通过 message/send 把处理结果发给消息的发送者
+    :param answer: 处理函数的返回值, 字符串为文字消息, list 为图文消息 (send_news 的 articles), None 不发送
+    :return: 接口返回的 JSON 数据包, 没有发送时返回 None
+    """
+    if answer is None:
+        return None
+    kwargs = {'agent_id': message.agentid, 'to_user': [message.source]}
+    if isinstance(answer, basestring):
+        return wechat.send_text(answer, **kwargs)
+    return wechat.send_news(answer, **kwargs)
+
+
+class IngestPool(object):
+    """
+    回调消息的后台处理线程池
+    回调请求只负责把消息放入有界队列并立即返回空响应, 处理函数在工作线程中执行,
+    返回值通过 deliver 主动发送给用户, 处理耗时不影响回调的响应时间
+    队列已满时 submit 返回 False, 由调用方决定如何响应 (CallbackApp 返回 503)
+    """
+
+    def __init__(self, wechat, workers=4, maxsize=1000, timeout=0):
+        """
+        :param wechat: WechatEnterprise 对象, 用于发送处理结果
+        :param workers: 工作线程数
+        :param maxsize: 队列长度上限
+        :param timeout: 队列已满时 submit 最多等待的秒数, 0 为不等待
+        """
+        self.wechat = wechat
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._queue = Queue(maxsize)
+        self._lock = threading.Lock()
+        self._counters = dict.fromkeys(('submitted', 'rejected', 'completed', 'failed', 'delivered', 'busy'), 0)
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._threads = []
+        for _ in range(workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self._counters[name] += n
+
+    def submit(self, func, request):
+        """
+        :param func: 处理函数, 参数为 CallbackRequest, 返回值交给 deliver
+        :param request: CallbackRequest 对象
+        :return: 是否进入队列
+        """
+        try:
+            self._queue.put((func, request, time.time()), self.timeout > 0, self.timeout or None)
+        except Full:
+            self._count('rejected')
+            return False
+        self._count('submitted')
+        return True
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+            func, request, queued_at = item
+            wait = time.time() - queued_at
+            with self._lock:
+                self._counters['busy'] += 1
+                self._wait_total += wait
+                self._wait_max = max(self._wait_max, wait)
+            try:
+                if deliver(self.wechat, request.message, func(request)) is not None:
+                    self._count('delivered')
+                self._count('completed')
+            except Exception:
+                self._count('failed')
+                logger.exception('Deferred handler failed for message %s', request.message.id)
+            finally:
+                self._count('busy', -1)
+
+    def stats(self):
+        """
+        :return: dict, queued 为排队中的消息数, busy 为正在处理的消息数,
+                 wait_avg / wait_max 为消息在队列中等待的平均 / 最长时间 (秒)
+        """
+        with self._lock:
+            stats = dict(self._counters)
+            started = stats['completed'] + stats['failed'] + stats['busy']
+            stats['wait_avg'] = self._wait_total / started if started else 0.0
+            stats['wait_max'] = self._wait_max
+        stats['queued'] = self._queue.qsize()
+        stats['maxsize'] = self.maxsize
+        stats['workers'] = len(self._threads)
+        return stats
+
+    def close(self):
+        """
+        处理完队列中的消息后停止工作线程
+        """
+        for _ in self._threads:
+            self._queue.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+from multiprocessing import TimeoutError
+
+from .batch import STATUS_DONE
+from .cache import TTLCache
+from .exceptions import APIError
+
+logger = logging.getLogger(__name__)
+
+# 任务完成后需要失效的通讯录缓存
+INVALIDATES = {
+    'sync_user': ('user', 'tag'),
+    'replace_user': ('user', 'tag'),
+    'replace_party': ('department', 'user'),
+}
+
+
+class JobResult(object):
+    """
+    异步任务的结果, 接口与 multiprocessing.pool.AsyncResult 相同, 另外可以注册完成时的回调
+    get() 返回 get_batch_result 的 JSON 数据包, 任务失败时抛出 APIError
+    """
+
+    def __init__(self, jobid, type=None):
+        self.jobid = jobid
+        self.type = type
+        # 最近一次查询到的完成百分比
+        self.percentage = None
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._value = None
+        self._error = None
+        self._callbacks = []
+
+    def ready(self):
+        return self._event.is_set()
+
+    def successful(self):
+        if not self.ready():
+            raise ValueError('Job %s is not ready' % self.jobid)
+        return self._error is None
+
+    def wait(self, timeout=None):
+        self._event.wait(timeout)
+
+    def get(self, timeout=None):
+        """
+        :raises multiprocessing.TimeoutError: timeout 秒内没有完成
+        :raises APIError: 任务失败
+        """
+        self.wait(timeout)
+        if not self.ready():
+            raise TimeoutError()
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+    def add_done_callback(self, func):
+        """
+        任务完成后在调度线程 (或回调消息的处理线程) 中调用 func(result), 已完成时立即调用
+        func 中不要执行耗时操作
+        """
+        with self._lock:
+            if not self.ready():
+                self._callbacks.append(func)
+                return
+        func(self)
+
+    def _set(self, value, error=None):
+        with self._lock:
+            if self.ready():
+                return False
+            self._value = value
+            self._error = error
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for func in callbacks:
+            try:
+                func(self)
+            except Exception:
+                logger.exception('Done callback of job %s failed', self.jobid)
+        return True
+
+    def __repr__(self):
+        return '<JobResult %s %s>' % (self.type, self.jobid)
+
+
+class _Tracked(object):
+    __slots__ = ('result', 'seq', 'interval', 'progress_at', 'errors')
+
+    def __init__(self, result, interval):
+        self.result = result
+        self.seq = None
+        self.interval = interval
+        self.progress_at = None
+        self.errors = 0
+
+
+class JobTracker(object):
+    """
+    用一个调度线程跟踪多个异步任务
+    每个任务按各自的间隔调用 get_batch_result: 进度没有变化时间隔按 backoff 倍数增加,
+    有进度时按完成速度估计剩余时间, 间隔限制在 min_interval 与 max_interval 之间
+    配置了任务回调 URL 时, 把 handle_callback 注册为 batch_job_result 事件的处理函数, 收到事件后立即完成任务,
+    此时可以设置 expect_callbacks=True, 轮询只按 max_interval 进行, 用于回调丢失的情况
+
+    tracker = JobTracker(wechat)
+    app.register('event', tracker.handle_callback, event='batch_job_result')
+    result = tracker.track(wechat.sync_users(users, callback=callback))
+    result.get()
+    """
+
+    def __init__(self, wechat, min_interval=2, max_interval=60, backoff=2.0, expect_callbacks=False,
+                 fetch_result=True, max_errors=3):
+        """
+        :param wechat: WechatEnterprise 对象
+        :param min_interval: 最短的查询间隔 (秒), 也是提交后第一次查询的时间
+        :param max_interval: 最长的查询间隔 (秒)
+        :param backoff: 进度没有变化时查询间隔的增长倍数
+        :param expect_callbacks: 是否配置了任务回调 URL
+        :param fetch_result: 收到成功的回调事件后是否再查询一次, 获取每条记录的处理结果
+        :param max_errors: 连续查询失败 (如网络错误) 的次数达到该值时任务以该异常结束
+        """
+        self.wechat = wechat
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.expect_callbacks = expect_callbacks
+        self.fetch_result = fetch_result
+        self.max_errors = max_errors
+        self._jobs = {}
+        # (查询时间, 序号, jobid), 任务重新调度后旧的项按序号忽略
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition(threading.Lock())
+        self._thread = None
+        self._closed = False
+        # 先于 track() 到达的回调事件
+        self._early = TTLCache(maxsize=1000, ttl=600)
+        self._counters = dict.fromkeys(('polls', 'callbacks', 'completed', 'failed'), 0)
+
+    def track(self, job, type=None):
+        """
+        :param job: batch.BatchJob 或 jobid
+        :param type: 任务类型, 如 sync_user, 用于完成后失效通讯录缓存
+        :return: JobResult, 同一个任务多次调用返回同一个对象
+        """
+        jobid = getattr(job, 'jobid', job)
+        type = type or getattr(job, 'type', None)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('JobTracker is closed')
+            tracked = self._jobs.get(jobid)
+            if tracked is not None:
+                return tracked.result
+            interval = self.max_interval if self.expect_callbacks else self.min_interval
+            tracked = self._jobs[jobid] = _Tracked(JobResult(jobid, type), interval)
+            self._schedule(tracked, interval)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+        early = self._early.pop(jobid)
+        if early is not None:
+            self._on_event(tracked, early)
+        return tracked.result
+
+    def _schedule(self, tracked, delay):
+        # 调用方持有锁
+        tracked.seq = next(self._seq)
+        heapq.heappush(self._heap, (time.time() + delay, tracked.seq, tracked.result.jobid))
+        self._cond.notify()
+
+    def _next(self):
+        """
+        等待下一个到期的任务, 关闭后返回 None
+        """
+        with self._cond:
+            while not self._closed:
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                due, seq, jobid = self._heap[0]
+                now = time.time()
+                if due > now:
+                    self._cond.wait(due - now)
+                    continue
+                heapq.heappop(self._heap)
+                tracked = self._jobs.get(jobid)
+                if tracked is not None and tracked.seq == seq:
+                    return tracked
+            return None
+
+    def _run(self):
+        while True:
+            tracked = self._next()
+            if tracked is None:
+                return
+            self._poll(tracked)
+
+    def _count(self, name):
+        with self._cond:
+            self._counters[name] += 1
+
+    def _poll(self, tracked):
+        result = tracked.result
+        self._count('polls')
+        try:
+            resp = self.wechat.get_batch_result(result.jobid)
+        except Exception as e:
+            tracked.errors += 1
+            if tracked.errors >= self.max_errors:
+                self._finish(tracked, None, e)
+            else:
+                with self._cond:
+                    if tracked.seq is not None:
+                        self._schedule(tracked, tracked.interval)
+            return
+        tracked.errors = 0
+        if resp.get('errcode', 0) != 0:
+            self._finish(tracked, None, APIError('Failed to get result of job %s: %s' % (
+                result.jobid, resp.get('errmsg')), errcode=resp.get('errcode')))
+        elif resp.get('status') == STATUS_DONE:
+            self._finish(tracked, resp)
+        else:
+            with self._cond:
+                if tracked.seq is not None:
+                    self._schedule(tracked, self._next_interval(tracked, resp.get('percentage')))
+
+    def _next_interval(self, tracked, percentage):
+        now = time.time()
+        result = tracked.result
+        interval = tracked.interval * self.backoff
+        if percentage is not None:
+            percentage = float(percentage)
+            if result.percentage is not None and percentage > result.percentage and now > tracked.progress_at:
+                # 按最近的完成速度估计剩余时间
+                speed = (percentage - result.percentage) / (now - tracked.progress_at)
+                interval = (100 - percentage) / speed
+            if percentage != result.percentage:
+                result.percentage = percentage
+                tracked.progress_at = now
+        if self.expect_callbacks:
+            interval = self.max_interval
+        tracked.interval = min(max(interval, self.min_interval), self.max_interval)
+        return tracked.interval
+
+    def _finish(self, tracked, value, error=None):
+        result = tracked.result
+        with self._cond:
+            if self._jobs.get(result.jobid) is not tracked:
+                return
+            del self._jobs[result.jobid]
+            # 堆中剩余的项按序号忽略
+            tracked.seq = None
+            self._counters['failed' if error is not None else 'completed'] += 1
+        if error is None:
+            result.type = result.type or value.get('type')
+            # 任务在提交后才执行, 期间缓存的数据已经过期
+            for kind in INVALIDATES.get(result.type, ()):
+                self.wechat.invalidate_directory(kind)
+        result._set(value, error)
+
+    def handle_callback(self, request):
+        """
+        batch_job_result 事件的处理函数, 可直接注册到 CallbackApp
+        :param request: CallbackRequest 或 EventMessage
+        :return: None, 不回复消息
+        """
+        message = getattr(request, 'message', request)
+        event = message.batch_job
+        if not event or not event.get('JobId'):
+            return None
+        self._count('callbacks')
+        with self._cond:
+            tracked = self._jobs.get(event['JobId'])
+        if tracked is None:
+            self._early.set(event['JobId'], event)
+        else:
+            self._on_event(tracked, event)
+        return None
+
+    def _on_event(self, tracked, event):
+        result = tracked.result
+        result.type = result.type or event.get('JobType')
+        errcode = int(event.get('ErrCode') or 0)
+        if errcode:
+            self._finish(tracked, None, APIError('Job %s failed: %s' % (result.jobid, event.get('ErrMsg')),
+                                                 errcode=errcode))
+        elif self.fetch_result:
+            # 回调事件中没有每条记录的处理结果, 立即查询一次
+            with self._cond:
+                if tracked.seq is not None:
+                    self._schedule(tracked, 0)
+        else:
+            self._finish(tracked, {'errcode': 0, 'errmsg': event.get('ErrMsg', 'ok'), 'status': STATUS_DONE,
+                                   'type': result.type, 'percentage': 100})
+
+    def stats(self):
+        """
+        :return: dict, pending 为跟踪中的任务数, polls 为 get_batch_result 调用次数, callbacks 为收到的回调事件数
+        """
+        with self._cond:
+            stats = dict(self._counters)
+            stats['pending'] = len(self._jobs)
+        return stats
+
+    def close(self):
+        """
+        停止调度线程, 未完成的任务不再查询
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
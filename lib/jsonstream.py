@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+import json
+import re
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+class ArrayNotFound(ValueError):
+    """
+    JSON 文档中没有指定的数组, document 为完整的文档 (如接口返回的错误)
+    """
+
+    def __init__(self, key, document):
+        super(ArrayNotFound, self).__init__('No array "%s" in JSON document' % key)
+        self.document = document
+
+
+def iter_json_array(chunks, key, max_buffer=16 * 1024 * 1024):
+    """
+    从分块读取的 JSON 文档中逐个解码 key 对应的数组元素, 只在内存中保留当前元素
+    key 需要是顶层对象中的字段, 且在此之前的字段中不能出现同名字符串 (如 {"errcode": 0, "userlist": [...]})
+    :param chunks: 字节串的可迭代对象, 如 response.iter_content()
+    :param key: 数组的字段名, 如 'userlist'
+    :param max_buffer: 单个元素的最大字节数, 超出时抛出 ValueError
+    :raises ArrayNotFound: 文档中没有该数组, 其 document 属性为解码后的整个文档
+    """
+    marker = '"%s"' % key
+    chunks = iter(chunks)
+    buf = ''
+    # 查找数组的开始
+    for chunk in chunks:
+        buf += chunk
+        start = buf.find(marker)
+        if start < 0:
+            continue
+        pos = _WHITESPACE.match(buf, start + len(marker)).end()
+        if pos >= len(buf):
+            continue
+        if buf[pos] != ':':
+            raise ValueError('Unexpected JSON near "%s"' % key)
+        pos = _WHITESPACE.match(buf, pos + 1).end()
+        if pos >= len(buf):
+            continue
+        if buf[pos] != '[':
+            raise ValueError('"%s" is not an array' % key)
+        buf = buf[pos + 1:]
+        break
+    else:
+        raise ArrayNotFound(key, json.loads(buf) if buf.strip() else None)
+
+    pos = 0
+    exhausted = False
+    while True:
+        pos = _WHITESPACE.match(buf, pos).end()
+        if pos < len(buf):
+            char = buf[pos]
+            if char == ']':
+                break
+            if char == ',':
+                pos = _WHITESPACE.match(buf, pos + 1).end()
+            if pos < len(buf):
+                try:
+                    item, end = _decoder.raw_decode(buf, pos)
+                except ValueError:
+                    # 元素不完整, 需要继续读取
+                    if exhausted:
+                        raise
+                else:
+                    # 元素后面需要有分隔符才能确定数字等值已经完整
+                    if end < len(buf) or exhausted:
+                        yield item
+                        pos = end
+                        continue
+        if exhausted:
+            raise ValueError('Unexpected end of JSON array "%s"' % key)
+        # 丢弃已经解码的部分, 读取下一块
+        buf = buf[pos:]
+        pos = 0
+        if len(buf) > max_buffer:
+            raise ValueError('JSON array item exceeds %d bytes' % max_buffer)
+        try:
+            buf += next(chunks)
+        except StopIteration:
+            exhausted = True
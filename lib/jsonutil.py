@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+# 安装了 ujson 时用于编码请求与解码响应
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+BACKEND = 'ujson' if ujson is not None else 'json'
+
+_ascii_encoder = json.JSONEncoder(separators=(',', ':'))
+_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+_CONTROL_CHARS = ''.join(chr(i) for i in range(32))
+
+
+def dumps(obj):
+    """
+    序列化为 UTF-8 编码的 JSON 字节串, 中文等字符直接输出, 不转义为 \\uXXXX
+    字节串 (str) 按 UTF-8 处理, 引号与反斜杠正常转义
+    """
+    if ujson is not None:
+        return ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False)
+    # ensure_ascii=False 时每个字符串都经过 Python 实现的转义函数, 较慢
+    # 这里先用 C 实现的 ASCII 编码, 再用 raw_unicode_escape 只还原 \uXXXX (包括代理对),
+    # 该编码只识别前面有奇数个反斜杠的 \u, 转义后的反斜杠与 \" \n 等保持不变
+    data = _ascii_encoder.encode(obj)
+    if '\\u' not in data:
+        return data
+    result = data.decode('raw_unicode_escape').encode('utf-8')
+    if len(result.translate(None, _CONTROL_CHARS)) != len(result):
+        # \u0000-\u001f 被还原为控制字符, 改为逐个字符串转义
+        data = _encoder.encode(obj)
+        return data.encode('utf-8') if isinstance(data, unicode) else data
+    return result
+
+
+def loads(data):
+    """
+    :param data: UTF-8 编码的 JSON 字节串, 如接口响应的 response.content
+    """
+    if ujson is not None:
+        return ujson.loads(data)
+    return json.loads(data)
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+import os
+import uuid
+
+
+class MultipartFile(object):
+    """
+    只包含一个文件字段的 multipart/form-data 请求体, 上传时分块读取文件, 不把整个文件读入内存
+    提供 read() 与 __len__, requests 会据此设置 Content-Length 并由 httplib 分块发送
+    重新发送 (如 token 过期后重试) 之前需要调用 seek(0)
+    """
+
+    def __init__(self, fileobj, field='media', filename='media', content_type='application/octet-stream'):
+        """
+        :param fileobj: 可 seek 的文件对象
+        :param field: 表单字段名
+        :param filename: 上传的文件名
+        """
+        self.fileobj = fileobj
+        self.boundary = uuid.uuid4().hex
+        if isinstance(filename, unicode):
+            filename = filename.encode('utf-8')
+        self._head = ('--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\n'
+                      'Content-Type: %s\r\n\r\n') % (self.boundary, field, filename.replace('"', ''), content_type)
+        self._tail = '\r\n--%s--\r\n' % self.boundary
+        fileobj.seek(0, os.SEEK_END)
+        self.size = fileobj.tell()
+        self.seek(0)
+
+    @property
+    def content_type(self):
+        return 'multipart/form-data; boundary=%s' % self.boundary
+
+    def __len__(self):
+        return len(self._head) + self.size + len(self._tail)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        """
+        只支持回到开头
+        """
+        if offset != 0 or whence != os.SEEK_SET:
+            raise IOError('MultipartFile can only seek to the start')
+        self.fileobj.seek(0)
+        self._parts = [self._head, self.fileobj, self._tail]
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self)
+        result = []
+        while size > 0 and self._parts:
+            part = self._parts[0]
+            if isinstance(part, str):
+                data, self._parts[0] = part[:size], part[size:]
+                if not self._parts[0]:
+                    self._parts.pop(0)
+            else:
+                data = part.read(size)
+                if len(data) < size:
+                    self._parts.pop(0)
+            result.append(data)
+            size -= len(data)
+        return ''.join(result)
+
+    def __iter__(self):
+        self.seek(0)
+        while True:
+            data = self.read(64 * 1024)
+            if not data:
+                return
+            yield data
@@ -1,6 +1,101 @@
 # -*- coding: utf-8 -*-
 
-from xml.dom import minidom, Node
+import xml.etree.cElementTree as ET
+from codecs import utf_8_decode
+from xml.sax.saxutils import unescape
+
+
+def _element2dict(parent):
+    """
+    将单个节点转换为 dict
+    叶子节点为文本, 包含子节点的节点为 dict 的列表 (如 SendPicsInfo), 空节点忽略
+    """
+    d = {}
+    for node in parent:
+        if len(node):
+            # 文本与子节点混排时与原 minidom 实现一致, 忽略该节点
+            if node.text and node.text.strip():
+                continue
+            d.setdefault(node.tag, []).append(_element2dict(node))
+        else:
+            text = node.text
+            if text:
+                # cElementTree 对纯 ASCII 文本返回 str, 统一为 unicode
+                d[node.tag] = text if isinstance(text, unicode) else unicode(text)
+    return d
+
+
+def parse_xml(xmlstring):
+    """
+    将微信消息 XML 直接转换为 dict, 不构造 DOM 也不做空白节点清理
+    :raises SyntaxError: XML 不合法 (cElementTree.ParseError)
+    """
+    return _element2dict(ET.fromstring(xmlstring))
+
+
+_PEEK_TAGS = {}
+
+
+def _peek_tag(tag):
+    found = _PEEK_TAGS.get(tag)
+    if found is None:
+        found = _PEEK_TAGS[tag] = ('<%s>' % tag, '</%s>' % tag, len(tag) + 2)
+    return found
+
+
+def _find_outside_cdata(xmlstring, tag, start=0):
+    """
+    查找不在 CDATA 中的 tag, 避免消息内容中的类似节点的文本被当作节点
+    """
+    while True:
+        pos = xmlstring.find(tag, start)
+        if pos < 0:
+            return pos
+        cdata = xmlstring.rfind('<![CDATA[', start, pos)
+        if cdata < 0:
+            return pos
+        cdata_end = xmlstring.find(']]>', cdata)
+        if cdata_end < 0:
+            return -1
+        if cdata_end < pos:
+            # 之前最后一个 CDATA 在 tag 之前已经结束
+            return pos
+        # tag 在 CDATA 中, 从 CDATA 结尾继续查找
+        start = cdata_end + 3
+
+
+def peek_xml(xmlstring, tags):
+    """
+    不解析整个 XML, 直接查找指定节点的文本, 用于只需要少数几个字段的场景
+    只适用于不重复且没有子节点的节点, 如 MsgType, Event, AgentID, CDATA 中的内容不会被当作节点
+    :param tags: 节点名列表
+    :return: dict, 不存在的节点为 None
+    """
+    result = {}
+    for tag in tags:
+        start_tag, end_tag, size = _peek_tag(tag)
+        start = _find_outside_cdata(xmlstring, start_tag)
+        if start < 0:
+            result[tag] = None
+            continue
+        start += size
+        if xmlstring.startswith('<![CDATA[', start):
+            cdata_end = xmlstring.find(']]>', start)
+            end = cdata_end + 3 if cdata_end >= 0 else -1
+            if end < 0 or not xmlstring.startswith(end_tag, end):
+                result[tag] = None
+                continue
+            text = xmlstring[start + 9:cdata_end]
+        else:
+            end = xmlstring.find(end_tag, start)
+            if end < 0:
+                result[tag] = None
+                continue
+            text = xmlstring[start:end]
+            if '&' in text:
+                text = unescape(text, {'&quot;': '"', '&apos;': "'"})
+        result[tag] = utf_8_decode(text)[0] if isinstance(text, str) else text
+    return result
 
 
 class XMLStore(object):
@@ -9,48 +104,11 @@ class XMLStore(object):
     """
     def __init__(self, xmlstring):
         self._raw = xmlstring
-        self._doc = minidom.parseString(xmlstring)
+        self._dict = parse_xml(xmlstring)
 
     @property
     def xml2dict(self):
         """
         将 XML 转换为 dict
         """
-        self._remove_whitespace_nodes(self._doc.childNodes[0])
-        return self._element2dict(self._doc.childNodes[0])
-
-    def _element2dict(self, parent):
-        """
-        将单个节点转换为 dict
-        """
-        d = {}
-        for node in parent.childNodes:
-            if not isinstance(node, minidom.Element):
-                continue
-            if not node.hasChildNodes():
-                continue
-
-            if node.childNodes[0].nodeType == minidom.Node.ELEMENT_NODE:
-                try:
-                    d[node.tagName]
-                except KeyError:
-                    d[node.tagName] = []
-                d[node.tagName].append(self._element2dict(node))
-            elif len(node.childNodes) == 1 and node.childNodes[0].nodeType in [minidom.Node.CDATA_SECTION_NODE, minidom.Node.TEXT_NODE]:
-                d[node.tagName] = node.childNodes[0].data
-        return d
-
-    def _remove_whitespace_nodes(self, node, unlink=True):
-        """
-        删除空白无用节点
-        """
-        remove_list = []
-        for child in node.childNodes:
-            if child.nodeType == Node.TEXT_NODE and not child.data.strip():
-                remove_list.append(child)
-            elif child.hasChildNodes():
-                self._remove_whitespace_nodes(child, unlink)
-        for node in remove_list:
-            node.parentNode.removeChild(node)
-            if unlink:
-                node.unlink()
\ No newline at end of file
+        return dict(self._dict)
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import mimetypes
+import mmap
+import os
+import threading
+import time
+from cStringIO import StringIO
+
+from .cache import TTLCache
+
+# 临时素材的有效期 (秒)
+MEDIA_LIFETIME = 3 * 24 * 3600
+
+
+class MediaSource(object):
+    """
+    待上传的素材, 统一为可 seek 的文件对象
+    文件路径以 mmap 方式打开, 计算摘要与上传时都直接读取映射的页面, 不复制整个文件
+    """
+
+    def __init__(self, fileobj=None, path=None, data=None, filename=None, content_type=None):
+        """
+        fileobj / path / data 三选一
+        :param fileobj: 可 seek 的文件对象, 包括 mmap
+        :param path: 文件路径
+        :param data: 素材内容的字节串
+        :param filename: 上传的文件名, 默认取文件名
+        :param content_type: 默认按文件名推断
+        """
+        self._owned = []
+        self._buffer = None
+        if path is not None:
+            fileobj = open(path, 'rb')
+            self._owned.append(fileobj)
+            filename = filename or os.path.basename(path)
+            if os.fstat(fileobj.fileno()).st_size:
+                # 空文件不能映射
+                fileobj = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+                self._owned.append(fileobj)
+                self._buffer = fileobj
+        elif data is not None:
+            self._buffer = data
+            fileobj = StringIO(data)
+        elif fileobj is None:
+            raise ValueError('One of fileobj, path and data is required')
+        elif isinstance(fileobj, mmap.mmap):
+            self._buffer = fileobj
+        self.fileobj = fileobj
+        self.filename = filename or os.path.basename(getattr(fileobj, 'name', '') or '') or 'media'
+        self.content_type = (content_type or mimetypes.guess_type(self.filename)[0] or
+                             'application/octet-stream')
+
+    def digest(self):
+        """
+        :return: 内容的 SHA-1, 十六进制
+        """
+        if self._buffer is not None:
+            return hashlib.sha1(self._buffer).hexdigest()
+        sha1 = hashlib.sha1()
+        self.fileobj.seek(0)
+        for chunk in iter(lambda: self.fileobj.read(64 * 1024), ''):
+            sha1.update(chunk)
+        self.fileobj.seek(0)
+        return sha1.hexdigest()
+
+    def close(self):
+        """
+        关闭由 path 打开的文件, 调用方传入的 fileobj 不关闭
+        """
+        for fileobj in reversed(self._owned):
+            fileobj.close()
+        self._owned = []
+
+
+class MediaCache(object):
+    """
+    临时素材的 media_id 缓存, 按 (corpid, 素材类型, 内容摘要) 保存 upload_media 的返回结果
+    同一内容在有效期内重复上传时直接返回缓存的 media_id
+    临时素材在 created_at 之后 3 天失效, 缓存提前 margin 秒过期, 保证拿到的 media_id 在发送时仍然有效
+    """
+
+    def __init__(self, cache=None, margin=3600, maxsize=1000):
+        """
+        :param cache: 存储后端, 需提供 get(key) / set(key, value, ttl=None) / clear(), 默认为 TTLCache
+        :param margin: 提前过期的秒数
+        :param maxsize: 默认 TTLCache 最多保存的项数
+        """
+        self.cache = cache if cache is not None else TTLCache(maxsize)
+        self.margin = margin
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0, 'misses': 0}
+
+    def _key(self, corpid, media_type, digest):
+        return u'%s:media:%s:%s' % (corpid, media_type, digest)
+
+    def get(self, corpid, media_type, digest):
+        """
+        :return: 缓存的 upload_media 返回结果, 没有缓存时返回 None
+        """
+        value = self.cache.get(self._key(corpid, media_type, digest))
+        with self._lock:
+            self._counters['hits' if value is not None else 'misses'] += 1
+        return value
+
+    def set(self, corpid, media_type, digest, value):
+        """
+        :param value: upload_media 的返回结果, 按其中的 created_at 计算过期时间
+        """
+        now = time.time()
+        created_at = int(value.get('created_at') or now)
+        ttl = created_at + MEDIA_LIFETIME - self.margin - now
+        if ttl > 0:
+            self.cache.set(self._key(corpid, media_type, digest), value, ttl=ttl)
+
+    def clear(self):
+        self.cache.clear()
+
+    def stats(self):
+        """
+        :return: dict, hits / misses 计数与 hit_rate 命中率
+        """
+        with self._lock:
+            stats = dict(self._counters)
+        total = stats['hits'] + stats['misses']
+        stats['hit_rate'] = float(stats['hits']) / total if total else 0.0
+        return stats
@@ -1,4 +1,7 @@
+# -*- coding: utf-8 -*-
+
 from .exceptions import ParseError
+from .lib.parser import parse_xml, peek_xml
 
 MESSAGE_TYPES = {}
 
@@ -10,17 +13,74 @@ def handle_for_type(type):
     return register
 
 
+class LazyField(object):
+    """
+    首次访问时才从消息中取值并转换的字段
+    """
+
+    def __init__(self, tag, convert=None, default=None):
+        self.tag = tag
+        self.convert = convert
+        self.default = default
+
+    def __get__(self, message, owner):
+        if message is None:
+            return self
+        value = message._decoded().get(self.tag, self.default)
+        if value is not None and self.convert is not None:
+            value = self.convert(value)
+        return value
+
+
 class WechatMessage(object):
+    """
+    回调消息, 只保存路由与回复需要的字段, 其余字段在首次访问时从 raw (解密后的 XML) 解析, 只解析一次
+    XML 中的其他节点可按节点名访问, 如 message.ScanCodeInfo
+    """
+    __slots__ = ('id', 'target', 'source', 'time', 'agentid', 'type', 'raw', '_fields')
+    # 必须存在的节点, 缺少时抛出 ParseError
+    REQUIRED = ()
+    # 构造时读取的节点, 从 raw 构造时只查找这些节点与 REQUIRED, 不解析整个 XML
+    EAGER = ('MsgId', 'ToUserName', 'FromUserName', 'CreateTime', 'AgentID')
+
     def __init__(self, message):
+        for tag in self.REQUIRED:
+            if tag not in message:
+                raise ParseError()
         self.id = int(message.pop('MsgId', 0))
         self.target = message.pop('ToUserName', None)
         self.source = message.pop('FromUserName', None)
         self.time = int(message.pop('CreateTime', 0))
         self.agentid = int(message.pop('AgentID', 0))
-        self.__dict__.update(message)
+        if 'type' in message:
+            self.type = message.pop('type')
+        self.raw = message.pop('raw', None)
+        # 有 raw 时其余字段只是 EAGER 与 REQUIRED 的副本, 不保留
+        self._fields = None if self.raw else message
+
+    def _decoded(self):
+        fields = self._fields
+        if fields is None:
+            try:
+                fields = self._fields = parse_xml(self.raw)
+            except SyntaxError:
+                raise ParseError()
+        return fields
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self._decoded()[name]
+        except KeyError:
+            raise AttributeError(name)
+
 
 @handle_for_type('text')
 class TextMessage(WechatMessage):
+    __slots__ = ('content',)
+    EAGER = WechatMessage.EAGER + ('Content',)
+
     def __init__(self, message):
         self.content = message.pop('Content', '')
         super(TextMessage, self).__init__(message)
@@ -28,102 +88,124 @@ class TextMessage(WechatMessage):
 
 @handle_for_type('image')
 class ImageMessage(WechatMessage):
-    def __init__(self, message):
-        try:
-            self.picurl = message.pop('PicUrl')
-            self.media_id = message.pop('MediaId')
-        except KeyError:
-            raise ParseError()
-        super(ImageMessage, self).__init__(message)
+    __slots__ = ()
+    REQUIRED = ('PicUrl', 'MediaId')
+    picurl = LazyField('PicUrl')
+    media_id = LazyField('MediaId')
 
 
 @handle_for_type('video')
 class VideoMessage(WechatMessage):
-    def __init__(self, message):
-        try:
-            self.media_id = message.pop('MediaId')
-            self.thumb_media_id = message.pop('ThumbMediaId')
-        except KeyError:
-            raise ParseError()
-        super(VideoMessage, self).__init__(message)
+    __slots__ = ()
+    REQUIRED = ('MediaId', 'ThumbMediaId')
+    media_id = LazyField('MediaId')
+    thumb_media_id = LazyField('ThumbMediaId')
 
 
 @handle_for_type('shortvideo')
 class ShortVideoMessage(WechatMessage):
-    def __init__(self, message):
-        try:
-            self.media_id = message.pop('MediaId')
-            self.thumb_media_id = message.pop('ThumbMediaId')
-        except KeyError:
-            raise ParseError()
-        super(ShortVideoMessage, self).__init__(message)
+    __slots__ = ()
+    REQUIRED = ('MediaId', 'ThumbMediaId')
+    media_id = LazyField('MediaId')
+    thumb_media_id = LazyField('ThumbMediaId')
 
 
 @handle_for_type('location')
 class LocationMessage(WechatMessage):
+    __slots__ = ()
+    REQUIRED = ('Location_X', 'Location_Y', 'Scale', 'Label')
+    scale = LazyField('Scale', int)
+    label = LazyField('Label')
+
     def __init__(self, message):
         try:
-            location_x = message.pop('Location_X')
-            location_y = message.pop('Location_Y')
-            self.location = (float(location_x), float(location_y))
-            self.scale = int(message.pop('Scale'))
-            self.label = message.pop('Label')
-        except KeyError:
+            float(message['Location_X']), float(message['Location_Y']), int(message['Scale'])
+        except (KeyError, ValueError):
             raise ParseError()
         super(LocationMessage, self).__init__(message)
 
+    @property
+    def location(self):
+        fields = self._decoded()
+        return float(fields['Location_X']), float(fields['Location_Y'])
+
 
 @handle_for_type('link')
 class LinkMessage(WechatMessage):
-    def __init__(self, message):
-        try:
-            self.title = message.pop('Title')
-            self.description = message.pop('Description')
-            self.url = message.pop('Url')
-        except KeyError:
-            raise ParseError()
-        super(LinkMessage, self).__init__(message)
+    __slots__ = ()
+    REQUIRED = ('Title', 'Description', 'Url')
+    title = LazyField('Title')
+    description = LazyField('Description')
+    url = LazyField('Url')
 
 
 @handle_for_type('event')
 class EventMessage(WechatMessage):
+    """
+    type 为事件类型, 如 'click', key 为 EventKey, 其余字段按事件类型取值
+    """
+    __slots__ = ('key',)
+    EAGER = WechatMessage.EAGER + ('Event', 'EventKey')
+    ticket = LazyField('Ticket')
+    menu_id = LazyField('MenuId')
+    latitude = LazyField('Latitude', float, '0')
+    longitude = LazyField('Longitude', float, '0')
+    precision = LazyField('Precision', float, '0')
+    status = LazyField('Status')
+    # batch_job_result 事件: {'JobId': ..., 'JobType': ..., 'ErrCode': ..., 'ErrMsg': ...}
+    batch_job = LazyField('BatchJob', lambda jobs: jobs[0])
+
     def __init__(self, message):
         message.pop('type')
         try:
             self.type = message.pop('Event').lower()
-            if self.type == 'subscribe' or self.type == 'scan':
-                self.key = message.pop('EventKey', None)
-                self.ticket = message.pop('Ticket', None)
-            elif self.type in ['click', 'scancode_push', 'scancode_waitmsg',
-                               'pic_sysphoto', 'pic_photo_or_album', 'pic_weixin', 'location_select']:
-                self.key = message.pop('EventKey', None)
-            elif self.type == 'view':
-                self.key = message.pop('EventKey', None)
-                self.menu_id = message.pop('MenuId', None)
-            elif self.type == 'location':
-                self.latitude = float(message.pop('Latitude', '0'))
-                self.longitude = float(message.pop('Longitude', '0'))
-                self.precision = float(message.pop('Precision', '0'))
-            elif self.type == 'templatesendjobfinish':
-                self.status = message.pop('Status', None)
         except KeyError:
             raise ParseError()
+        self.key = message.pop('EventKey', None)
         super(EventMessage, self).__init__(message)
 
 
 @handle_for_type('voice')
 class VoiceMessage(WechatMessage):
-    def __init__(self, message):
-        try:
-            self.media_id = message.pop('MediaId')
-            self.format = message.pop('Format')
-            self.recognition = message.pop('Recognition', None)
-        except KeyError:
-            raise ParseError()
-        super(VoiceMessage, self).__init__(message)
+    __slots__ = ()
+    REQUIRED = ('MediaId', 'Format')
+    media_id = LazyField('MediaId')
+    format = LazyField('Format')
+    recognition = LazyField('Recognition')
 
 
 class UnknownMessage(WechatMessage):
+    __slots__ = ()
+
     def __init__(self, message):
         self.type = 'unknown'
         super(UnknownMessage, self).__init__(message)
+
+
+def build_message(raw):
+    """
+    从解密后的 XML 构造消息对象, 只查找构造需要的节点, 其余字段在首次访问时解析
+    :raises ParseError: XML 不合法或缺少必需的节点
+    """
+    msg_type = peek_xml(raw, ('MsgType',))['MsgType']
+    if not msg_type:
+        raise ParseError()
+    message_type = MESSAGE_TYPES.get(msg_type.lower(), UnknownMessage)
+    message = {}
+    for tag, value in peek_xml(raw, message_type.EAGER + message_type.REQUIRED).items():
+        if value:
+            message[tag] = value
+        elif value is None and '<%s>' % tag in raw:
+            # 节点无法直接读取 (如内容拆分为多段 CDATA), 解析整个 XML
+            try:
+                message = parse_xml(raw)
+            except SyntaxError:
+                raise ParseError()
+            message.pop('MsgType', None)
+            break
+    message['type'] = msg_type.lower()
+    message['raw'] = raw
+    try:
+        return message_type(message)
+    except ValueError:
+        raise ParseError()
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+from .exceptions import RateLimitExceeded
+
+SCOPES = ('corpid', 'agentid', 'path')
+
+
+class TokenBucket(object):
+    """
+    令牌桶, 每秒补充 rate 个令牌, 最多积累 capacity 个
+    令牌可以预支 (余额为负), 预支的调用需要等待余额恢复
+    """
+
+    def __init__(self, rate, capacity=None, clock=time.time):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self._clock = clock
+        self._tokens = self.capacity
+        self._updated = clock()
+
+    def _fill(self):
+        now = self._clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, n=1):
+        """取得 n 个令牌需要等待的秒数"""
+        self._fill()
+        if self._tokens >= n:
+            return 0.0
+        return (n - self._tokens) / self.rate
+
+    def take(self, n=1):
+        self._fill()
+        self._tokens -= n
+
+
+class Rule(object):
+    def __init__(self, rate, capacity, scope, corpid, agentid, path):
+        self.rate = rate
+        self.capacity = capacity
+        self.scope = scope
+        self.filters = {'corpid': corpid, 'agentid': agentid, 'path': path}
+
+    def match(self, key):
+        for name, value in self.filters.items():
+            if value is not None and str(value) != str(key[name]):
+                return False
+        return True
+
+
+class RateLimiter(object):
+    """
+    客户端限流, 按 corpid / agentid / 接口路径 配置令牌桶
+    一次调用需要同时取得所有匹配规则的令牌
+
+    limiter = RateLimiter()
+    # 每个应用每秒 20 次
+    limiter.add_rule(20, scope=('corpid', 'agentid'))
+    # 每个企业的 message/send 每秒 50 次, 允许突发 100 次
+    limiter.add_rule(50, capacity=100, scope=('corpid', 'path'), path='/message/send')
+    """
+
+    def __init__(self, blocking=True, timeout=None, clock=time.time):
+        """
+        :param blocking: acquire 的默认方式, True 时等待令牌, False 时取不到令牌立即抛出 RateLimitExceeded
+        :param timeout: 阻塞等待的最长时间 (秒), 超出时抛出 RateLimitExceeded, None 为不限
+        """
+        self.blocking = blocking
+        self.timeout = timeout
+        self._clock = clock
+        self._rules = []
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def add_rule(self, rate, capacity=None, scope=('corpid',), corpid=None, agentid=None, path=None):
+        """
+        增加限流规则
+        :param rate: 每秒允许的调用次数
+        :param capacity: 允许的突发调用次数, 默认为 rate
+        :param scope: 按哪些维度分别计数, 取值为 SCOPES 的子集, 如 ('corpid', 'agentid') 为每个应用一个令牌桶
+        :param corpid: 仅对该企业生效, None 为全部
+        :param agentid: 仅对该应用生效, None 为全部
+        :param path: 仅对该接口生效, 如 '/message/send', None 为全部
+        """
+        for name in scope:
+            if name not in SCOPES:
+                raise ValueError('Unknown rate limit scope: %s' % name)
+        with self._lock:
+            self._rules.append(Rule(rate, capacity, tuple(scope), corpid, agentid, path))
+
+    def _matched(self, corpid, agentid, path):
+        key = {'corpid': corpid, 'agentid': agentid, 'path': path}
+        buckets = []
+        for index, rule in enumerate(self._rules):
+            if not rule.match(key):
+                continue
+            bucket_key = (index,) + tuple(key[name] for name in rule.scope)
+            bucket = self._buckets.get(bucket_key)
+            if bucket is None:
+                bucket = self._buckets[bucket_key] = TokenBucket(rule.rate, rule.capacity, self._clock)
+            buckets.append(bucket)
+        return buckets
+
+    def wait_time(self, corpid, agentid=None, path=None):
+        """
+        当前调用该接口需要等待的秒数
+        """
+        with self._lock:
+            return max([bucket.wait_time() for bucket in self._matched(corpid, agentid, path)] or [0.0])
+
+    def wait_times(self):
+        """
+        所有令牌桶当前需要等待的秒数
+        :return: dict, key 为 (规则序号, scope 各维度的值...)
+        """
+        with self._lock:
+            return dict((key, bucket.wait_time()) for key, bucket in self._buckets.items())
+
+    def acquire(self, corpid, agentid=None, path=None, blocking=None, timeout=None):
+        """
+        取得一次调用的令牌
+        :param blocking: 是否阻塞等待, 默认使用构造参数
+        :param timeout: 阻塞等待的最长时间, 默认使用构造参数
+        :return: 实际等待的秒数
+        :raises RateLimitExceeded: 非阻塞模式下令牌不足, 或需要等待的时间超出 timeout
+        """
+        blocking = self.blocking if blocking is None else blocking
+        timeout = self.timeout if timeout is None else timeout
+        with self._lock:
+            buckets = self._matched(corpid, agentid, path)
+            wait = max([bucket.wait_time() for bucket in buckets] or [0.0])
+            if wait > 0 and (not blocking or (timeout is not None and wait > timeout)):
+                raise RateLimitExceeded('Rate limit exceeded for %s' % path, wait=wait)
+            for bucket in buckets:
+                bucket.take()
+        if wait > 0:
+            time.sleep(wait)
+        return wait
@@ -1,9 +1,44 @@
 # -*- coding: utf-8 -*-
 
 import time
+from string import Formatter
 
 from .messages import WechatMessage
 
+_CDATA_START = u'<![CDATA['
+_CDATA_END = u']]>'
+_COMPILED = {}
+
+
+def compile_template(template):
+    """
+    找出模板中位于 CDATA 内的字段, 以及模板自身的 ]]> 个数, 同一模板只分析一次
+    """
+    compiled = _COMPILED.get(template)
+    if compiled is None:
+        fields = tuple(field for literal, field, _, _ in Formatter().parse(template)
+                       if field is not None and literal.endswith(_CDATA_START))
+        compiled = _COMPILED[template] = (fields, template.count(_CDATA_END))
+    return compiled
+
+
+def _render(template, args, nested=0):
+    """
+    按模板渲染, CDATA 中的 ]]> 拆分为两段 CDATA
+    先直接 format, 结果中的 ]]> 个数与模板一致时说明字段中没有 ]]>, 无需逐个字段检查
+    :param nested: 非 CDATA 字段 (已渲染的子节点) 中包含的 ]]> 个数
+    """
+    fields, count = compile_template(template)
+    result = template.format(**args)
+    if result.count(_CDATA_END) == count + nested:
+        return result
+    escaped = dict(args)
+    for field in fields:
+        value = escaped[field]
+        if isinstance(value, basestring):
+            escaped[field] = value.replace(_CDATA_END, u']]]]><![CDATA[>')
+    return template.format(**escaped)
+
 
 class WechatReply(object):
     def __init__(self, message=None, **kwargs):
@@ -21,20 +56,24 @@ class WechatReply(object):
     def render(self):
         raise NotImplementedError()
 
+    def render_bytes(self):
+        """
+        :return: 回复消息的 UTF-8 字节串, 可直接加密
+        """
+        return self.render().encode('utf-8')
+
 
 class TextReply(WechatReply):
     """
     回复文字消息
     """
-    TEMPLATE = u"""
-    <xml>
-    <ToUserName><![CDATA[{target}]]></ToUserName>
-    <FromUserName><![CDATA[{source}]]></FromUserName>
-    <CreateTime>{time}</CreateTime>
-    <MsgType><![CDATA[text]]></MsgType>
-    <Content><![CDATA[{content}]]></Content>
-    </xml>
-    """
+    TEMPLATE = (u"<xml>"
+                u"<ToUserName><![CDATA[{target}]]></ToUserName>"
+                u"<FromUserName><![CDATA[{source}]]></FromUserName>"
+                u"<CreateTime>{time}</CreateTime>"
+                u"<MsgType><![CDATA[text]]></MsgType>"
+                u"<Content><![CDATA[{content}]]></Content>"
+                u"</xml>")
 
     def __init__(self, message, content):
         """
@@ -44,24 +83,22 @@ class TextReply(WechatReply):
         super(TextReply, self).__init__(message=message, content=content)
 
     def render(self):
-        return TextReply.TEMPLATE.format(**self._args)
+        return _render(TextReply.TEMPLATE, self._args)
 
 
 class ImageReply(WechatReply):
     """
     回复图片消息
     """
-    TEMPLATE = u"""
-    <xml>
-    <ToUserName><![CDATA[{target}]]></ToUserName>
-    <FromUserName><![CDATA[{source}]]></FromUserName>
-    <CreateTime>{time}</CreateTime>
-    <MsgType><![CDATA[image]]></MsgType>
-    <Image>
-    <MediaId><![CDATA[{media_id}]]></MediaId>
-    </Image>
-    </xml>
-    """
+    TEMPLATE = (u"<xml>"
+                u"<ToUserName><![CDATA[{target}]]></ToUserName>"
+                u"<FromUserName><![CDATA[{source}]]></FromUserName>"
+                u"<CreateTime>{time}</CreateTime>"
+                u"<MsgType><![CDATA[image]]></MsgType>"
+                u"<Image>"
+                u"<MediaId><![CDATA[{media_id}]]></MediaId>"
+                u"</Image>"
+                u"</xml>")
 
     def __init__(self, message, media_id):
         """
@@ -71,24 +108,22 @@ class ImageReply(WechatReply):
         super(ImageReply, self).__init__(message=message, media_id=media_id)
 
     def render(self):
-        return ImageReply.TEMPLATE.format(**self._args)
+        return _render(ImageReply.TEMPLATE, self._args)
 
 
 class VoiceReply(WechatReply):
     """
     回复语音消息
     """
-    TEMPLATE = u"""
-    <xml>
-    <ToUserName><![CDATA[{target}]]></ToUserName>
-    <FromUserName><![CDATA[{source}]]></FromUserName>
-    <CreateTime>{time}</CreateTime>
-    <MsgType><![CDATA[voice]]></MsgType>
-    <Voice>
-    <MediaId><![CDATA[{media_id}]]></MediaId>
-    </Voice>
-    </xml>
-    """
+    TEMPLATE = (u"<xml>"
+                u"<ToUserName><![CDATA[{target}]]></ToUserName>"
+                u"<FromUserName><![CDATA[{source}]]></FromUserName>"
+                u"<CreateTime>{time}</CreateTime>"
+                u"<MsgType><![CDATA[voice]]></MsgType>"
+                u"<Voice>"
+                u"<MediaId><![CDATA[{media_id}]]></MediaId>"
+                u"</Voice>"
+                u"</xml>")
 
     def __init__(self, message, media_id):
         """
@@ -98,26 +133,24 @@ class VoiceReply(WechatReply):
         super(VoiceReply, self).__init__(message=message, media_id=media_id)
 
     def render(self):
-        return VoiceReply.TEMPLATE.format(**self._args)
+        return _render(VoiceReply.TEMPLATE, self._args)
 
 
 class VideoReply(WechatReply):
     """
     回复视频消息
     """
-    TEMPLATE = u"""
-    <xml>
-    <ToUserName><![CDATA[{target}]]></ToUserName>
-    <FromUserName><![CDATA[{source}]]></FromUserName>
-    <CreateTime>{time}</CreateTime>
-    <MsgType><![CDATA[video]]></MsgType>
-    <Video>
-    <MediaId><![CDATA[{media_id}]]></MediaId>
-    <Title><![CDATA[{title}]]></Title>
-    <Description><![CDATA[{description}]]></Description>
-    </Video>
-    </xml>
-    """
+    TEMPLATE = (u"<xml>"
+                u"<ToUserName><![CDATA[{target}]]></ToUserName>"
+                u"<FromUserName><![CDATA[{source}]]></FromUserName>"
+                u"<CreateTime>{time}</CreateTime>"
+                u"<MsgType><![CDATA[video]]></MsgType>"
+                u"<Video>"
+                u"<MediaId><![CDATA[{media_id}]]></MediaId>"
+                u"<Title><![CDATA[{title}]]></Title>"
+                u"<Description><![CDATA[{description}]]></Description>"
+                u"</Video>"
+                u"</xml>")
 
     def __init__(self, message, media_id, title=None, description=None):
         """
@@ -131,43 +164,39 @@ class VideoReply(WechatReply):
         super(VideoReply, self).__init__(message=message, media_id=media_id, title=title, description=description)
 
     def render(self):
-        return VideoReply.TEMPLATE.format(**self._args)
+        return _render(VideoReply.TEMPLATE, self._args)
 
 
 class MusicReply(WechatReply):
     """
     回复音乐消息
     """
-    TEMPLATE_THUMB = u"""
-    <xml>
-    <ToUserName><![CDATA[{target}]]></ToUserName>
-    <FromUserName><![CDATA[{source}]]></FromUserName>
-    <CreateTime>{time}</CreateTime>
-    <MsgType><![CDATA[music]]></MsgType>
-    <Music>
-    <Title><![CDATA[{title}]]></Title>
-    <Description><![CDATA[{description}]]></Description>
-    <MusicUrl><![CDATA[{music_url}]]></MusicUrl>
-    <HQMusicUrl><![CDATA[{hq_music_url}]]></HQMusicUrl>
-    <ThumbMediaId><![CDATA[{thumb_media_id}]]></ThumbMediaId>
-    </Music>
-    </xml>
-    """
-
-    TEMPLATE_NOTHUMB = u"""
-    <xml>
-    <ToUserName><![CDATA[{target}]]></ToUserName>
-    <FromUserName><![CDATA[{source}]]></FromUserName>
-    <CreateTime>{time}</CreateTime>
-    <MsgType><![CDATA[music]]></MsgType>
-    <Music>
-    <Title><![CDATA[{title}]]></Title>
-    <Description><![CDATA[{description}]]></Description>
-    <MusicUrl><![CDATA[{music_url}]]></MusicUrl>
-    <HQMusicUrl><![CDATA[{hq_music_url}]]></HQMusicUrl>
-    </Music>
-    </xml>
-    """
+    TEMPLATE_THUMB = (u"<xml>"
+                      u"<ToUserName><![CDATA[{target}]]></ToUserName>"
+                      u"<FromUserName><![CDATA[{source}]]></FromUserName>"
+                      u"<CreateTime>{time}</CreateTime>"
+                      u"<MsgType><![CDATA[music]]></MsgType>"
+                      u"<Music>"
+                      u"<Title><![CDATA[{title}]]></Title>"
+                      u"<Description><![CDATA[{description}]]></Description>"
+                      u"<MusicUrl><![CDATA[{music_url}]]></MusicUrl>"
+                      u"<HQMusicUrl><![CDATA[{hq_music_url}]]></HQMusicUrl>"
+                      u"<ThumbMediaId><![CDATA[{thumb_media_id}]]></ThumbMediaId>"
+                      u"</Music>"
+                      u"</xml>")
+
+    TEMPLATE_NOTHUMB = (u"<xml>"
+                        u"<ToUserName><![CDATA[{target}]]></ToUserName>"
+                        u"<FromUserName><![CDATA[{source}]]></FromUserName>"
+                        u"<CreateTime>{time}</CreateTime>"
+                        u"<MsgType><![CDATA[music]]></MsgType>"
+                        u"<Music>"
+                        u"<Title><![CDATA[{title}]]></Title>"
+                        u"<Description><![CDATA[{description}]]></Description>"
+                        u"<MusicUrl><![CDATA[{music_url}]]></MusicUrl>"
+                        u"<HQMusicUrl><![CDATA[{hq_music_url}]]></HQMusicUrl>"
+                        u"</Music>"
+                        u"</xml>")
 
     def __init__(self, message, title='', description='', music_url='', hq_music_url='', thumb_media_id=None):
         title = title or ''
@@ -179,9 +208,9 @@ class MusicReply(WechatReply):
 
     def render(self):
         if self._args['thumb_media_id']:
-            return MusicReply.TEMPLATE_THUMB.format(**self._args)
+            return _render(MusicReply.TEMPLATE_THUMB, self._args)
         else:
-            return MusicReply.TEMPLATE_NOTHUMB.format(**self._args)
+            return _render(MusicReply.TEMPLATE_NOTHUMB, self._args)
 
 
 class Article(object):
@@ -193,25 +222,21 @@ class Article(object):
 
 
 class ArticleReply(WechatReply):
-    TEMPLATE = u"""
-    <xml>
-    <ToUserName><![CDATA[{target}]]></ToUserName>
-    <FromUserName><![CDATA[{source}]]></FromUserName>
-    <CreateTime>{time}</CreateTime>
-    <MsgType><![CDATA[news]]></MsgType>
-    <ArticleCount>{count}</ArticleCount>
-    <Articles>{items}</Articles>
-    </xml>
-    """
-
-    ITEM_TEMPLATE = u"""
-    <item>
-    <Title><![CDATA[{title}]]></Title>
-    <Description><![CDATA[{description}]]></Description>
-    <PicUrl><![CDATA[{picurl}]]></PicUrl>
-    <Url><![CDATA[{url}]]></Url>
-    </item>
-    """
+    TEMPLATE = (u"<xml>"
+                u"<ToUserName><![CDATA[{target}]]></ToUserName>"
+                u"<FromUserName><![CDATA[{source}]]></FromUserName>"
+                u"<CreateTime>{time}</CreateTime>"
+                u"<MsgType><![CDATA[news]]></MsgType>"
+                u"<ArticleCount>{count}</ArticleCount>"
+                u"<Articles>{items}</Articles>"
+                u"</xml>")
+
+    ITEM_TEMPLATE = (u"<item>"
+                     u"<Title><![CDATA[{title}]]></Title>"
+                     u"<Description><![CDATA[{description}]]></Description>"
+                     u"<PicUrl><![CDATA[{picurl}]]></PicUrl>"
+                     u"<Url><![CDATA[{url}]]></Url>"
+                     u"</item>")
 
     def __init__(self, message, **kwargs):
         super(ArticleReply, self).__init__(message, **kwargs)
@@ -226,29 +251,22 @@ class ArticleReply(WechatReply):
     def render(self):
         items = []
         for article in self._articles:
-            items.append(ArticleReply.ITEM_TEMPLATE.format(
-                title=article.title,
-                description=article.description,
-                picurl=article.picurl,
-                url=article.url,
-            ))
-        self._args["items"] = ''.join(items)
-        self._args["count"] = len(items)
-        return ArticleReply.TEMPLATE.format(**self._args)
+            items.append(_render(ArticleReply.ITEM_TEMPLATE, article.__dict__))
+        self._args["items"] = items = u''.join(items)
+        self._args["count"] = len(self._articles)
+        return _render(ArticleReply.TEMPLATE, self._args, nested=items.count(_CDATA_END))
 
 
 class GroupTransferReply(WechatReply):
     """
     客服群发转发消息
     """
-    TEMPLATE = u"""
-    <xml>
-    <ToUserName><![CDATA[{target}]]></ToUserName>
-    <FromUserName><![CDATA[{source}]]></FromUserName>
-    <CreateTime>{time}</CreateTime>
-    <MsgType><![CDATA[transfer_customer_service]]></MsgType>
-    </xml>
-    """
+    TEMPLATE = (u"<xml>"
+                u"<ToUserName><![CDATA[{target}]]></ToUserName>"
+                u"<FromUserName><![CDATA[{source}]]></FromUserName>"
+                u"<CreateTime>{time}</CreateTime>"
+                u"<MsgType><![CDATA[transfer_customer_service]]></MsgType>"
+                u"</xml>")
 
     def __init__(self, message):
         """
@@ -257,6 +275,6 @@ class GroupTransferReply(WechatReply):
         super(GroupTransferReply, self).__init__(message=message)
 
     def render(self):
-        return GroupTransferReply.TEMPLATE.format(**self._args)
+        return _render(GroupTransferReply.TEMPLATE, self._args)
 
 
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+import random
+import threading
+
+# access_token 不合法 / 已过期
+TOKEN_EXPIRED_CODES = frozenset([40014, 42001])
+# 系统繁忙 / 接口调用超过限制
+BUSY_CODES = frozenset([-1, 45009])
+# 非幂等的接口: 返回系统繁忙时请求可能已经执行, 重试会重复发送消息
+NO_RETRY_PATHS = frozenset(['/message/send'])
+
+
+class RetryPolicy(object):
+    """
+    按 errcode 重试
+    - TOKEN_EXPIRED_CODES: 作废当前 token 后重试一次, 由调用方处理
+    - BUSY_CODES: 指数退避 (full jitter) 后重试, 最多 max_retries 次, 累计等待不超过 max_delay,
+      no_retry_paths 中的非幂等接口不重试
+    所有调用共享一个重试预算: 每次调用存入 budget_ratio, 每次退避重试取出 1,
+    预算耗尽时不再重试, 避免微信侧故障期间的重试风暴
+    """
+
+    def __init__(self, max_retries=3, backoff=0.2, max_backoff=5.0, max_delay=10.0, budget=10, budget_ratio=0.1,
+                 token_codes=TOKEN_EXPIRED_CODES, busy_codes=BUSY_CODES, no_retry_paths=NO_RETRY_PATHS):
+        """
+        :param max_retries: 单次调用的最大退避重试次数
+        :param backoff: 第一次退避的上限 (秒), 之后每次翻倍
+        :param max_backoff: 单次退避的上限 (秒)
+        :param max_delay: 单次调用累计退避的上限 (秒)
+        :param budget: 重试预算的上限
+        :param budget_ratio: 每次调用存入预算的数量
+        :param no_retry_paths: 系统繁忙时不重试的接口路径, 如 '/message/send'
+        """
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_delay = max_delay
+        self.budget = budget
+        self.budget_ratio = budget_ratio
+        self.token_codes = token_codes
+        self.busy_codes = busy_codes
+        self.no_retry_paths = no_retry_paths
+        self._tokens = float(budget)
+        self._lock = threading.Lock()
+
+    def is_token_expired(self, errcode):
+        return errcode in self.token_codes
+
+    def record(self):
+        """记录一次调用, 补充重试预算"""
+        with self._lock:
+            self._tokens = min(self.budget, self._tokens + self.budget_ratio)
+
+    def delay(self, errcode, attempt, waited, path=None):
+        """
+        计算下一次重试前的等待时间
+        :param errcode: 本次调用返回的 errcode
+        :param attempt: 已经退避重试的次数
+        :param waited: 已经累计退避的时间 (秒)
+        :param path: 接口路径, 如 '/message/send'
+        :return: 等待秒数, 不应重试时返回 None
+        """
+        if errcode not in self.busy_codes or attempt >= self.max_retries or path in self.no_retry_paths:
+            return None
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * (2 ** attempt)))
+        if waited + delay > self.max_delay:
+            return None
+        with self._lock:
+            if self._tokens < 1:
+                return None
+            self._tokens -= 1
+        return delay
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+from collections import namedtuple
+
+from .messages import EventMessage, TextMessage
+
+Route = namedtuple('Route', 'handler defer')
+
+# 前缀树中保存路由的键, 不会与单个字符冲突
+_END = None
+
+
+class Router(object):
+    """
+    消息路由, 注册时建立索引, 分发耗时与路由个数无关
+    - (agentid, type, event, key) 的哈希索引, 事件按 Event 与 EventKey 分发
+    - 文本消息按内容前缀分发, 每个 agentid 一棵前缀树, 取最长的匹配
+
+    匹配顺序: 指定 agentid 的路由优先于所有应用通用的路由, 同一 agentid 内
+    文本前缀 > (type, event, key) > (type, event) > type
+
+    router = Router()
+    router.add(on_help, 'text', prefix=u'/help')
+    router.add(on_click, 'event', event='click', key='menu1')
+    router.add(on_subscribe, 'event', event='subscribe', agentid=2)
+    route = router.match(message)
+    """
+
+    def __init__(self):
+        self._index = {}
+        self._tries = {}
+
+    def add(self, handler, type, event=None, key=None, agentid=None, prefix=None, defer=False):
+        """
+        注册路由, 同一条件重复注册时覆盖之前的处理函数
+        :param handler: 处理函数
+        :param type: 消息类型, 如 'text', 'event'
+        :param event: 事件类型, 仅 type 为 'event' 时有效, 如 'click'
+        :param key: 事件的 EventKey, 需要同时指定 event
+        :param agentid: 仅处理该应用的消息, None 为所有应用
+        :param prefix: 文本消息内容的前缀, 仅 type 为 'text' 时有效
+        :param defer: 是否先返回 200 空响应, 再执行处理函数
+        """
+        route = Route(handler, defer)
+        agentid = int(agentid) if agentid is not None else None
+        if prefix is not None:
+            if type != 'text':
+                raise ValueError('prefix is only supported for text messages')
+            node = self._tries.setdefault(agentid, {})
+            for char in prefix:
+                node = node.setdefault(char, {})
+            node[_END] = route
+            return
+        if key is not None and event is None:
+            raise ValueError('key requires event')
+        event = event.lower() if event else None
+        self._index[(agentid, type, event, key)] = route
+
+    def _match_prefix(self, agentid, content):
+        node = self._tries.get(agentid)
+        if node is None or not content:
+            return None
+        found = node.get(_END)
+        for char in content:
+            node = node.get(char)
+            if node is None:
+                break
+            if _END in node:
+                found = node[_END]
+        return found
+
+    def match(self, message):
+        """
+        :param message: WechatMessage 对象
+        :return: Route, 没有匹配时返回 None
+        """
+        index = self._index
+        if isinstance(message, EventMessage):
+            keys = (('event', message.type, getattr(message, 'key', None)), ('event', message.type, None),
+                    ('event', None, None))
+        else:
+            keys = ((message.type, None, None),)
+        for agentid in (message.agentid, None):
+            if self._tries and isinstance(message, TextMessage):
+                route = self._match_prefix(agentid, message.content)
+                if route is not None:
+                    return route
+            for type, event, key in keys:
+                route = index.get((agentid, type, event, key))
+                if route is not None:
+                    return route
+        return None
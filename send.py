@@ -1,5 +1,9 @@
 # -*- coding: utf-8 -*-
 
+from .lib import jsonutil
+
+# 接收者字段, 由 PreparedMessage 在发送时拼接
+RECIPIENT_KEYS = ('touser', 'toparty', 'totag')
 
 class WechatSend(object):
     message_type = ""
@@ -140,4 +144,33 @@ class ArticleSend(WechatSend):
         return self.data
 
 
+class PreparedMessage(object):
+    """
+    只序列化一次的消息, 同一内容分组发送给大量接收者时使用
+    除接收者之外的部分在创建时序列化为 JSON, body() 只序列化并拼接 touser / toparty / totag
+    """
 
+    def __init__(self, message):
+        """
+        :param message: 已调用 apply() 的 WechatSend 对象, 或 apply() 返回的 dict, 其中的接收者被忽略
+        """
+        data = dict(getattr(message, 'data', message))
+        for key in RECIPIENT_KEYS:
+            data.pop(key, None)
+        self.agentid = data.get('agentid')
+        # 去掉末尾的 }, 接收者作为最后几个字段拼接
+        self._head = jsonutil.dumps(data)[:-1]
+
+    def body(self, to_all=False, to_user=(), to_party=(), to_tag=()):
+        """
+        :return: 带接收者的请求体 (UTF-8 编码的 JSON)
+        """
+        if to_all:
+            recipients = {'touser': '@all'}
+        else:
+            if len(to_user) > 1000:
+                raise AttributeError("Can't send to more than 1000 users.")
+            elif len(to_party) > 100:
+                raise AttributeError("Can't send to more than 100 parties.")
+            recipients = {'touser': '|'.join(to_user), 'toparty': '|'.join(to_party), 'totag': '|'.join(to_tag)}
+        return self._head + ',' + jsonutil.dumps(recipients)[1:]
@@ -8,15 +8,14 @@
 # ------------------------------------------------------------------------
 
 import base64
+import os
 import string
-import random
 import hashlib
 import time
 import struct
 from Crypto.Cipher import AES
 import xml.etree.cElementTree as ET  
 import sys                                                                                                                                                                             
-import socket
 reload(sys)
 import ierror 
 sys.setdefaultencoding('utf-8') 
@@ -47,11 +46,8 @@ class SHA1:
         try:
             sortlist = [token, timestamp, nonce, encrypt]
             sortlist.sort()
-            sha = hashlib.sha1()
-            sha.update("".join(sortlist))
-            return  ierror.WXBizMsgCrypt_OK, sha.hexdigest()
-        except Exception,e:
-            print e
+            return  ierror.WXBizMsgCrypt_OK, hashlib.sha1("".join(sortlist)).hexdigest()
+        except Exception:
             return  ierror.WXBizMsgCrypt_ComputeSignature_Error, None
   
 
@@ -71,13 +67,20 @@ class XMLParse:
         @param xmltext: 待提取的xml字符串
         @return: 提取出的加密消息字符串
         """
+        # 回调数据包的节点固定且没有转义, 直接查找 Encrypt, 格式不符时再解析整个 XML
+        start = xmltext.find("<Encrypt><![CDATA[")
+        end = xmltext.find("]]></Encrypt>", start)
+        if start >= 0 and end >= 0:
+            user_start = xmltext.find("<ToUserName><![CDATA[")
+            user_end = xmltext.find("]]></ToUserName>", user_start)
+            if user_start >= 0 and user_end >= 0:
+                return ierror.WXBizMsgCrypt_OK, xmltext[start + 18:end], xmltext[user_start + 21:user_end]
         try:
             xml_tree = ET.fromstring(xmltext)
             encrypt  = xml_tree.find("Encrypt")
             touser_name    = xml_tree.find("ToUserName")
             return  ierror.WXBizMsgCrypt_OK, encrypt.text, touser_name.text
-        except Exception,e:
-            print e
+        except Exception:
             return  ierror.WXBizMsgCrypt_ParseXml_Error,None,None
     
     def generate(self, encrypt, signature, timestamp, nonce):
@@ -127,35 +130,46 @@ class PKCS7Encoder():
         return decrypted[:-pad]
     
     
+# get_random_str 用: 将随机字节映射为字母与数字
+# 只使用小于 248 (62 的 4 倍) 的字节, 每个字符对应 4 个字节值, 保证均匀分布
+_RANDOM_ALPHABET = string.ascii_letters + string.digits
+_RANDOM_TABLE = "".join(_RANDOM_ALPHABET[i % len(_RANDOM_ALPHABET)] for i in range(256))
+_RANDOM_REJECT = "".join(chr(i) for i in range(256 - 256 % len(_RANDOM_ALPHABET), 256))
+_LENGTH = struct.Struct("!I")
+
+
 class Prpcrypt(object):
-    """提供接收和推送给公众平台消息的加解密接口"""
+    """提供接收和推送给公众平台消息的加解密接口
+    key 与 iv 在构造时准备好, 同一个对象可以重复用于所有消息
+    """
     
     def __init__(self,key):
 
         #self.key = base64.b64decode(key+"=")
         self.key = key
+        self.iv = key[:16]
         # 设置加解密模式为AES的CBC模式   
         self.mode = AES.MODE_CBC
+        self.block_size = PKCS7Encoder.block_size
     
             
-    def encrypt(self,text,corpid):
+    def encrypt(self,text,corpid,random_str=None):
         """对明文进行加密
         @param text: 需要加密的明文
+        @param random_str: 16位随机字符串, 默认随机生成
         @return: 加密得到的字符串
         """      
-        # 16位随机字符串添加到明文开头
-        text = self.get_random_str() + struct.pack("I",socket.htonl(len(text))) + text + corpid
-        # 使用自定义的填充方式对明文进行补位填充
-        pkcs7 = PKCS7Encoder()
-        text = pkcs7.encode(text)
-        # 加密    
-        cryptor = AES.new(self.key,self.mode,self.key[:16])
+        # 16位随机字符串 + 网络字节序的明文长度 + 明文 + corpid, 再按 PKCS7 补位
+        length = 20 + len(text) + len(corpid)
+        amount_to_pad = self.block_size - (length % self.block_size)
+        text = "".join((random_str or self.get_random_str(), _LENGTH.pack(len(text)), text, corpid,
+                        chr(amount_to_pad) * amount_to_pad))
         try:
-            ciphertext = cryptor.encrypt(text)
+            # AES 的 CBC 模式对象带有状态, 每条消息需要新建
+            ciphertext = AES.new(self.key, self.mode, self.iv).encrypt(text)
             # 使用BASE64对加密后的字符串进行编码
             return ierror.WXBizMsgCrypt_OK, base64.b64encode(ciphertext)
-        except Exception,e:
-            print e 
+        except Exception:
             return  ierror.WXBizMsgCrypt_EncryptAES_Error,None
     
     def decrypt(self,text,corpid):
@@ -164,36 +178,31 @@ class Prpcrypt(object):
         @return: 删除填充补位后的明文
         """
         try:
-            cryptor = AES.new(self.key,self.mode,self.key[:16])
             # 使用BASE64对密文进行解码，然后AES-CBC解密
-            plain_text  = cryptor.decrypt(base64.b64decode(text))
-        except Exception,e:
-            print e 
+            plain_text = AES.new(self.key, self.mode, self.iv).decrypt(base64.b64decode(text))
+        except Exception:
             return  ierror.WXBizMsgCrypt_DecryptAES_Error,None
         try:
-            pad = ord(plain_text[-1]) 
-            # 去掉补位字符串 
-            #pkcs7 = PKCS7Encoder()
-            #plain_text = pkcs7.encode(plain_text)   
-            # 去除16位随机字符串
-            content = plain_text[16:-pad]
-            xml_len = socket.ntohl(struct.unpack("I",content[ : 4])[0])
-            xml_content = content[4 : xml_len+4] 
-            from_corpid = content[xml_len+4:]
-        except Exception,e:
-            print e
+            # 去掉补位字符串与16位随机字符串, 直接按偏移读取, 不做中间切片
+            end = len(plain_text) - ord(plain_text[-1])
+            xml_len = _LENGTH.unpack_from(plain_text, 16)[0]
+            corpid_start = 20 + xml_len
+            if end < corpid_start:
+                return  ierror.WXBizMsgCrypt_IllegalBuffer,None
+        except Exception:
             return  ierror.WXBizMsgCrypt_IllegalBuffer,None
-        if  from_corpid != corpid:
+        if end - corpid_start != len(corpid) or not plain_text.startswith(corpid, corpid_start):
             return ierror.WXBizMsgCrypt_ValidateCorpid_Error,None
-        return 0,xml_content
+        return 0,plain_text[20:corpid_start]
     
     def get_random_str(self):
         """ 随机生成16位字符串
         @return: 16位字符串
         """ 
-        rule = string.letters + string.digits
-        str = random.sample(rule, 16)
-        return "".join(str)
+        result = ""
+        while len(result) < 16:
+            result += os.urandom(24).translate(_RANDOM_TABLE, _RANDOM_REJECT)
+        return result[:16]
         
 class WXBizMsgCrypt(object):
     #构造函数
@@ -209,6 +218,10 @@ class WXBizMsgCrypt(object):
            #return ierror.WXBizMsgCrypt_IllegalAesKey)
         self.m_sToken = sToken
         self.m_sCorpid = sCorpId
+        # 加解密对象无状态, 构造一次后重复使用
+        self.sha1 = SHA1()
+        self.xmlParse = XMLParse()
+        self.pc = Prpcrypt(self.key)
 
 		 #验证URL
          #@param sMsgSignature: 签名串，对应URL参数的msg_signature
@@ -218,14 +231,12 @@ class WXBizMsgCrypt(object):
          #@param sReplyEchoStr: 解密之后的echostr，当return返回0时有效
          #@return：成功0，失败返回对应的错误码	
     def VerifyURL(self, sMsgSignature, sTimeStamp, sNonce, sEchoStr):
-        sha1 = SHA1()
-        ret,signature = sha1.getSHA1(self.m_sToken, sTimeStamp, sNonce, sEchoStr)
+        ret,signature = self.sha1.getSHA1(self.m_sToken, sTimeStamp, sNonce, sEchoStr)
         if ret  != 0:
             return ret, None 
         if not signature == sMsgSignature:
             return ierror.WXBizMsgCrypt_ValidateSignature_Error, None
-        pc = Prpcrypt(self.key)
-        ret,sReplyEchoStr = pc.decrypt(sEchoStr,self.m_sCorpid)
+        ret,sReplyEchoStr = self.pc.decrypt(sEchoStr,self.m_sCorpid)
         return ret,sReplyEchoStr
 	
     def EncryptMsg(self, sReplyMsg, sNonce, timestamp = None):
@@ -235,19 +246,16 @@ class WXBizMsgCrypt(object):
         #@param sNonce: 随机串，可以自己生成，也可以用URL参数的nonce
         #sEncryptMsg: 加密后的可以直接回复用户的密文，包括msg_signature, timestamp, nonce, encrypt的xml格式的字符串,
         #return：成功0，sEncryptMsg,失败返回对应的错误码None     
-        pc = Prpcrypt(self.key) 
-        ret,encrypt = pc.encrypt(sReplyMsg, self.m_sCorpid)
+        ret,encrypt = self.pc.encrypt(sReplyMsg, self.m_sCorpid)
         if ret != 0:
             return ret,None
         if timestamp is None:
             timestamp = str(int(time.time()))
         # 生成安全签名 
-        sha1 = SHA1() 
-        ret,signature = sha1.getSHA1(self.m_sToken, timestamp, sNonce, encrypt)
+        ret,signature = self.sha1.getSHA1(self.m_sToken, timestamp, sNonce, encrypt)
         if ret != 0: 
             return ret,None 
-        xmlParse = XMLParse()  
-        return ret,xmlParse.generate(encrypt, signature, timestamp, sNonce)  
+        return ret,self.xmlParse.generate(encrypt, signature, timestamp, sNonce)  
 
     def DecryptMsg(self, sPostData, sMsgSignature, sTimeStamp, sNonce):
         # 检验消息的真实性，并且获取解密后的明文
@@ -258,18 +266,15 @@ class WXBizMsgCrypt(object):
         #  xml_content: 解密后的原文，当return返回0时有效
         # @return: 成功0，失败返回对应的错误码
          # 验证安全签名 
-        xmlParse = XMLParse()
-        ret,encrypt,touser_name = xmlParse.extract(sPostData)
+        ret,encrypt,touser_name = self.xmlParse.extract(sPostData)
         if ret != 0:
             return ret, None
-        sha1 = SHA1() 
-        ret,signature = sha1.getSHA1(self.m_sToken, sTimeStamp, sNonce, encrypt)
+        ret,signature = self.sha1.getSHA1(self.m_sToken, sTimeStamp, sNonce, encrypt)
         if ret  != 0:
             return ret, None 
         if not signature == sMsgSignature:
             return ierror.WXBizMsgCrypt_ValidateSignature_Error, None
-        pc = Prpcrypt(self.key)
-        ret,xml_content = pc.decrypt(encrypt,self.m_sCorpid)
+        ret,xml_content = self.pc.decrypt(encrypt,self.m_sCorpid)
         return ret,xml_content 
 
 
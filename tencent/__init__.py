@@ -11,6 +11,7 @@ class OfficialWechat(object):
         self.corpid = corpid
         self.corpsecret = corpsecret
         self.encoding_aes_key = encoding_aes_key
+        self.access_token = access_token
         self.jsapi_ticket = jsapi_ticket
         self.wxcpt = WXBizMsgCrypt(token, encoding_aes_key, corpid)
 
@@ -23,7 +24,7 @@ class OfficialWechat(object):
         return result == WXBizMsgCrypt_OK, data
 
     def encrypt_message(self, data, nonce, timestamp):
-        result, data = self.wxcpt.DecryptMsg(data, nonce, timestamp)
+        result, data = self.wxcpt.EncryptMsg(data, nonce, timestamp)
         return result == WXBizMsgCrypt_OK, data
 
     @classmethod
@@ -3,7 +3,96 @@
 __author__ = 'justinfong'
 
 from wechat_enterprise_sdk.wechat import *
+from wechat_enterprise_sdk.async_client import AsyncWechatEnterprise
+from wechat_enterprise_sdk.transport import HttpTransport
+from wechat_enterprise_sdk.retry import RetryPolicy
+from wechat_enterprise_sdk.ratelimit import RateLimiter
+from wechat_enterprise_sdk.exceptions import RateLimitExceeded
+from wechat_enterprise_sdk.tencent.WXBizMsgCrypt import WXBizMsgCrypt, _RANDOM_TABLE, _RANDOM_REJECT
+from wechat_enterprise_sdk.lib.parser import parse_xml, peek_xml
+from wechat_enterprise_sdk.lib.jsonstream import iter_json_array, ArrayNotFound
+from wechat_enterprise_sdk.lib import jsonutil
+from wechat_enterprise_sdk.send import TextSend, PreparedMessage
+from wechat_enterprise_sdk.tokens import TokenManager, FileTokenStore, SQLiteTokenStore
+from wechat_enterprise_sdk.wsgi import CallbackApp
+from wechat_enterprise_sdk.router import Router
+from wechat_enterprise_sdk.cache import TTLCache, DirectoryCache
+from wechat_enterprise_sdk.dedupe import Deduplicator, SQLiteDedupeStore
+from wechat_enterprise_sdk.ingest import IngestPool
+from wechat_enterprise_sdk.directory import Directory
+from wechat_enterprise_sdk.batch import BatchJob
+from wechat_enterprise_sdk.jobs import JobTracker, JobResult
+from wechat_enterprise_sdk.media import MediaCache, MEDIA_LIFETIME
+from wechat_enterprise_sdk.lib.multipart import MultipartFile
+import urlparse
+from multiprocessing.dummy import DummyProcess
+from wechat_enterprise_sdk import messages
+from wechat_enterprise_sdk.messages import TextMessage, EventMessage, LocationMessage
+import json
+import logging
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
 import unittest
+import urllib
+from StringIO import StringIO
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    本地接口桩, 记录收到的请求路径
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def _reply(self, data):
+        body = json.dumps(data)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.server.paths.append(self.path)
+        if self.path.startswith('/cgi-bin/gettoken'):
+            self._reply({'access_token': 'stub-token', 'expires_in': 7200})
+        else:
+            self._reply({'errcode': 0, 'errmsg': 'ok'})
+
+    def do_POST(self):
+        self.server.paths.append(self.path)
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self._reply({'errcode': 0, 'errmsg': 'ok'})
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, handler=StubHandler):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), handler)
+        self.paths = []
+        self.api_url = 'http://127.0.0.1:%d/cgi-bin' % self.server_address[1]
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def handle_error(self, request, client_address):
+        # 客户端的 keep-alive 连接在测试结束时被直接断开
+        pass
+
+
+ENCODING_AES_KEY = 'abcdefghijklmnopqrstuvwxyz0123456789ABCDEFG'
 
 
 class TestCase(unittest.TestCase):
@@ -123,3 +212,1170 @@ class TestCase(unittest.TestCase):
         # 这里是返回菜单，没有对应的errorcode
         resp = self.wechat.delete_menu(0)
         self.assertEqual(resp['errcode'], 0)
+
+
+class TokenManagerTestCase(unittest.TestCase):
+    def test_single_flight(self):
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            time.sleep(0.1)
+            return {'access_token': 'token-%d' % len(calls), 'expires_in': 7200}
+
+        manager = TokenManager(fetch)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(manager.get())) for _ in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['token-1'] * 10)
+
+    def test_expires(self):
+        now = [0]
+        manager = TokenManager(lambda: {'access_token': 'token-%d' % now[0], 'expires_in': 7200},
+                               clock=lambda: now[0])
+        self.assertEqual(manager.get(), 'token-0')
+        now[0] = 7200
+        self.assertEqual(manager.get(), 'token-7200')
+        manager.invalidate('token-0')
+        self.assertEqual(manager.value, 'token-7200')
+        manager.invalidate('token-7200')
+        self.assertEqual(manager.value, None)
+
+
+class TokenStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _check_shared(self, store):
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            time.sleep(0.1)
+            return {'access_token': 'shared', 'expires_in': 7200}
+
+        # 每个 manager 相当于一个 worker 进程, 只共享 store
+        managers = [TokenManager(fetch, store=store, store_key='access_token:corp') for _ in range(5)]
+        results = []
+        threads = [threading.Thread(target=lambda m=m: results.append(m.get())) for m in managers]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['shared'] * 5)
+
+        managers[0].invalidate('shared')
+        self.assertEqual(store.load('access_token:corp'), (None, 0))
+
+    def test_file_store(self):
+        self._check_shared(FileTokenStore(self.directory))
+
+    def test_sqlite_store(self):
+        self._check_shared(SQLiteTokenStore(os.path.join(self.directory, 'tokens.db')))
+
+
+class TransportTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = StubServer()
+        self.transport = HttpTransport(pool_maxsize=10)
+
+    def tearDown(self):
+        self.transport.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_shared_connection(self):
+        clients = [WechatEnterprise(token='token', corpid='corp%d' % i, corpsecret='secret',
+                                    encoding_aes_key=ENCODING_AES_KEY, transport=self.transport) for i in range(2)]
+        for wechat in clients:
+            wechat.api_url = self.server.api_url
+            for i in range(3):
+                self.assertEqual(wechat.get_user('user%d' % i)['errcode'], 0)
+        stats = self.transport.stats()
+        # 两个客户端各获取一次 token 并调用 3 次接口, 全部复用同一个连接
+        self.assertEqual((stats['requests'], stats['errors']), (8, 0))
+        self.assertEqual(len(stats['pools']), 1)
+        pool = stats['pools'][0]
+        self.assertEqual((pool['connections'], pool['requests'], pool['idle']), (1, 8, 1))
+
+
+class AsyncClientTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = StubServer()
+        self.wechat = AsyncWechatEnterprise(token='token', corpid='corpid', corpsecret='secret',
+                                            encoding_aes_key=ENCODING_AES_KEY, workers=8, max_pending=16)
+        self.wechat.api_url = self.server.api_url
+
+    def tearDown(self):
+        self.wechat.close()
+        self.wechat.transport.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_concurrent_calls(self):
+        results = [self.wechat.get_user_async('user%d' % i) for i in range(100)]
+        results.append(self.wechat.send_text_async('hello', agent_id=1, to_user=['a']))
+        for resp in self.wechat.gather(results, timeout=10):
+            self.assertEqual(resp['errcode'], 0)
+        gettoken = [path for path in self.server.paths if path.startswith('/cgi-bin/gettoken')]
+        self.assertEqual(len(gettoken), 1)
+        self.assertEqual(len(self.server.paths), 102)
+
+    def test_sync_methods(self):
+        # 原名方法保持同步, 调用同步方法的组件可以直接使用异步客户端
+        self.assertEqual(self.wechat.get_user('a')['errcode'], 0)
+        server = StubServer(DirectoryHandler)
+        try:
+            self.wechat.api_url = server.api_url
+            snapshot = Directory(self.wechat, workers=2).refresh()
+            self.assertEqual(snapshot.users_under(1), frozenset(['a', 'b', 'c']))
+            self.assertEqual(self.wechat.get_departments_async().get(5)['department'][0]['id'], 1)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_subclass_override(self):
+        class Client(AsyncWechatEnterprise):
+            def get_user(self, user_id):
+                return {'errcode': 0, 'userid': user_id, 'overridden': True}
+
+        client = Client(token='token', corpid='corpid', corpsecret='secret', encoding_aes_key=ENCODING_AES_KEY)
+        try:
+            self.assertTrue(client.get_user_async('a').get(5)['overridden'])
+        finally:
+            client.close()
+
+
+class FlakyHandler(StubHandler):
+    """
+    第一个 token 返回 42001, 之后的前两次调用返回系统繁忙
+    """
+
+    def do_GET(self):
+        self.server.paths.append(self.path)
+        if self.path.startswith('/cgi-bin/gettoken'):
+            self.server.tokens += 1
+            self._reply({'access_token': 'token%d' % self.server.tokens, 'expires_in': 7200})
+        elif 'access_token=token1' in self.path:
+            self._reply({'errcode': 42001, 'errmsg': 'access_token expired'})
+        elif self.server.busy > 0:
+            self.server.busy -= 1
+            self._reply({'errcode': -1, 'errmsg': 'system busy'})
+        else:
+            self._reply({'errcode': 0, 'errmsg': 'ok'})
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self.do_GET()
+
+
+class RetryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = StubServer(FlakyHandler)
+        self.server.tokens = 0
+        self.server.busy = 0
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _wechat(self, **kwargs):
+        wechat = WechatEnterprise(token='token', corpid='corpid', corpsecret='secret',
+                                  encoding_aes_key=ENCODING_AES_KEY, retry_policy=RetryPolicy(**kwargs))
+        wechat.api_url = self.server.api_url
+        return wechat
+
+    def test_token_expired(self):
+        wechat = self._wechat()
+        self.assertEqual(wechat.get_user('a')['errcode'], 0)
+        self.assertEqual(wechat.access_token, 'token2')
+
+    def test_busy(self):
+        self.server.busy = 2
+        self.assertEqual(self._wechat(backoff=0.01).get_user('a')['errcode'], 0)
+
+        self.server.busy = 2
+        self.assertEqual(self._wechat(backoff=0.01, max_retries=1).get_user('a')['errcode'], -1)
+
+        # 发送消息返回系统繁忙时不重试, 避免重复送达
+        wechat = self._wechat(backoff=0.01)
+        wechat.get_user('a')
+        self.server.busy = 1
+        self.assertEqual(wechat.send_text(u'你好', agent_id=1, to_user=['a'])['errcode'], -1)
+        self.assertEqual(len([p for p in self.server.paths if p.startswith('/cgi-bin/message/send')]), 1)
+
+    def test_stream(self):
+        # 流式接口与 _request 使用同一个重试循环
+        self.server.busy = 1
+        wechat = self._wechat(backoff=0.01)
+        self.assertEqual(list(wechat.iter_departments()), [])
+        self.assertEqual(wechat.access_token, 'token2')
+        self.server.busy = 2
+        try:
+            list(self._wechat(backoff=0.01, max_retries=1).iter_departments())
+            self.fail()
+        except APIError as e:
+            self.assertEqual(e.errcode, -1)
+
+    def test_budget(self):
+        policy = RetryPolicy(budget=2, budget_ratio=0)
+        self.assertTrue(policy.delay(-1, 0, 0) is not None)
+        self.assertTrue(policy.delay(-1, 0, 0) is not None)
+        self.assertTrue(policy.delay(-1, 0, 0) is None)
+        self.assertTrue(policy.delay(40001, 0, 0) is None)
+        # 发送消息返回系统繁忙时可能已经送达, 不重试
+        self.assertTrue(RetryPolicy().delay(-1, 0, 0, '/message/send') is None)
+        self.assertTrue(RetryPolicy(no_retry_paths=()).delay(-1, 0, 0, '/message/send') is not None)
+
+
+class FanoutHandler(StubHandler):
+    def do_POST(self):
+        self.server.paths.append(self.path)
+        data = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)))
+        self.server.bodies.append(data)
+        self._reply({'errcode': 0, 'errmsg': 'ok', 'invaliduser': data['touser'].split('|')[0]})
+
+
+class FanoutTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = StubServer(FanoutHandler)
+        self.server.bodies = []
+        self.wechat = WechatEnterprise(token='token', corpid='corpid', corpsecret='secret',
+                                       encoding_aes_key=ENCODING_AES_KEY)
+        self.wechat.api_url = self.server.api_url
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_json_body(self):
+        content = u'路径 C:\\new\\table "引号" \\u4e2d </a>'
+        self.wechat.send_text(content, agent_id=1, to_user=['a'])
+        self.assertEqual(self.server.bodies[-1]['text']['content'], content)
+        self.wechat.send_text(content.encode('utf-8'), agent_id=1, to_user=['a'])
+        self.assertEqual(self.server.bodies[-1]['text']['content'], content)
+
+        data = {'name': '\xe5\xbc\xa0\xe4\xb8\x89', 'title': u'工程师\n"A"', 'department': [1, 2]}
+        encoded = jsonutil.dumps(data)
+        self.assertTrue(isinstance(encoded, str))
+        self.assertTrue(u'"工程师\\n\\"A\\""'.encode('utf-8') in encoded)
+        self.assertEqual(jsonutil.loads(encoded), json.loads(json.dumps(data)))
+        for value in (u'\x01中文', u'\U0001f600 \\u4e2d'):
+            self.assertEqual(json.loads(jsonutil.dumps(value)), value)
+
+    def test_send_text(self):
+        users = ['user%d' % i for i in range(2500)]
+        parties = [str(i) for i in range(150)]
+        sender = self.wechat.fanout(workers=4)
+        result = sender.send_text(u'通知', agent_id=1, to_user=users, to_party=parties, to_tag=['1'])
+
+        self.assertTrue(result.ok)
+        self.assertEqual(len(self.server.bodies), 3)
+        self.assertEqual(sorted(result.invaliduser), ['user0', 'user1000', 'user2000'])
+        sent = sorted(u for body in self.server.bodies for u in body['touser'].split('|'))
+        self.assertEqual(sent, sorted(users))
+        self.assertEqual([body['totag'] for body in self.server.bodies].count('1'), 1)
+
+    def test_no_thread_leak(self):
+        users = ['user%d' % i for i in range(2500)]
+        for _ in range(5):
+            self.assertTrue(self.wechat.fanout(workers=4).send_text(u'通知', agent_id=1, to_user=users).ok)
+        # 桩服务为每个 keep-alive 连接保留一个线程, 只统计线程池的工作线程
+        self.assertEqual([t for t in threading.enumerate() if isinstance(t, DummyProcess)], [])
+        self.assertTrue(self.wechat.fanout().send_text(u'通知', agent_id=1, to_all=True).ok)
+        self.assertEqual(self.server.bodies[-1]['touser'], '@all')
+        self.assertFalse('toparty' in self.server.bodies[-1])
+
+    def test_send_news(self):
+        users = ['user%d' % i for i in range(2500)]
+        articles = [{'title': '\xe6\xa0\x87\xe9\xa2\x98', 'description': u'说明 "a"', 'url': 'http://example.com/'}]
+        sender = self.wechat.fanout(workers=4)
+        result = sender.send_news(articles, agent_id=3, to_user=users, safe=True)
+        self.assertTrue(result.ok)
+        self.assertEqual(len(self.server.bodies), 3)
+        for body in self.server.bodies:
+            self.assertEqual(body['news']['articles'], [{'title': u'标题', 'description': u'说明 "a"',
+                                                         'picurl': '', 'url': 'http://example.com/'}])
+            self.assertEqual((body['msgtype'], body['agentid'], body['safe'], body['totag']), ('news', 3, '1', ''))
+        self.assertTrue(articles[0]['title'] == '\xe6\xa0\x87\xe9\xa2\x98')
+
+        # 同一内容再次发送
+        prepared = PreparedMessage(TextSend(1).apply(content=u'通知'))
+        sender.send_prepared(prepared, to_user=['a"b'], to_party=['2'])
+        self.assertEqual(self.server.bodies[-1], {'msgtype': 'text', 'agentid': 1, 'safe': '0',
+                                                  'text': {'content': u'通知'},
+                                                  'touser': 'a"b', 'toparty': '2', 'totag': ''})
+        self.assertEqual(json.loads(prepared.body(to_all=True))['touser'], '@all')
+        self.assertRaises(AttributeError, prepared.body, to_user=users)
+
+
+class RateLimiterTestCase(unittest.TestCase):
+    def test_buckets(self):
+        now = [0.0]
+        limiter = RateLimiter(blocking=False, clock=lambda: now[0])
+        limiter.add_rule(2, scope=('corpid', 'agentid'))
+        limiter.add_rule(1, scope=('corpid', 'path'), path='/message/send')
+
+        limiter.acquire('corp', 1, '/message/send')
+        self.assertRaises(RateLimitExceeded, limiter.acquire, 'corp', 1, '/message/send')
+        # 其他接口只受应用维度的限制
+        limiter.acquire('corp', 1, '/user/get')
+        self.assertRaises(RateLimitExceeded, limiter.acquire, 'corp', 1, '/user/get')
+        limiter.acquire('corp', 2, '/user/get')
+
+        self.assertAlmostEqual(limiter.wait_time('corp', 1, '/message/send'), 1.0)
+        now[0] = 1.0
+        self.assertEqual(limiter.wait_time('corp', 1, '/message/send'), 0)
+        limiter.acquire('corp', 1, '/message/send')
+
+    def test_blocking(self):
+        limiter = RateLimiter()
+        limiter.add_rule(20)
+        start = time.time()
+        for _ in range(25):
+            limiter.acquire('corp')
+        self.assertTrue(time.time() - start >= 0.2)
+        self.assertRaises(RateLimitExceeded, limiter.acquire, 'corp', timeout=0.01)
+
+
+class CryptTestCase(unittest.TestCase):
+    MESSAGE = '<xml><Content><![CDATA[\xe4\xbd\xa0\xe5\xa5\xbd]]></Content></xml>'
+    # 腾讯示例代码在随机字符串为 abcdefghijklmnop 时的加密结果
+    ENCRYPTED = ('8Q6sFaw1Cb9qj7RuhNb60lTzeDGei5Dq/ZQCDjoz/mRUERTAKlf205CjFx3nYGYae3ZzHwkntn1x'
+                 'FRoHjOyJK14aOiNKO/NL1WWBXYhIoLg8JOiO0JgKKozUwfZjKdYl')
+
+    def setUp(self):
+        self.crypt = WXBizMsgCrypt('token', ENCODING_AES_KEY, 'corpid')
+
+    def test_encrypt(self):
+        self.assertEqual(self.crypt.pc.encrypt(self.MESSAGE, 'corpid', 'abcdefghijklmnop'), (0, self.ENCRYPTED))
+        random_str = self.crypt.pc.get_random_str()
+        self.assertEqual(len(random_str), 16)
+        self.assertTrue(random_str.isalnum())
+        # 保留的字节值在字母与数字上均匀分布
+        kept = ''.join(chr(i) for i in range(256)).translate(_RANDOM_TABLE, _RANDOM_REJECT)
+        self.assertEqual(len(kept), 248)
+        self.assertEqual(set(kept.count(c) for c in kept), set([4]))
+
+    def test_decrypt(self):
+        self.assertEqual(self.crypt.pc.decrypt(self.ENCRYPTED, 'corpid'), (0, self.MESSAGE))
+        self.assertEqual(self.crypt.pc.decrypt(self.ENCRYPTED, 'other')[0], -40005)
+        ret, encrypted = self.crypt.pc.encrypt(self.MESSAGE, 'corpid')
+        self.assertEqual(self.crypt.pc.decrypt(encrypted, 'corpid'), (0, self.MESSAGE))
+
+
+class ParserTestCase(unittest.TestCase):
+    def test_parse_xml(self):
+        data = parse_xml("""<xml><ToUserName><![CDATA[corpid]]></ToUserName>
+        <FromUserName><![CDATA[zhangsan]]></FromUserName>
+        <CreateTime>1408090816</CreateTime>
+        <MsgType><![CDATA[event]]></MsgType>
+        <Event><![CDATA[pic_weixin]]></Event>
+        <EventKey><![CDATA[6]]></EventKey>
+        <SendPicsInfo><Count>1</Count>
+        <PicList><item><PicMd5Sum><![CDATA[5a75aaca956d97be686719218f275c6b]]></PicMd5Sum></item></PicList>
+        </SendPicsInfo>
+        <Label></Label>
+        <Content><![CDATA[ ]]></Content>
+        <AgentID>1</AgentID>
+        </xml>""")
+        self.assertEqual(data, {
+            'ToUserName': u'corpid',
+            'FromUserName': u'zhangsan',
+            'CreateTime': u'1408090816',
+            'MsgType': u'event',
+            'Event': u'pic_weixin',
+            'EventKey': u'6',
+            'SendPicsInfo': [{'Count': u'1', 'PicList': [{'item': [
+                {'PicMd5Sum': u'5a75aaca956d97be686719218f275c6b'}]}]}],
+            'Content': u' ',
+            'AgentID': u'1',
+        })
+        self.assertTrue(isinstance(data['AgentID'], unicode))
+
+
+def encrypt_callback(crypt, xml, timestamp='1409304348', nonce='nonce'):
+    """
+    模拟微信服务器加密回调消息, 返回 (POST 数据, msg_signature)
+    """
+    ret, encrypted = crypt.EncryptMsg(xml, nonce, timestamp)
+    encrypt = parse_xml(encrypted)['Encrypt']
+    signature = parse_xml(encrypted)['MsgSignature']
+    data = ('<xml><ToUserName><![CDATA[corpid]]></ToUserName><AgentID><![CDATA[1]]></AgentID>'
+            '<Encrypt><![CDATA[%s]]></Encrypt></xml>') % encrypt
+    return data, signature
+
+
+TEXT_MESSAGE = ('<xml><ToUserName><![CDATA[corpid]]></ToUserName>'
+                '<FromUserName><![CDATA[zhangsan]]></FromUserName>'
+                '<CreateTime>1348831860</CreateTime><MsgType><![CDATA[text]]></MsgType>'
+                '<Content><![CDATA[\xe4\xbd\xa0\xe5\xa5\xbd]]></Content><MsgId>1234567890123456</MsgId>'
+                '<AgentID>1</AgentID></xml>')
+
+
+class CallbackTestMixin(object):
+    """
+    用同一个 WechatEnterprise 模拟微信服务器的加密回调
+    """
+
+    def setUp(self):
+        self.wechat = WechatEnterprise(token='token', corpid='corpid', corpsecret='secret',
+                                       encoding_aes_key=ENCODING_AES_KEY)
+        data, signature = encrypt_callback(self.wechat.wxcpt, TEXT_MESSAGE)
+        self.wechat.parse_data(data, signature, '1409304348', 'nonce')
+
+    def _decrypt(self, response):
+        envelope = parse_xml(response)
+        data = ('<xml><ToUserName><![CDATA[corpid]]></ToUserName>'
+                '<Encrypt><![CDATA[%s]]></Encrypt></xml>') % envelope['Encrypt']
+        ok, xml = self.wechat.decrypt_message(data, envelope['MsgSignature'], envelope['TimeStamp'],
+                                              envelope['Nonce'])
+        self.assertTrue(ok)
+        return xml
+
+    def _call(self, method, query, body='', **environ):
+        status = []
+        environ.setdefault('CONTENT_LENGTH', str(len(body)))
+        environ.update({'REQUEST_METHOD': method, 'QUERY_STRING': urllib.urlencode(query),
+                        'wsgi.input': StringIO(body)})
+        result = self.app(environ, lambda s, headers: status.append(s))
+        try:
+            data = ''.join(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        return status[0], data
+
+    def _post(self, xml):
+        data, signature = encrypt_callback(self.wechat.wxcpt, xml)
+        return self._call('POST', {'msg_signature': signature, 'timestamp': '1409304348', 'nonce': 'nonce'}, data)
+
+
+class ReplyTestCase(CallbackTestMixin, unittest.TestCase):
+    def test_response_text(self):
+        xml = self._decrypt(self.wechat.response_text(u'a]]>b 你好'))
+        self.assertTrue(xml.startswith('<xml><ToUserName><![CDATA[zhangsan]]></ToUserName>'))
+        self.assertEqual(parse_xml(xml)['Content'], u'a]]>b 你好')
+
+    def test_response_news(self):
+        xml = self._decrypt(self.wechat.response_news([{'title': u'标题]]>', 'url': 'http://example.com/?a=1&b=2'}]))
+        data = parse_xml(xml)
+        self.assertEqual(data['ArticleCount'], u'1')
+        self.assertEqual(data['Articles'][0]['item'][0]['Title'], u'标题]]>')
+        self.assertEqual(data['Articles'][0]['item'][0]['Url'], u'http://example.com/?a=1&b=2')
+
+
+class CallbackRequestTestCase(CallbackTestMixin, unittest.TestCase):
+    def _request(self, user):
+        data, signature = encrypt_callback(self.wechat.wxcpt, TEXT_MESSAGE.replace('zhangsan', user))
+        return self.wechat.parse_request(data, signature, '1409304348', 'nonce')
+
+    def test_immutable(self):
+        request = self._request('lisi')
+        self.assertEqual(request.message.source, u'lisi')
+        self.assertRaises(AttributeError, setattr, request, 'nonce', 'other')
+        # parse_request 不影响 parse_data 保存的请求
+        self.assertEqual(self.wechat.message.source, u'zhangsan')
+
+    def test_need_parse(self):
+        wechat = WechatEnterprise(token='token', corpid='corpid', encoding_aes_key=ENCODING_AES_KEY)
+        self.assertRaises(NeedParseError, wechat.response_text, u'你好')
+
+    def test_peek(self):
+        data, signature = encrypt_callback(self.wechat.wxcpt, TEXT_MESSAGE.replace('zhangsan', 'li&amp;si'))
+        peek = self.wechat.peek_request(data, signature, '1409304348', 'nonce')
+        self.assertEqual((peek.msg_type, peek.event, peek.agentid, peek.source), ('text', None, 1, u'li&amp;si'))
+        self.assertEqual(peek.parse().message.content, u'你好')
+        # 数据包不是 CDATA 格式时按 XML 解析
+        data = data.replace('<ToUserName><![CDATA[corpid]]></ToUserName>', '<ToUserName>corpid</ToUserName>')
+        self.assertEqual(self.wechat.peek_request(data, signature, '1409304348', 'nonce').msg_type, 'text')
+        self.assertEqual(parse_xml('<xml><a>x &amp; y</a><b><![CDATA[&amp;]]></b></xml>'),
+                         peek_xml('<xml><a>x &amp; y</a><b><![CDATA[&amp;]]></b></xml>', ('a', 'b')))
+
+    def test_peek_tag_like_content(self):
+        # 消息内容中类似节点的文本不能被当作节点
+        content = '<![CDATA[<AgentID>999</AgentID><Event>subscribe</Event>]]>'
+        xml = TEXT_MESSAGE.replace('<![CDATA[\xe4\xbd\xa0\xe5\xa5\xbd]]>', content)
+        data, signature = encrypt_callback(self.wechat.wxcpt, xml)
+        peek = self.wechat.peek_request(data, signature, '1409304348', 'nonce')
+        self.assertEqual((peek.msg_type, peek.event, peek.agentid), ('text', None, 1))
+        self.assertEqual(peek.parse().message.agentid, 1)
+
+        xml = TEXT_MESSAGE.replace('<AgentID>1</AgentID>', '').replace(
+            '<![CDATA[\xe4\xbd\xa0\xe5\xa5\xbd]]>', '<![CDATA[a]]><AgentID>abc</AgentID>')
+        data, signature = encrypt_callback(self.wechat.wxcpt, xml)
+        self.assertRaises(ParseError, self.wechat.peek_request, data, signature, '1409304348', 'nonce')
+        self.assertEqual(peek_xml('<xml><a><![CDATA[</a>]]></a><b><![CDATA[<a>1</a>]]></b></xml>', ('a', 'b')),
+                         {'a': u'</a>', 'b': u'<a>1</a>'})
+
+    def test_concurrent(self):
+        errors = []
+
+        def handle(user):
+            try:
+                for _ in range(20):
+                    request = self._request(user)
+                    xml = self._decrypt(request.response_text(user))
+                    data = parse_xml(xml)
+                    if data['ToUserName'] != user or data['Content'] != user:
+                        errors.append(data)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=handle, args=('user%d' % i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+
+class CallbackAppTestCase(CallbackTestMixin, unittest.TestCase):
+    def setUp(self):
+        super(CallbackAppTestCase, self).setUp()
+        self.app = CallbackApp(self.wechat, max_body=4096)
+        self.deferred = []
+
+        @self.app.handler('text')
+        def on_text(request):
+            return request.response_text(request.message.content)
+
+        @self.app.handler('event', event='click', defer=True)
+        def on_click(request):
+            self.deferred.append(request.message.key)
+
+    def test_verify_url(self):
+        echostr = parse_xml(self.wechat.wxcpt.EncryptMsg('echo', 'nonce', '1409304348')[1])
+        status, data = self._call('GET', {'msg_signature': echostr['MsgSignature'], 'timestamp': '1409304348',
+                                          'nonce': 'nonce', 'echostr': echostr['Encrypt']})
+        self.assertEqual((status, data), ('200 OK', 'echo'))
+        status, data = self._call('GET', {'msg_signature': 'bad', 'timestamp': '1', 'nonce': 'n', 'echostr': 'x'})
+        self.assertEqual(status, '403 Forbidden')
+
+    def test_reply(self):
+        status, data = self._post(TEXT_MESSAGE)
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(parse_xml(self._decrypt(data))['Content'], u'你好')
+
+    def test_dedupe(self):
+        self.app.dedupe = Deduplicator()
+        status, data = self._post(TEXT_MESSAGE)
+        self.assertTrue(data)
+        self.assertEqual(self._post(TEXT_MESSAGE), ('200 OK', ''))
+
+    def test_deferred(self):
+        xml = TEXT_MESSAGE.replace('<MsgType><![CDATA[text]]></MsgType>',
+                                   '<MsgType><![CDATA[event]]></MsgType><Event><![CDATA[click]]></Event>'
+                                   '<EventKey><![CDATA[menu1]]></EventKey>')
+        self.assertEqual(self._post(xml), ('200 OK', ''))
+        self.assertEqual(self.deferred, [u'menu1'])
+
+    def test_deferred_error(self):
+        self.app.dedupe = Deduplicator()
+        calls = []
+
+        @self.app.handler('event', event='click', defer=True)
+        def on_click(request):
+            calls.append(request.message.key)
+            if len(calls) == 1:
+                raise RuntimeError('failed')
+
+        xml = TEXT_MESSAGE.replace('<MsgType><![CDATA[text]]></MsgType>',
+                                   '<MsgType><![CDATA[event]]></MsgType><Event><![CDATA[click]]></Event>'
+                                   '<EventKey><![CDATA[menu1]]></EventKey>')
+        logging.disable(logging.ERROR)
+        try:
+            self.assertEqual(self._post(xml), ('200 OK', ''))
+        finally:
+            logging.disable(logging.NOTSET)
+        # 处理失败的消息不保留去重记录, 再次收到时重新处理, 处理成功后被去重
+        self.assertEqual(self._post(xml), ('200 OK', ''))
+        self.assertEqual(self._post(xml), ('200 OK', ''))
+        self.assertEqual(calls, [u'menu1', u'menu1'])
+
+    def test_body_limit(self):
+        status, _ = self._call('POST', {}, 'x' * 5000)
+        self.assertEqual(status, '413 Request Entity Too Large')
+        status, _ = self._call('POST', {'msg_signature': 'bad'}, '<xml></xml>')
+        self.assertEqual(status, '400 Bad Request')
+
+    def test_no_content_length(self):
+        data, signature = encrypt_callback(self.wechat.wxcpt, TEXT_MESSAGE)
+        query = {'msg_signature': signature, 'timestamp': '1409304348', 'nonce': 'nonce'}
+        # 服务器不保证请求体结束时返回 EOF, 不读取
+        self.assertEqual(self._call('POST', query, data, CONTENT_LENGTH='')[0], '411 Length Required')
+        status, reply = self._call('POST', query, data, CONTENT_LENGTH='', **{'wsgi.input_terminated': True})
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(parse_xml(self._decrypt(reply))['Content'], u'你好')
+        status, _ = self._call('POST', query, 'x' * 5000, CONTENT_LENGTH='', **{'wsgi.input_terminated': True})
+        self.assertEqual(status, '413 Request Entity Too Large')
+
+
+class RouterTestCase(unittest.TestCase):
+    def _text(self, content, agentid='1'):
+        return TextMessage({'type': 'text', 'Content': content, 'AgentID': agentid})
+
+    def _event(self, event, key=None, agentid='1'):
+        return EventMessage({'type': 'event', 'Event': event, 'EventKey': key, 'AgentID': agentid})
+
+    def test_event(self):
+        router = Router()
+        router.add('any', 'event')
+        router.add('click', 'event', event='CLICK')
+        router.add('menu1', 'event', event='click', key='menu1')
+        router.add('agent2', 'event', event='click', agentid=2)
+        self.assertEqual(router.match(self._event('click', 'menu1')).handler, 'menu1')
+        self.assertEqual(router.match(self._event('click', 'menu2')).handler, 'click')
+        self.assertEqual(router.match(self._event('click', 'menu1', agentid='2')).handler, 'agent2')
+        self.assertEqual(router.match(self._event('subscribe')).handler, 'any')
+        self.assertEqual(router.match(self._text(u'hi')), None)
+
+    def test_prefix(self):
+        router = Router()
+        router.add('text', 'text')
+        router.add('help', 'text', prefix=u'/help')
+        router.add('help-user', 'text', prefix=u'/help user')
+        router.add('agent2', 'text', prefix=u'/', agentid=2)
+        for i in range(500):
+            router.add(i, 'text', prefix=u'/cmd%d ' % i)
+        self.assertEqual(router.match(self._text(u'/help me')).handler, 'help')
+        self.assertEqual(router.match(self._text(u'/help users')).handler, 'help-user')
+        self.assertEqual(router.match(self._text(u'/cmd42 x')).handler, 42)
+        self.assertEqual(router.match(self._text(u'/cmd42')).handler, 'text')
+        self.assertEqual(router.match(self._text(u'/help', agentid='2')).handler, 'agent2')
+        self.assertRaises(ValueError, router.add, 'bad', 'event', prefix=u'/')
+
+
+class MessageTestCase(unittest.TestCase):
+    def test_lazy_fields(self):
+        xml = ('<xml><ToUserName><![CDATA[corpid]]></ToUserName><FromUserName><![CDATA[zhangsan]]></FromUserName>'
+               '<CreateTime>1351776360</CreateTime><MsgType><![CDATA[location]]></MsgType>'
+               '<Location_X>23.134521</Location_X><Location_Y>113.358803</Location_Y><Scale>20</Scale>'
+               '<Label><![CDATA[\xe4\xbd\x8d\xe7\xbd\xae]]></Label><MsgId>1234567890123456</MsgId>'
+               '<AgentID>1</AgentID></xml>')
+        parsed = []
+
+        def counting_parse(raw):
+            parsed.append(raw)
+            return parse_xml(raw)
+
+        messages.parse_xml, original = counting_parse, messages.parse_xml
+        try:
+            message = messages.build_message(xml)
+            self.assertTrue(isinstance(message, LocationMessage))
+            self.assertFalse(hasattr(message, '__dict__'))
+            # 构造时只查找需要的节点, 不解析整个 XML
+            self.assertEqual((message.id, message.agentid, message.source), (1234567890123456, 1, u'zhangsan'))
+            self.assertEqual((parsed, message._fields), ([], None))
+            self.assertEqual(message.location, (23.134521, 113.358803))
+            self.assertEqual(message.label, u'位置')
+            self.assertEqual(parsed, [xml])
+        finally:
+            messages.parse_xml = original
+        self.assertEqual((message.scale, message.label), (20, u'位置'))
+        self.assertEqual(message.Label, u'位置')
+        self.assertRaises(AttributeError, getattr, message, 'missing')
+        # 内容拆分为多段 CDATA 时解析整个 XML
+        message = messages.build_message(TEXT_MESSAGE.replace('<![CDATA[\xe4\xbd\xa0\xe5\xa5\xbd]]>',
+                                                              '<![CDATA[a]]]]><![CDATA[>b]]>'))
+        self.assertEqual((message.content, message.agentid), (u'a]]>b', 1))
+
+    def test_without_raw(self):
+        message = EventMessage({'type': 'event', 'Event': 'LOCATION', 'Latitude': '23.1', 'Extra': 'x'})
+        self.assertEqual((message.type, message.key, message.latitude, message.longitude), ('location', None, 23.1, 0))
+        self.assertEqual(message.Extra, 'x')
+        self.assertRaises(ParseError, LocationMessage, {'type': 'location', 'Location_X': '1'})
+
+
+class DedupeTestCase(unittest.TestCase):
+    def test_ttl_cache(self):
+        now = [0]
+        cache = TTLCache(maxsize=2, ttl=10, clock=lambda: now[0])
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        # b 最久未使用, 被淘汰
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c')), (1, None, 3))
+        self.assertFalse(cache.add('a', 4))
+        now[0] = 11
+        self.assertEqual(cache.get('a'), None)
+        self.assertTrue(cache.add('a', 4))
+        self.assertEqual(len(cache), 2)
+
+    def _check(self, dedupe):
+        text = TextMessage({'type': 'text', 'ToUserName': 'corpid', 'MsgId': '1', 'Content': u'hi'})
+        click = EventMessage({'type': 'event', 'ToUserName': 'corpid', 'FromUserName': 'zhangsan',
+                              'CreateTime': '1348831860', 'Event': 'click', 'EventKey': 'menu1'})
+        self.assertFalse(dedupe.is_duplicate(text))
+        self.assertTrue(dedupe.is_duplicate(text))
+        self.assertFalse(dedupe.is_duplicate(click))
+        self.assertTrue(dedupe.is_duplicate(click))
+        dedupe.forget(click)
+        self.assertFalse(dedupe.is_duplicate(click))
+
+    def test_memory(self):
+        self._check(Deduplicator())
+
+    def test_sqlite(self):
+        directory = tempfile.mkdtemp()
+        try:
+            store = SQLiteDedupeStore(os.path.join(directory, 'dedupe.db'), maxsize=5, prune_interval=5)
+            self._check(Deduplicator(store))
+            for i in range(20):
+                store.add('key%d' % i, 60)
+            self.assertFalse(store.add('key19', 60))
+            self.assertTrue(store.add('key0', 60))
+        finally:
+            shutil.rmtree(directory)
+
+
+class IngestTestCase(CallbackTestMixin, unittest.TestCase):
+    def setUp(self):
+        super(IngestTestCase, self).setUp()
+        self.server = StubServer(FanoutHandler)
+        self.server.bodies = []
+        self.wechat.api_url = self.server.api_url
+        self.pool = IngestPool(self.wechat, workers=1, maxsize=1)
+        self.app = CallbackApp(self.wechat, ingest=self.pool, dedupe=Deduplicator())
+        self.release = threading.Event()
+        self.started = threading.Event()
+
+        @self.app.handler('text', defer=True)
+        def on_text(request):
+            self.started.set()
+            self.release.wait(5)
+            return u're: ' + request.message.content
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _message(self, msgid):
+        return TEXT_MESSAGE.replace('1234567890123456', str(msgid))
+
+    def test_ack_and_deliver(self):
+        self.assertEqual(self._post(self._message(1)), ('200 OK', ''))
+        self.started.wait(5)
+        self.assertEqual(self._post(self._message(2)), ('200 OK', ''))
+        # 工作线程与队列都已占满
+        self.assertEqual(self._post(self._message(3))[0], '503 Service Unavailable')
+        stats = self.pool.stats()
+        self.assertEqual((stats['busy'], stats['queued'], stats['rejected']), (1, 1, 1))
+        # 被拒绝的消息在微信重试时可以再次进入队列
+        self.assertEqual(self._post(self._message(3))[0], '503 Service Unavailable')
+
+        self.release.set()
+        self.pool.close()
+        stats = self.pool.stats()
+        self.assertEqual((stats['completed'], stats['delivered'], stats['failed']), (2, 2, 0))
+        self.assertEqual([(body['touser'], body['agentid'], body['text']['content']) for body in self.server.bodies],
+                         [('zhangsan', 1, u're: 你好')] * 2)
+
+    def test_failure_logged(self):
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logger = logging.getLogger('wechat_enterprise_sdk.ingest')
+        logger.addHandler(handler)
+        logger.propagate = False
+        try:
+            @self.app.handler('text', defer=True)
+            def on_text(request):
+                raise RuntimeError('failed')
+
+            self.assertEqual(self._post(self._message(1)), ('200 OK', ''))
+            self.pool.close()
+        finally:
+            logger.removeHandler(handler)
+            logger.propagate = True
+        self.assertEqual(self.pool.stats()['failed'], 1)
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0].exc_info[0], RuntimeError)
+
+
+class DirectoryCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = StubServer()
+        self.cache = DirectoryCache(ttl=60)
+        self.wechat = WechatEnterprise(token='token', corpid='corpid', corpsecret='secret',
+                                       encoding_aes_key=ENCODING_AES_KEY, directory_cache=self.cache)
+        self.wechat.api_url = self.server.api_url
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _calls(self, path):
+        return len([p for p in self.server.paths if p.startswith('/cgi-bin' + path)])
+
+    def test_read_through(self):
+        for _ in range(3):
+            self.wechat.get_user('zhangsan')
+            self.wechat.get_tag(1)
+        self.assertEqual((self._calls('/user/get'), self._calls('/tag/get')), (1, 1))
+        self.assertEqual(self.cache.stats()['hits'], 4)
+
+        # 更新成员后标签的成员列表也失效
+        self.wechat.update_user(userid='zhangsan', name=u'张三')
+        self.wechat.get_user('zhangsan')
+        self.wechat.get_tag(1)
+        self.assertEqual((self._calls('/user/get'), self._calls('/tag/get')), (2, 2))
+
+        self.wechat.add_tag_users(tagid=1, userlist=['zhangsan'])
+        self.wechat.get_tag(1)
+        self.assertEqual(self._calls('/tag/get'), 3)
+        # 删除成员后所有标签的成员列表失效
+        self.wechat.delete_user('lisi')
+        self.wechat.get_tag(1)
+        self.wechat.get_user('zhangsan')
+        self.assertEqual((self._calls('/user/get'), self._calls('/tag/get')), (2, 4))
+
+    def test_invalidate_during_fetch(self):
+        # 查询接口期间发生的失效, 查询结果不写入缓存
+        for key in (None, 1):
+            value, snapshot = self.cache.lookup('corpid', 'tag', 1)
+            self.assertEqual(value, None)
+            self.cache.invalidate('corpid', 'tag', key)
+            self.cache.set('corpid', 'tag', 1, {'errcode': 0}, snapshot)
+            self.assertEqual(self.cache.get('corpid', 'tag', 1), None)
+        # 失效之后开始的查询正常写入
+        value, snapshot = self.cache.lookup('corpid', 'tag', 1)
+        self.cache.set('corpid', 'tag', 1, {'errcode': 0}, snapshot)
+        self.assertEqual(self.cache.get('corpid', 'tag', 1), {'errcode': 0})
+
+        # 调用接口期间删除成员
+        fetch = self.wechat._get
+
+        def fetch_and_delete(path, **params):
+            result = fetch(path, **params)
+            if path == '/tag/get':
+                self.wechat.delete_user('lisi')
+            return result
+
+        self.wechat._get = fetch_and_delete
+        self.wechat.get_tag(2)
+        del self.wechat._get
+        self.wechat.get_tag(2)
+        self.assertEqual(self._calls('/tag/get'), 2)
+
+    def test_shared_backend(self):
+        # 两个进程各自的 DirectoryCache 共享同一个存储后端
+        other = WechatEnterprise(token='token', corpid='corpid', corpsecret='secret',
+                                 encoding_aes_key=ENCODING_AES_KEY, directory_cache=DirectoryCache(self.cache.cache))
+        other.api_url = self.server.api_url
+        self.wechat.get_tag(1)
+        other.get_tag(1)
+        self.assertEqual(self._calls('/tag/get'), 1)
+        other.delete_user('lisi')
+        self.wechat.get_tag(1)
+        self.assertEqual(self._calls('/tag/get'), 2)
+
+
+class DirectoryHandler(StubHandler):
+    # 1 -> 2 -> 3, 1 -> 4
+    DEPARTMENTS = [{'id': 1, 'parentid': 0}, {'id': 2, 'parentid': 1}, {'id': 3, 'parentid': 2},
+                   {'id': 4, 'parentid': 1}]
+    USERS = [{'userid': 'a', 'department': [1]}, {'userid': 'b', 'department': [3]},
+             {'userid': 'c', 'department': [3, 4]}]
+
+    def do_GET(self):
+        self.server.paths.append(self.path)
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        if url.path == '/cgi-bin/gettoken':
+            self._reply({'access_token': 'stub-token', 'expires_in': 7200})
+        elif url.path == '/cgi-bin/department/list':
+            self._reply({'errcode': 0, 'department': self.DEPARTMENTS})
+        elif url.path == '/cgi-bin/user/list':
+            dept_id = int(query['department_id'])
+            self._reply({'errcode': 0, 'userlist': [user for user in self.USERS if dept_id in user['department']]})
+
+
+class DirectoryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = StubServer(DirectoryHandler)
+        self.wechat = WechatEnterprise(token='token', corpid='corpid', corpsecret='secret',
+                                       encoding_aes_key=ENCODING_AES_KEY)
+        self.wechat.api_url = self.server.api_url
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_snapshot(self):
+        directory = Directory(self.wechat, workers=4)
+        snapshot = directory.refresh()
+        self.assertTrue(directory.snapshot is snapshot)
+        self.assertEqual(snapshot.subtree[2], frozenset([2, 3]))
+        self.assertEqual(snapshot.users_under(1), frozenset(['a', 'b', 'c']))
+        self.assertEqual(snapshot.users_under(2), frozenset(['b', 'c']))
+        self.assertEqual(snapshot.users_under(3, recursive=False), frozenset(['b', 'c']))
+        self.assertTrue(snapshot.is_member('c', 4))
+        self.assertFalse(snapshot.is_member('a', 2))
+        self.assertEqual(snapshot.ancestors(3), [2, 1])
+        self.assertEqual(snapshot.user_departments['c'], (3, 4))
+        # 查询条件作为 URL 参数发送
+        self.assertEqual(len([p for p in self.server.paths if 'department_id=' in p]), 4)
+
+    def test_iter_users(self):
+        users = list(self.wechat.iter_users(1))
+        self.assertEqual(sorted(user['userid'] for user in users), ['a', 'b', 'c'])
+        self.assertEqual([dept['id'] for dept in self.wechat.iter_departments()], [1, 2, 3, 4])
+        self.assertEqual([user['userid'] for user in self.wechat.iter_users(4, fetch_child=False)], ['c'])
+
+    def test_json_stream(self):
+        document = json.dumps({'errcode': 0, 'errmsg': 'ok', 'userlist': [
+            {'userid': u'张三', 'order': [1, 2]}, {'userid': 'b', 'n': 12345}, 678]})
+        for size in (1, 3, 7, len(document)):
+            chunks = [document[i:i + size] for i in range(0, len(document), size)]
+            self.assertEqual(list(iter_json_array(chunks, 'userlist')),
+                             [{'userid': u'张三', 'order': [1, 2]}, {'userid': 'b', 'n': 12345}, 678])
+        self.assertEqual(list(iter_json_array(['{"userlist" : [ ] }'], 'userlist')), [])
+        try:
+            list(iter_json_array(['{"errcode": 60011, ', '"errmsg": "no privilege"}'], 'userlist'))
+            self.fail()
+        except ArrayNotFound as e:
+            self.assertEqual(e.document['errcode'], 60011)
+        self.assertRaises(ValueError, list, iter_json_array(['{"userlist": [{"a": 1}, {"b"'], 'userlist'))
+
+    def test_department_id(self):
+        self.wechat.get_departments(2)
+        self.wechat.get_departments()
+        paths = [p for p in self.server.paths if p.startswith('/cgi-bin/department/list')]
+        self.assertTrue('id=2' in paths[0])
+        self.assertFalse('id=' in paths[1].replace('access_token', ''))
+
+
+class BatchHandler(StubHandler):
+    def do_POST(self):
+        self.server.paths.append(self.path)
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        path = urlparse.urlparse(self.path).path
+        if path == '/cgi-bin/media/upload':
+            self.server.uploads.append((self.headers.get('Content-Type'), body))
+            self._reply({'errcode': 0, 'type': 'file', 'media_id': 'media-%d' % len(self.server.uploads),
+                         'created_at': str(int(time.time()))})
+        else:
+            self.server.bodies.append(json.loads(body))
+            self._reply({'errcode': 0, 'errmsg': 'ok', 'jobid': 'job-1'})
+
+    def do_GET(self):
+        self.server.paths.append(self.path)
+        if self.path.startswith('/cgi-bin/gettoken'):
+            self._reply({'access_token': 'stub-token', 'expires_in': 7200})
+        else:
+            self._reply({'errcode': 0, 'errmsg': 'ok', 'status': 3, 'type': 'sync_user', 'total': 2,
+                         'percentage': 100, 'result': []})
+
+
+class BatchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = StubServer(BatchHandler)
+        self.server.uploads = []
+        self.server.bodies = []
+        self.wechat = WechatEnterprise(token='token', corpid='corpid', corpsecret='secret',
+                                       encoding_aes_key=ENCODING_AES_KEY)
+        self.wechat.api_url = self.server.api_url
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_multipart(self):
+        body = MultipartFile(StringIO('x' * 20000), filename=u'文件.csv', content_type='text/csv')
+        data = ''.join(iter(lambda: body.read(8192), ''))
+        self.assertEqual(len(data), len(body))
+        self.assertEqual(body.read(8192), '')
+        body.seek(0)
+        self.assertEqual(body.read(), data)
+        self.assertTrue(data.startswith('--%s\r\n' % body.boundary))
+        self.assertTrue(data.endswith('\r\n--%s--\r\n' % body.boundary))
+        self.assertTrue('filename="\xe6\x96\x87\xe4\xbb\xb6.csv"' in data)
+        self.assertTrue('\r\n\r\n' + 'x' * 20000 + '\r\n--' in data)
+
+    def test_sync_users(self):
+        users = ({'userid': 'user%d' % i, 'name': u'成员%d' % i, 'department': [1, 2], 'mobile': None}
+                 for i in xrange(5000))
+        callback = {'url': 'http://example.com/', 'token': 't', 'encodingaeskey': 'k'}
+        job = self.wechat.sync_users(users, callback=callback)
+        self.assertTrue(isinstance(job, BatchJob))
+        self.assertEqual((job.jobid, job.type, job.rows), ('job-1', 'sync_user', 5000))
+        self.assertEqual(self.server.bodies, [{'media_id': 'media-1', 'callback': callback}])
+
+        content_type, body = self.server.uploads[0]
+        self.assertTrue(content_type.startswith('multipart/form-data; boundary='))
+        lines = body.split('\r\n')
+        start = lines.index(u'姓名,帐号,微信号,手机号,邮箱,所在部门,职位'.encode('utf-8'))
+        self.assertEqual(lines[start + 1], u'成员0,user0,,,,1;2,'.encode('utf-8'))
+        self.assertEqual(lines[start + 5000], u'成员4999,user4999,,,,1;2,'.encode('utf-8'))
+        self.assertTrue('type=file' in [p for p in self.server.paths if 'media/upload' in p][0])
+
+        self.assertFalse(job.done)
+        job.poll()
+        self.assertTrue(job.done)
+
+    def test_async_client(self):
+        wechat = AsyncWechatEnterprise(token='token', corpid='corpid', corpsecret='secret',
+                                       encoding_aes_key=ENCODING_AES_KEY, workers=2)
+        wechat.api_url = self.server.api_url
+        try:
+            job = wechat.sync_users_async([{'userid': 'a', 'name': 'A'}]).get(5)
+            self.assertEqual((job.jobid, job.rows), ('job-1', 1))
+            self.assertEqual(wechat.replace_users([{'userid': 'b'}]).type, 'replace_user')
+            self.assertEqual(wechat.upload_media_async('file', data='abc').get(5)['media_id'], 'media-3')
+        finally:
+            wechat.close()
+
+    def test_upload_media(self):
+        self.wechat.media_cache = MediaCache()
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'logo.png')
+            with open(path, 'wb') as f:
+                f.write('\x89PNG' + 'x' * 100000)
+            result = self.wechat.upload_media('image', path=path)
+            self.assertEqual(result['media_id'], 'media-1')
+            content_type, body = self.server.uploads[0]
+            self.assertTrue('filename="logo.png"\r\nContent-Type: image/png\r\n\r\n\x89PNG' in body)
+            # 内容相同时不再上传
+            self.assertEqual(self.wechat.upload_media('image', data='\x89PNG' + 'x' * 100000)['media_id'], 'media-1')
+            with open(path, 'rb') as f:
+                self.assertEqual(self.wechat.upload_media('image', f)['media_id'], 'media-1')
+            self.assertEqual(self.wechat.upload_media('file', path=path)['media_id'], 'media-2')
+            self.assertEqual(len(self.server.uploads), 2)
+            self.assertEqual(self.wechat.media_cache.stats()['hits'], 2)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_media_cache_expiry(self):
+        cache = MediaCache(margin=3600)
+        now = int(time.time())
+        cache.set('corpid', 'image', 'digest', {'media_id': 'old', 'created_at': str(now - MEDIA_LIFETIME + 1800)})
+        self.assertEqual(cache.get('corpid', 'image', 'digest'), None)
+        cache.set('corpid', 'image', 'digest', {'media_id': 'new', 'created_at': str(now)})
+        self.assertEqual(cache.get('corpid', 'image', 'digest')['media_id'], 'new')
+        self.assertEqual(cache.get('other', 'image', 'digest'), None)
+
+    def test_replace_parties(self):
+        job = self.wechat.replace_parties([{'name': u'研发部', 'id': 2, 'parentid': 1, 'order': 1}])
+        self.assertEqual(job.type, 'replace_party')
+        self.assertTrue('/cgi-bin/batch/replaceparty' in [urlparse.urlparse(p).path for p in self.server.paths])
+        self.assertTrue(u'部门名称,部门ID,父部门ID,排序\r\n研发部,2,1,1\r\n'.encode('utf-8') in self.server.uploads[0][1])
+
+
+class JobHandler(StubHandler):
+    """
+    job-slow 第二次查询时完成, 其余任务一直在执行中
+    """
+
+    def do_GET(self):
+        self.server.paths.append(self.path)
+        url = urlparse.urlparse(self.path)
+        if url.path == '/cgi-bin/gettoken':
+            return self._reply({'access_token': 'stub-token', 'expires_in': 7200})
+        jobid = dict(urlparse.parse_qsl(url.query))['jobid']
+        polls = self.server.polls[jobid] = self.server.polls.get(jobid, 0) + 1
+        if jobid == 'job-missing':
+            self._reply({'errcode': 86004, 'errmsg': 'invalid jobid'})
+        elif jobid == 'job-slow' and polls < 2:
+            self._reply({'errcode': 0, 'status': 2, 'type': 'sync_user', 'percentage': 50})
+        elif jobid == 'job-slow' or self.server.done:
+            self._reply({'errcode': 0, 'status': 3, 'type': 'sync_user', 'percentage': 100,
+                         'result': [{'userid': 'a', 'errcode': 0}]})
+        else:
+            self._reply({'errcode': 0, 'status': 2, 'type': 'replace_party', 'percentage': 0})
+
+
+BATCH_JOB_EVENT = ('<xml><ToUserName><![CDATA[corpid]]></ToUserName><FromUserName><![CDATA[sys]]></FromUserName>'
+                   '<CreateTime>1425284517</CreateTime><MsgType><![CDATA[event]]></MsgType>'
+                   '<Event><![CDATA[batch_job_result]]></Event><BatchJob><JobId><![CDATA[%s]]></JobId>'
+                   '<JobType><![CDATA[replace_party]]></JobType><ErrCode>%d</ErrCode>'
+                   '<ErrMsg><![CDATA[ok]]></ErrMsg></BatchJob></xml>')
+
+
+class JobTrackerTestCase(CallbackTestMixin, unittest.TestCase):
+    def setUp(self):
+        super(JobTrackerTestCase, self).setUp()
+        self.server = StubServer(JobHandler)
+        self.server.polls = {}
+        self.server.done = False
+        self.wechat.api_url = self.server.api_url
+        self.tracker = JobTracker(self.wechat, min_interval=0.05, max_interval=30)
+        self.app = CallbackApp(self.wechat)
+        self.app.register('event', self.tracker.handle_callback, event='batch_job_result')
+
+    def tearDown(self):
+        self.tracker.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_poll(self):
+        self.wechat.directory_cache = DirectoryCache()
+        self.wechat.directory_cache.set('corpid', 'user', 'a', {'userid': 'a'})
+        done = []
+        slow = self.tracker.track(BatchJob(self.wechat, 'job-slow', 'sync_user'))
+        slow.add_done_callback(done.append)
+        missing = self.tracker.track('job-missing')
+        self.assertTrue(self.tracker.track('job-slow') is slow)
+        self.assertEqual(slow.get(5)['result'], [{'userid': 'a', 'errcode': 0}])
+        self.assertTrue(slow.successful())
+        self.assertEqual(done, [slow])
+        self.assertEqual(slow.percentage, 50)
+        self.assertEqual(self.server.polls['job-slow'], 2)
+        # 任务完成后通讯录缓存失效
+        self.assertEqual(self.wechat.directory_cache.get('corpid', 'user', 'a'), None)
+        try:
+            missing.get(5)
+            self.fail()
+        except APIError as e:
+            self.assertEqual(e.errcode, 86004)
+        self.assertEqual(self.tracker.stats()['pending'], 0)
+
+    def test_done_callback_error(self):
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logger = logging.getLogger('wechat_enterprise_sdk.jobs')
+        logger.addHandler(handler)
+        logger.propagate = False
+        done = []
+        result = JobResult('job-1')
+        result.add_done_callback(lambda r: 1 / 0)
+        result.add_done_callback(done.append)
+        try:
+            result._set({'status': 3})
+        finally:
+            logger.removeHandler(handler)
+            logger.propagate = True
+        # 回调的异常记录日志, 不影响其他回调
+        self.assertEqual(done, [result])
+        self.assertEqual([record.exc_info[0] for record in records], [ZeroDivisionError])
+
+    def test_callback(self):
+        self.tracker.expect_callbacks = True
+        result = self.tracker.track('job-cb')
+        failed = self.tracker.track('job-failed')
+        status, _ = self._post(BATCH_JOB_EVENT % ('job-failed', 60123))
+        self.assertEqual(status, '200 OK')
+        self.assertRaises(APIError, failed.get, 1)
+
+        self.server.done = True
+        self._post(BATCH_JOB_EVENT % ('job-cb', 0))
+        self.assertEqual(result.get(5)['status'], 3)
+        self.assertEqual(result.type, 'replace_party')
+        # 只在收到回调后查询一次结果
+        self.assertEqual(self.server.polls, {'job-cb': 1})
+        self.assertEqual(self.tracker.stats()['callbacks'], 2)
+
+        # 回调先于 track() 到达
+        self._post(BATCH_JOB_EVENT % ('job-early', 60123))
+        self.assertRaises(APIError, self.tracker.track('job-early').get, 1)
@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+
+import fcntl
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+
+class TokenStore(object):
+    """
+    token 存储后端, 在多个 TokenManager 之间共享 token
+    expires_at 为绝对时间 (time.time())
+    """
+
+    def load(self, key):
+        """
+        :return: (token, expires_at), 不存在时返回 (None, 0)
+        """
+        raise NotImplementedError()
+
+    def save(self, key, value, expires_at):
+        raise NotImplementedError()
+
+    def delete(self, key, value=None):
+        """
+        删除 token
+        :param value: 仅当存储的 token 等于 value 时才删除
+        """
+        raise NotImplementedError()
+
+    def lock(self, key):
+        """
+        返回刷新 token 用的互斥锁 (context manager), 持有锁的调用方负责请求接口并 save
+        """
+        raise NotImplementedError()
+
+
+class MemoryTokenStore(TokenStore):
+    """
+    进程内存储, 在同一进程的多个客户端之间共享 token
+    """
+
+    def __init__(self):
+        self._data = {}
+        self._locks = {}
+        self._guard = threading.Lock()
+
+    def load(self, key):
+        return self._data.get(key, (None, 0))
+
+    def save(self, key, value, expires_at):
+        self._data[key] = (value, expires_at)
+
+    def delete(self, key, value=None):
+        with self._guard:
+            if value is None or self._data.get(key, (None, 0))[0] == value:
+                self._data.pop(key, None)
+
+    def lock(self, key):
+        with self._guard:
+            if key not in self._locks:
+                self._locks[key] = threading.Lock()
+            return self._locks[key]
+
+
+class FileTokenStore(TokenStore):
+    """
+    文件存储, 同一主机的多个进程 (如 gunicorn 的 pre-fork worker) 共享 token
+    每个 key 对应目录下的一个 JSON 文件, 通过 flock 文件锁保证只有一个进程刷新
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, key, suffix):
+        return os.path.join(self.directory, re.sub(r'[^\w.-]', '_', key) + suffix)
+
+    def load(self, key):
+        try:
+            with open(self._path(key, '.json'), 'rb') as f:
+                data = json.load(f)
+            return data['value'], data['expires_at']
+        except (IOError, OSError, ValueError, KeyError):
+            return None, 0
+
+    def save(self, key, value, expires_at):
+        path = self._path(key, '.json')
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'wb') as f:
+            json.dump({'value': value, 'expires_at': expires_at}, f)
+        # rename 为原子操作, 读取方不会读到写了一半的文件
+        os.rename(tmp, path)
+
+    def delete(self, key, value=None):
+        with self.lock(key):
+            if value is None or self.load(key)[0] == value:
+                try:
+                    os.remove(self._path(key, '.json'))
+                except OSError:
+                    pass
+
+    @contextmanager
+    def lock(self, key):
+        with open(self._path(key, '.lock'), 'ab') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class SQLiteTokenStore(TokenStore):
+    """
+    SQLite 存储, 同一主机的多个进程共享 token
+    刷新锁为带租期的行锁, 持锁进程异常退出后锁会在 lease 秒后失效
+    """
+
+    def __init__(self, path, lease=30, poll_interval=0.05, timeout=10):
+        """
+        :param path: 数据库文件路径
+        :param lease: 刷新锁的租期 (秒)
+        :param poll_interval: 等待刷新锁时的轮询间隔 (秒)
+        :param timeout: SQLite 的 busy timeout (秒)
+        """
+        self.path = path
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('CREATE TABLE IF NOT EXISTS tokens '
+                             '(key TEXT PRIMARY KEY, value TEXT, expires_at REAL)')
+                conn.execute('CREATE TABLE IF NOT EXISTS token_locks '
+                             '(key TEXT PRIMARY KEY, owner TEXT, expires_at REAL)')
+        finally:
+            conn.close()
+
+    def _connect(self):
+        # 每次操作使用独立连接, fork 之后也不会共享连接
+        return sqlite3.connect(self.path, timeout=self.timeout)
+
+    def load(self, key):
+        conn = self._connect()
+        try:
+            row = conn.execute('SELECT value, expires_at FROM tokens WHERE key = ?', (key,)).fetchone()
+        finally:
+            conn.close()
+        return row if row else (None, 0)
+
+    def save(self, key, value, expires_at):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO tokens (key, value, expires_at) VALUES (?, ?, ?)',
+                             (key, value, expires_at))
+        finally:
+            conn.close()
+
+    def delete(self, key, value=None):
+        conn = self._connect()
+        try:
+            with conn:
+                if value is None:
+                    conn.execute('DELETE FROM tokens WHERE key = ?', (key,))
+                else:
+                    conn.execute('DELETE FROM tokens WHERE key = ? AND value = ?', (key, value))
+        finally:
+            conn.close()
+
+    @contextmanager
+    def lock(self, key):
+        owner = uuid.uuid4().hex
+        conn = self._connect()
+        try:
+            while True:
+                now = time.time()
+                with conn:
+                    conn.execute('DELETE FROM token_locks WHERE key = ? AND expires_at < ?', (key, now))
+                    cursor = conn.execute('INSERT OR IGNORE INTO token_locks (key, owner, expires_at) '
+                                          'VALUES (?, ?, ?)', (key, owner, now + self.lease))
+                if cursor.rowcount == 1:
+                    break
+                time.sleep(self.poll_interval)
+            try:
+                yield
+            finally:
+                with conn:
+                    conn.execute('DELETE FROM token_locks WHERE key = ? AND owner = ?', (key, owner))
+        finally:
+            conn.close()
+
+
+class TokenManager(object):
+    """
+    带有效期的 token 管理 (access_token / jsapi_ticket)
+    - 距过期不足 refresh_ahead 秒时由后台线程提前刷新, 调用方继续使用当前 token
+    - 尚未获取或已过期时, 只有一个调用方去刷新, 其余调用方等待该次刷新的结果
+    - 指定 store 时, 刷新前先读取 store, 并持有 store 的锁刷新, 多个进程只会请求一次接口
+    """
+
+    def __init__(self, fetch, key='access_token', refresh_ahead=300, default_expires_in=7200, clock=time.time,
+                 store=None, store_key=None):
+        """
+        :param fetch: 获取 token 的函数, 返回接口的 JSON 数据包, 如 grant_access_token
+        :param key: JSON 数据包中 token 的字段名
+        :param refresh_ahead: 提前刷新的秒数
+        :param default_expires_in: 数据包中没有 expires_in 时使用的有效期
+        :param clock: 时间函数, 返回秒, 使用 store 时必须为 time.time
+        :param store: TokenStore 对象, 可选
+        :param store_key: token 在 store 中的 key, 默认为 key
+        """
+        self._fetch = fetch
+        self.key = key
+        self.store = store
+        self.store_key = store_key or key
+        self.refresh_ahead = refresh_ahead
+        self.default_expires_in = default_expires_in
+        self._clock = clock
+        self._value = None
+        self._expires_at = 0
+        self._refreshing = False
+        self._cond = threading.Condition(threading.Lock())
+
+    @property
+    def value(self):
+        """当前缓存的 token, 可能已过期"""
+        return self._value
+
+    @property
+    def expires_at(self):
+        return self._expires_at
+
+    def set(self, value, expires_in=None):
+        """
+        手动设置 token
+        :param expires_in: 有效期 (秒), 默认为 default_expires_in
+        """
+        with self._cond:
+            self._store(value, expires_in)
+
+    def invalidate(self, value=None):
+        """
+        作废 token, 下次 get 时重新获取
+        :param value: 仅当当前 token 等于 value 时才作废, 避免作废别的线程刚刷新的 token
+        """
+        with self._cond:
+            if value is None or value == self._value:
+                self._value = None
+                self._expires_at = 0
+        if self.store is not None:
+            self.store.delete(self.store_key, value)
+
+    def get(self):
+        """
+        获取有效的 token, 获取失败时返回 None
+        """
+        with self._cond:
+            now = self._clock()
+            if self._value and now < self._expires_at - self.refresh_ahead:
+                return self._value
+            if self._value and now < self._expires_at:
+                if not self._refreshing:
+                    self._refreshing = True
+                    thread = threading.Thread(target=self._refresh_quietly)
+                    thread.daemon = True
+                    thread.start()
+                return self._value
+            if self._refreshing:
+                while self._refreshing:
+                    self._cond.wait()
+                return self._current()
+            self._refreshing = True
+        self._refresh()
+        with self._cond:
+            return self._current()
+
+    def _current(self):
+        if self._value and self._clock() < self._expires_at:
+            return self._value
+        return None
+
+    def _store(self, value, expires_in):
+        self._value = value
+        if value:
+            self._expires_at = self._clock() + int(expires_in or self.default_expires_in)
+        else:
+            self._expires_at = 0
+
+    def _obtain(self):
+        """
+        获取新的 token
+        :return: (token, expires_at), 获取失败时 token 为 None
+        """
+        if self.store is None:
+            return self._request()
+        value, expires_at = self.store.load(self.store_key)
+        if value and self._clock() < expires_at - self.refresh_ahead:
+            return value, expires_at
+        with self.store.lock(self.store_key):
+            # 等锁期间其他进程可能已经刷新
+            value, expires_at = self.store.load(self.store_key)
+            if value and self._clock() < expires_at - self.refresh_ahead:
+                return value, expires_at
+            value, expires_at = self._request()
+            if value:
+                self.store.save(self.store_key, value, expires_at)
+            return value, expires_at
+
+    def _request(self):
+        resp = self._fetch()
+        if resp and resp.get(self.key):
+            return resp[self.key], self._clock() + int(resp.get('expires_in') or self.default_expires_in)
+        return None, 0
+
+    def _refresh(self):
+        value, expires_at = None, 0
+        try:
+            value, expires_at = self._obtain()
+        finally:
+            with self._cond:
+                if value:
+                    self._value = value
+                    self._expires_at = expires_at
+                self._refreshing = False
+                self._cond.notify_all()
+
+    def _refresh_quietly(self):
+        try:
+            self._refresh()
+        except Exception:
+            # 后台提前刷新失败时保留当前 token, 过期后由调用方同步刷新
+            pass
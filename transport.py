@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class HttpTransport(object):
+    """
+    HTTP 传输层
+    所有接口调用都经过同一个 requests.Session, 复用 keep-alive 连接池,
+    避免每次调用都重新建立 TCP + TLS 连接
+    同一个 transport 可以被多个 WechatEnterprise 实例共享
+    """
+
+    def __init__(self, pool_connections=10, pool_maxsize=10, pool_block=False, max_retries=0, timeout=None):
+        """
+        :param pool_connections: 缓存的连接池个数 (按 host 区分)
+        :param pool_maxsize: 每个连接池保持的最大连接数
+        :param pool_block: 连接池用尽时是否阻塞等待空闲连接
+        :param max_retries: 连接失败时的重试次数
+        :param timeout: 默认超时时间 (秒)，None 为不超时
+        """
+        self.timeout = timeout
+        self.session = requests.Session()
+        self._adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+                                    max_retries=max_retries, pool_block=pool_block)
+        self.session.mount('https://', self._adapter)
+        self.session.mount('http://', self._adapter)
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._errors = 0
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        with self._lock:
+            self._requests += 1
+        try:
+            return self.session.request(method, url, **kwargs)
+        except requests.RequestException:
+            with self._lock:
+                self._errors += 1
+            raise
+
+    def get(self, url, params=None, **kwargs):
+        return self.request('GET', url, params=params, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        return self.request('POST', url, data=data, **kwargs)
+
+    def stats(self):
+        """
+        连接池统计
+        connections 为该连接池累计新建的连接数, 远小于 requests 说明连接被复用
+        """
+        pools = []
+        container = self._adapter.poolmanager.pools
+        for key in container.keys():
+            pool = container.get(key)
+            if pool is None:
+                continue
+            pools.append({
+                'scheme': pool.scheme,
+                'host': pool.host,
+                'port': pool.port,
+                'connections': pool.num_connections,
+                'requests': pool.num_requests,
+                # 连接池的队列预先填充了 None 占位, 只统计已建立的空闲连接
+                'idle': sum(1 for conn in list(pool.pool.queue) if conn is not None) if pool.pool is not None else 0,
+            })
+        with self._lock:
+            return {
+                'requests': self._requests,
+                'errors': self._errors,
+                'pools': pools,
+            }
+
+    def close(self):
+        self.session.close()
+
+
+_default_transport = None
+_default_lock = threading.Lock()
+
+
+def get_default_transport():
+    """
+    获取进程内共享的默认 transport
+    """
+    global _default_transport
+    if _default_transport is None:
+        with _default_lock:
+            if _default_transport is None:
+                _default_transport = HttpTransport()
+    return _default_transport
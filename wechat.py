@@ -1,15 +1,26 @@
 # -*- coding: utf-8 -*-
 
 import hashlib
-import requests
-import json
 import cgi
-from .lib.parser import XMLStore
+import itertools
+import time
+from .lib.parser import peek_xml
+from .lib.jsonstream import iter_json_array, ArrayNotFound
+from .lib import jsonutil
+from .lib.multipart import MultipartFile
+from .media import MediaSource
 from .tencent import OfficialWechat
-from .exceptions import ParseError, DecryptError, EncryptError, NeedParseError
-from .messages import UnknownMessage, MESSAGE_TYPES
-from .reply import TextReply, ImageReply, VoiceReply, VideoReply, MusicReply, Article, ArticleReply
+from .exceptions import ParseError, DecryptError, NeedParseError, APIError
+from .messages import build_message
 from .send import TextSend, ImageSend, VoiceSend, VideoSend, FileSend, Article as Article2, ArticleSend
+from .transport import get_default_transport
+from .tokens import TokenManager
+from .retry import RetryPolicy
+from .fanout import FanoutSender
+from .callback import CallbackRequest, CallbackPeek
+from . import batch
+
+API_URL = 'https://qyapi.weixin.qq.com/cgi-bin'
 
 
 class WechatEnterprise(OfficialWechat):
@@ -18,28 +29,46 @@ class WechatEnterprise(OfficialWechat):
     仅支持企业号， 公司剧情需要，抽出来作为基础类
     该工具参考wechat-python-sdk
     """
+    api_url = API_URL
 
     def __init__(self, *args, **kwargs):
+        """
+        :param transport: HttpTransport 对象, 可在多个实例间共享, 默认使用进程内共享的 transport
+        :param token_store: TokenStore 对象, 多个进程共享 access_token 与 jsapi_ticket, 默认仅保存在当前实例
+        :param retry_policy: RetryPolicy 对象, 按 errcode 重试
+        :param rate_limiter: RateLimiter 对象, 客户端限流, 默认不限流
+        :param directory_cache: DirectoryCache 对象, 缓存成员 / 部门 / 标签 / 应用的查询结果, 默认不缓存
+        :param media_cache: MediaCache 对象, 同一内容的临时素材在有效期内只上传一次, 默认不缓存
+        """
+        transport = kwargs.pop('transport', None)
+        token_store = kwargs.pop('token_store', None)
+        self.retry_policy = kwargs.pop('retry_policy', None) or RetryPolicy()
+        self.rate_limiter = kwargs.pop('rate_limiter', None)
+        self.directory_cache = kwargs.pop('directory_cache', None)
+        self.media_cache = kwargs.pop('media_cache', None)
+        self._token_manager = TokenManager(self.grant_access_token, store=token_store)
+        self._ticket_manager = TokenManager(self.grant_jsapi_ticket, key='ticket', store=token_store)
         super(WechatEnterprise, self).__init__(*args, **kwargs)
-        self.__is_parse = False
-        self.__content = None
+        # 同一 corpid 下不同应用的 secret 对应不同的 token
+        secret = hashlib.sha1((self.corpsecret or '').encode('utf-8')).hexdigest()[:8]
+        self._token_manager.store_key = 'access_token:{}:{}'.format(self.corpid, secret)
+        self._ticket_manager.store_key = 'jsapi_ticket:{}:{}'.format(self.corpid, secret)
+        self.transport = transport or get_default_transport()
+        self.__request = None
 
     def grant_access_token(self):
         """
         获取token , 暂时不做失败处理
         """
         self._check_corpid_corpsecret()
-        return requests.get(url="https://qyapi.weixin.qq.com/cgi-bin/gettoken",
-                            params={"corpid": self.corpid, 'corpsecret': self.corpsecret}).json()
+        return jsonutil.loads(self.transport.get(url=self.api_url + "/gettoken",
+                                                 params={"corpid": self.corpid, 'corpsecret': self.corpsecret}).content)
 
     def get_user_info(self, code):
         """
         根据code 获取用户资料
         """
-        access_token = self._check_access_token()
-        return requests.get(
-            url='https://qyapi.weixin.qq.com/cgi-bin/user/getuserinfo?access_token={}&code={}'.format(access_token,
-                                                                                                      code)).json()
+        return self._get('/user/getuserinfo', code=code)
 
 
     def grant_jsapi_ticket(self):
@@ -47,61 +76,79 @@ class WechatEnterprise(OfficialWechat):
         获取js ticket
         """
         self._check_corpid_corpsecret()
-        access_token = self._check_access_token()
-        return requests.get(url="https://qyapi.weixin.qq.com/cgi-bin/get_jsapi_ticket",
-                            params={'access_token': access_token}).json()
+        return self._get('/get_jsapi_ticket')
 
-    def parse_data(self, data=None, msg_signature=None, timestamp=None, nonce=None):
+    def _decrypt_request(self, data, msg_signature, timestamp, nonce):
+        if type(data) not in [str, unicode]:
+            raise ParseError()
+        data = data.encode('utf-8')
+        ok, data = self.decrypt_message(data, msg_signature, timestamp, nonce)
+        if not ok:
+            raise DecryptError()
+        return data
+
+    def _build_request(self, data, msg_signature, timestamp, nonce):
+        return CallbackRequest(self, build_message(data), msg_signature, timestamp, nonce)
+
+    def parse_request(self, data=None, msg_signature=None, timestamp=None, nonce=None):
         """
-        解析微信服务器发送过来的数据并保存类中
+        解析微信服务器发送过来的数据, 不修改当前对象, 可在多个线程中同时调用
         :param data: HTTP Request 的 Body 数据
         :param msg_signature: EncodingAESKey 的 msg_signature
         :param timestamp: EncodingAESKey 用时间戳
         :param nonce: EncodingAESKey 用随机数
+        :return: CallbackRequest 对象, 通过其 response_* 方法生成回复
         :raises ParseError: 解析微信服务器数据错误, 数据不合法
         """
-        if type(data) not in [str, unicode]:
+        data = self._decrypt_request(data, msg_signature, timestamp, nonce)
+        return self._build_request(data, msg_signature, timestamp, nonce)
+
+    def peek_request(self, data=None, msg_signature=None, timestamp=None, nonce=None):
+        """
+        解密后只读取 MsgType, Event, AgentID, FromUserName, 不构造消息对象, 用于只做转发的网关
+        参数与 parse_request 相同
+        :return: CallbackPeek 对象, 调用其 parse() 得到 CallbackRequest
+        :raises ParseError: 解析微信服务器数据错误, 数据不合法
+        """
+        data = self._decrypt_request(data, msg_signature, timestamp, nonce)
+        fields = peek_xml(data, ('MsgType', 'Event', 'AgentID', 'FromUserName'))
+        if fields['MsgType'] is None:
             raise ParseError()
-        data = data.encode('utf-8')
-        ok, data = self.decrypt_message(data, msg_signature, timestamp, nonce)
-        if not ok:
-            raise DecryptError()
         try:
-            xml = XMLStore(xmlstring=data)
-        except Exception:
+            agentid = int(fields['AgentID'] or 0)
+        except ValueError:
             raise ParseError()
-        result = xml.xml2dict
-        result['raw'] = data
-        result['type'] = result.pop('MsgType').lower()
-        message_type = MESSAGE_TYPES.get(result['type'], UnknownMessage)
-        self.__content = {
-            'message': message_type(result),
-            'msg_signature': msg_signature,
-            'timestamp': timestamp,
-            'nonce': nonce,
-        }
-        self.__is_parse = True
+        return CallbackPeek(self, data, fields['MsgType'].lower(), fields['Event'] and fields['Event'].lower(),
+                            agentid, fields['FromUserName'], msg_signature, timestamp, nonce)
+
+    def parse_data(self, data=None, msg_signature=None, timestamp=None, nonce=None):
+        """
+        解析微信服务器发送过来的数据并保存类中, 之后通过 message 与 response_* 访问
+        解析结果保存在当前对象上, 同一对象不能同时处理多个请求, 并发场景请使用 parse_request
+        :raises ParseError: 解析微信服务器数据错误, 数据不合法
+        """
+        self.__request = self.parse_request(data, msg_signature, timestamp, nonce)
 
     @property
-    def message(self):
+    def request(self):
+        """
+        parse_data 保存的 CallbackRequest 对象
+        """
         self._check_parse()
-        return self.__content['message']
+        return self.__request
+
+    @property
+    def message(self):
+        return self.request.message
 
     def _check_parse(self):
         """
         检查是否成功解析微信服务器传来的数据
         :raises NeedParseError: 需要解析微信服务器传来的数据
         """
-        if not self.__is_parse:
+        if self.__request is None:
             raise NeedParseError()
 
-    def _encrypt_response(self, response):
-        response = response.encode('utf-8')
-        ok, encrypt_msg = self.encrypt_message(response, self.__content['nonce'], self.__content['timestamp'])
-        if not ok:
-            raise EncryptError()
-        return encrypt_msg
-
     def response_text(self, content, escape=False):
         """
         将文字信息 content 组装为符合微信服务器要求的响应数据
@@ -109,13 +156,7 @@ class WechatEnterprise(OfficialWechat):
         :param escape: 是否转义该文本内容 (默认不转义)
         :return: 符合微信服务器要求的 XML 响应数据
         """
-        self._check_parse()
-        content = self._transcoding(content)
-        if escape:
-            content = cgi.escape(content)
-
-        response = TextReply(message=self.__content['message'], content=content).render()
-        return self._encrypt_response(response)
+        return self.request.response_text(content, escape=escape)
 
     def response_image(self, media_id):
         """
@@ -123,10 +164,7 @@ class WechatEnterprise(OfficialWechat):
         :param media_id: 图片的 MediaID
         :return: 符合微信服务器要求的 XML 响应数据
         """
-        self._check_parse()
-
-        response = ImageReply(message=self.__content['message'], media_id=media_id).render()
-        return self._encrypt_response(response)
+        return self.request.response_image(media_id)
 
     def response_voice(self, media_id):
         """
@@ -134,10 +172,7 @@ class WechatEnterprise(OfficialWechat):
         :param media_id: 语音的 MediaID
         :return: 符合微信服务器要求的 XML 响应数据
         """
-        self._check_parse()
-
-        response = VoiceReply(message=self.__content['message'], media_id=media_id).render()
-        return self._encrypt_response(response)
+        return self.request.response_voice(media_id)
 
     def response_video(self, media_id, title=None, description=None):
         """
@@ -147,13 +182,7 @@ class WechatEnterprise(OfficialWechat):
         :param description: 视频消息的描述
         :return: 符合微信服务器要求的 XML 响应数据
         """
-        self._check_parse()
-        title = self._transcoding(title)
-        description = self._transcoding(description)
-
-        response = VideoReply(message=self.__content['message'], media_id=media_id, title=title,
-                              description=description).render()
-        return self._encrypt_response(response)
+        return self.request.response_video(media_id, title=title, description=description)
 
     def response_music(self, music_url, title=None, description=None, hq_music_url=None, thumb_media_id=None):
         """
@@ -165,16 +194,8 @@ class WechatEnterprise(OfficialWechat):
         :param thumb_media_id: 缩略图的 MediaID
         :return: 符合微信服务器要求的 XML 响应数据
         """
-        self._check_parse()
-        music_url = self._transcoding(music_url)
-        title = self._transcoding(title)
-        description = self._transcoding(description)
-        hq_music_url = self._transcoding(hq_music_url)
-
-        response = MusicReply(message=self.__content['message'], title=title, description=description,
-                              music_url=music_url,
-                              hq_music_url=hq_music_url, thumb_media_id=thumb_media_id).render()
-        return self._encrypt_response(response)
+        return self.request.response_music(music_url, title=title, description=description,
+                                           hq_music_url=hq_music_url, thumb_media_id=thumb_media_id)
 
     def response_news(self, articles):
         """
@@ -182,26 +203,24 @@ class WechatEnterprise(OfficialWechat):
         :param articles: list 对象, 每个元素为一个 dict 对象, key 包含 `title`, `description`, `picurl`, `url`
         :return: 符合微信服务器要求的 XML 响应数据
         """
-        self._check_parse()
-        for article in articles:
-            if article.get('title'):
-                article['title'] = self._transcoding(article['title'])
-            if article.get('description'):
-                article['description'] = self._transcoding(article['description'])
-            if article.get('picurl'):
-                article['picurl'] = self._transcoding(article['picurl'])
-            if article.get('url'):
-                article['url'] = self._transcoding(article['url'])
-
-        news = ArticleReply(message=self.__content['message'])
-        for article in articles:
-            article = Article(**article)
-            news.add_article(article)
-        response = news.render()
-        return self._encrypt_response(response)
+        return self.request.response_news(articles)
 
     def _post_message(self, data):
-        return self._post('https://qyapi.weixin.qq.com/cgi-bin/message/send', data)
+        return self._post('/message/send', data)
+
+    def _post_prepared(self, prepared, **recipients):
+        """
+        发送 PreparedMessage, 只序列化接收者
+        :param recipients: PreparedMessage.body 的参数
+        """
+        return self._request('POST', '/message/send', agentid=prepared.agentid, data=prepared.body(**recipients))
+
+    def fanout(self, workers=8):
+        """
+        返回不受接收者个数限制的 FanoutSender, 用法与 send_* 相同, 如 wechat.fanout().send_text(...)
+        :param workers: 并发发送的线程数
+        """
+        return FanoutSender(self, workers=workers)
 
 
     def send_text(self, content, escape=False, **kwargs):
@@ -295,7 +314,6 @@ class WechatEnterprise(OfficialWechat):
         :param to_tag: 标签ID列表
         :param safe: 是否加密
         """
-        self._check_parse()
         for article in articles:
             if article.get('title'):
                 article['title'] = self._transcoding(article['title'])
@@ -313,6 +331,36 @@ class WechatEnterprise(OfficialWechat):
         data = news.apply()
         return self._post_message(data)
 
+    def upload_media(self, media_type, fileobj=None, filename=None, content_type=None, path=None, data=None):
+        """
+        上传临时素材, 文件分块读取后发送, 不把整个文件读入内存
+        设置了 media_cache 时先按内容摘要查找缓存, 仍然有效的 media_id 不再上传
+        fileobj / path / data 三选一
+        :param media_type: image / voice / video / file
+        :param fileobj: 可 seek 的文件对象, 包括 mmap
+        :param path: 文件路径, 以 mmap 方式读取
+        :param data: 素材内容的字节串
+        :param filename: 上传的文件名, 默认取文件名
+        :param content_type: 默认按文件名推断
+        :return: {"type": "file", "media_id": "xxx", "created_at": "xxx"}
+        """
+        source = MediaSource(fileobj, path=path, data=data, filename=filename, content_type=content_type)
+        try:
+            cache = self.media_cache
+            if cache is not None:
+                digest = source.digest()
+                result = cache.get(self.corpid, media_type, digest)
+                if result is not None:
+                    return result
+            body = MultipartFile(source.fileobj, filename=source.filename, content_type=source.content_type)
+            result = self._request('POST', '/media/upload', params={'type': media_type}, data=body,
+                                   headers={'Content-Type': body.content_type})
+            if cache is not None and result.get('errcode', 0) == 0 and result.get('media_id'):
+                cache.set(self.corpid, media_type, digest, result)
+            return result
+        finally:
+            source.close()
+
     def create_menu(self, menu_data, agent_id):
         """
         详情参考 http://qydev.weixin.qq.com/wiki/index.php?title=%E5%88%9B%E5%BB%BA%E5%BA%94%E7%94%A8%E8%8F%9C%E5%8D%95
@@ -320,10 +368,7 @@ class WechatEnterprise(OfficialWechat):
         :param agent_id: 企业应用的id，整型
         :return: 返回的 JSON 数据包
         """
-        return requests.post(
-            url='https://qyapi.weixin.qq.com/cgi-bin/menu/create?access_token={}&agentid={}'.format(self.access_token,
-                                                                                                    agent_id),
-            data=json.dumps(menu_data).decode('unicode-escape').encode("utf-8")).json()
+        return self._post('/menu/create', menu_data, agentid=agent_id)
 
     def get_menu(self, agent_id):
         """
@@ -332,9 +377,7 @@ class WechatEnterprise(OfficialWechat):
         :param agent_id: 企业应用的id，整型
         :return: 返回的 JSON 数据包
         """
-        return requests.get(
-            'https://qyapi.weixin.qq.com/cgi-bin/menu/get?access_token={}&agentid={}'.format(self.access_token,
-                                                                                             agent_id)).json()
+        return self._get('/menu/get', agentid=agent_id)
 
     def delete_menu(self, agent_id):
         """
@@ -343,16 +386,14 @@ class WechatEnterprise(OfficialWechat):
         :param agent_id: 企业应用的id，整型
         :return: 返回的 JSON 数据包
         """
-        return requests.get(
-            'https://qyapi.weixin.qq.com/cgi-bin/menu/delete?access_token={}&agentid={}'.format(self.access_token,
-                                                                                                agent_id)).json()
+        return self._get('/menu/delete', agentid=agent_id)
 
     def generate_jsapi_signature(self, timestamp, noncestr, url, jsapi_ticket=None):
         """
         生成JS API 签名
         """
         if not jsapi_ticket:
-            jsapi_ticket = self.jsapi_ticket
+            jsapi_ticket = self._check_jsapi_ticket()
 
         data = {
             'jsapi_ticket': jsapi_ticket,
@@ -371,35 +412,157 @@ class WechatEnterprise(OfficialWechat):
         """
         管理组权限验证方法
         """
-        access_token = self._check_access_token()
-        return requests.get(url="https://qyapi.weixin.qq.com/cgi-bin/ticket/get",
-                            params={'access_token': access_token, 'type': 'contact'}).json()
-
-    def _post(self, url, kwargs):
+        return self._get('/ticket/get', type='contact')
+
+    def _with_retry(self, path, params, agentid, call):
+        """
+        调用接口的重试循环, 每次调用前附带 access_token 并从 rate_limiter 取得令牌
+        token 过期时作废 token 并重试一次, 系统繁忙时按 retry_policy 退避重试
+        :param call: call(params) 发送一次请求, 返回 (结果, errcode)
+        :return: 最后一次调用的 (结果, errcode)
+        """
+        policy = self.retry_policy
+        token_retried = False
+        attempt = 0
+        waited = 0
+        while True:
+            access_token = self._check_access_token()
+            params['access_token'] = access_token
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire(self.corpid, agentid, path)
+            result, errcode = call(params)
+            policy.record()
+            if not errcode:
+                return result, errcode
+            if policy.is_token_expired(errcode) and not token_retried:
+                token_retried = True
+                self._token_manager.invalidate(access_token)
+                continue
+            delay = policy.delay(errcode, attempt, waited, path)
+            if delay is None:
+                return result, errcode
+            time.sleep(delay)
+            attempt += 1
+            waited += delay
+
+    def _request(self, method, path, params=None, agentid=None, **kwargs):
+        """
+        调用接口, 自动附带 access_token, 重试的处理见 _with_retry
+        :param agentid: 用于限流的应用id, 默认取 params 中的 agentid
+        """
+        params = dict(params or {})
+        if agentid is None:
+            agentid = params.get('agentid')
+        data = kwargs.get('data')
+
+        def call(params):
+            if hasattr(data, 'seek'):
+                # 重试时重新发送整个文件
+                data.seek(0)
+            resp = jsonutil.loads(self.transport.request(method, self.api_url + path, params=params, **kwargs).content)
+            return resp, resp.get('errcode', 0) if isinstance(resp, dict) else 0
+
+        return self._with_retry(path, params, agentid, call)[0]
+
+    def _get(self, path, **params):
+        """查询处理"""
+        return self._request('GET', path, params=params)
+
+    def _post(self, path, kwargs, **params):
         """上传处理"""
-        access_token = self._check_access_token()
-
-        _url = "{}?access_token={}".format(url, access_token)
-        resp = requests.post(url=_url, data=json.dumps(kwargs).decode('unicode-escape').encode("utf-8"))
-        return resp.json()
+        agentid = kwargs.get('agentid') if isinstance(kwargs, dict) else None
+        return self._request('POST', path, params=params, agentid=agentid, data=jsonutil.dumps(kwargs))
+
+    def _stream(self, path, key, chunk_size=64 * 1024, **params):
+        """
+        以流的方式调用 GET 接口, 逐个返回 key 对应数组的元素, 不把整个响应读入内存
+        token 过期与系统繁忙的处理与 _request 相同, 但只在返回第一个元素之前重试
+        :raises APIError: 接口返回错误
+        """
+        def call(params):
+            resp = self.transport.request('GET', self.api_url + path, params=params, stream=True)
+            items = iter_json_array(resp.iter_content(chunk_size), key)
+            try:
+                # 读到第一个元素才能确定接口没有返回错误
+                first = next(items)
+            except StopIteration:
+                resp.close()
+                return None, 0
+            except ArrayNotFound as e:
+                resp.close()
+                error = e.document if isinstance(e.document, dict) else {}
+                return error, error.get('errcode', 0)
+            except Exception:
+                resp.close()
+                raise
+            return (resp, itertools.chain([first], items)), 0
+
+        result, errcode = self._with_retry(path, params, params.get('agentid'), call)
+        if errcode:
+            raise APIError(result.get('errmsg', ''), errcode=errcode)
+        if not isinstance(result, tuple):
+            # 空数组, 或响应中没有 key 但也没有错误码
+            return
+        resp, items = result
+        try:
+            for item in items:
+                yield item
+        finally:
+            resp.close()
+
+    def _cached_get(self, kind, key, path, **params):
+        """
+        先查询 directory_cache, 没有缓存时调用接口, 成功的结果写入缓存
+        """
+        cache = self.directory_cache
+        if cache is None:
+            return self._get(path, **params)
+        result, snapshot = cache.lookup(self.corpid, kind, key)
+        if result is None:
+            result = self._get(path, **params)
+            if result.get('errcode', 0) == 0:
+                # 按调用接口之前的版本号写入, 期间发生的失效不会被覆盖
+                cache.set(self.corpid, kind, key, result, snapshot)
+        return result
+
+    def invalidate_directory(self, kind, *keys):
+        """
+        使 directory_cache 中的相关数据失效, 不指定 keys 时整类失效
+        SDK 的写操作会自动调用, 通讯录在 SDK 之外被修改 (如异步任务完成, 管理后台操作) 时需要手动调用
+        :param kind: 'user', 'department', 'tag' 或 'agent'
+        """
+        cache = self.directory_cache
+        if cache is None:
+            return
+        for key in keys or (None,):
+            cache.invalidate(self.corpid, kind, key)
 
     def _check_corpid_corpsecret(self):
         if not self.corpid or not self.corpsecret:
             raise ValueError(u"请提供corpid或corpsecret!")
 
 
+    @property
+    def access_token(self):
+        return self._token_manager.value
+
+    @access_token.setter
+    def access_token(self, value):
+        self._token_manager.set(value)
+
+    @property
+    def jsapi_ticket(self):
+        return self._ticket_manager.value
+
+    @jsapi_ticket.setter
+    def jsapi_ticket(self, value):
+        self._ticket_manager.set(value)
+
     def _check_access_token(self):
         """
-        检查token
+        检查token, 过期前自动刷新, 并发调用时只会请求一次 gettoken
         """
-        if not self.access_token:
-            self._check_corpid_corpsecret()
-            resp = self.grant_access_token()
-            if 'access_token' in resp:
-                self.access_token = resp['access_token']
-                return resp['access_token']
-
-        return self.access_token
+        return self._token_manager.get()
 
 
     def get_access_token(self):
@@ -408,14 +571,24 @@ class WechatEnterprise(OfficialWechat):
         """
         return self._check_access_token()
 
+    def _check_jsapi_ticket(self):
+        """
+        检查 jsapi_ticket, 与 access_token 一样过期前自动刷新
+        """
+        return self._ticket_manager.get()
+
+    def get_jsapi_ticket(self):
+        """
+        获取 jsapi_ticket, 可能为null
+        """
+        return self._check_jsapi_ticket()
+
 
     def auth_succ(self, user_id):
         """
         成员关注企业号，二次验证
         """
-        access_token = self._check_access_token()
-        return requests.get(url="https://qyapi.weixin.qq.com/cgi-bin/user/authsucc",
-                            params={'access_token': access_token, 'userid': user_id}).json()
+        return self._get('/user/authsucc', userid=user_id)
 
 
     def create_department(self, **kwargs):
@@ -434,7 +607,9 @@ class WechatEnterprise(OfficialWechat):
            "id": 2
         }
         """
-        return self._post("https://qyapi.weixin.qq.com/cgi-bin/department/create", kwargs)
+        result = self._post("/department/create", kwargs)
+        self.invalidate_directory('department')
+        return result
 
 
     def update_department(self, **kwargs):
@@ -453,26 +628,26 @@ class WechatEnterprise(OfficialWechat):
            "id": 2
         }
         """
-        return self._post("https://qyapi.weixin.qq.com/cgi-bin/department/update", kwargs)
+        result = self._post("/department/update", kwargs)
+        self.invalidate_directory('department')
+        return result
 
 
     def delete_department(self, _id):
         """
         删除部门
         """
-        access_token = self._check_access_token()
-        return requests.get(url='https://qyapi.weixin.qq.com/cgi-bin/department/delete',
-                            params={'access_token': access_token, 'id': _id}).json()
+        result = self._get('/department/delete', id=_id)
+        self.invalidate_directory('department')
+        return result
 
 
-    def get_departments(self, _id):
+    def get_departments(self, _id=None):
         """
         获取部门列表
-        params: _id 获取指定部门及其下的子部门
+        params: _id 获取指定部门及其下的子部门, 默认获取全部部门
         """
-        access_token = self._check_access_token()
-        return requests.get(url='https://qyapi.weixin.qq.com/cgi-bin/department/list',
-                            params={'access_token': access_token}).json()
+        return self._cached_get('department', _id, '/department/list', id=_id)
 
     def create_user(self, **kwargs):
         """
@@ -490,7 +665,9 @@ class WechatEnterprise(OfficialWechat):
            "extattr": {"attrs":[{"name":"爱好","value":"旅游"},{"name":"卡号","value":"1234567234"}]}
         }
         """
-        return self._post('https://qyapi.weixin.qq.com/cgi-bin/user/create', kwargs)
+        result = self._post('/user/create', kwargs)
+        self.invalidate_directory('user', kwargs.get('userid'))
+        return result
 
 
     def update_user(self, **kwargs):
@@ -509,16 +686,22 @@ class WechatEnterprise(OfficialWechat):
            "extattr": {"attrs":[{"name":"爱好","value":"旅游"},{"name":"卡号","value":"1234567234"}]}
         }
         """
-        return self._post('https://qyapi.weixin.qq.com/cgi-bin/user/update', kwargs)
+        result = self._post('/user/update', kwargs)
+        self.invalidate_directory('user', kwargs.get('userid'))
+        # 标签的成员列表中包含成员的姓名
+        self.invalidate_directory('tag')
+        return result
 
 
     def delete_user(self, user_id):
         """
         删除成员
         """
-        access_token = self._check_access_token()
-        return requests.get(url='https://qyapi.weixin.qq.com/cgi-bin/user/delete',
-                            params={'access_token': access_token, 'userid': user_id}).json()
+        result = self._get('/user/delete', userid=user_id)
+        # 标签的成员列表中也包含该成员
+        self.invalidate_directory('user', user_id)
+        self.invalidate_directory('tag')
+        return result
 
 
     def delete_users(self, user_ids):
@@ -526,19 +709,17 @@ class WechatEnterprise(OfficialWechat):
         删除多个成员
         user_ids = ['a', 'b']
         """
-        access_token = self._check_access_token()
-        return requests.post(
-            url='https://qyapi.weixin.qq.com/cgi-bin/user/batchdelete?access_token={}'.format(access_token),
-            json={'useridlist': user_ids}).json()
+        result = self._post('/user/batchdelete', {'useridlist': user_ids})
+        self.invalidate_directory('user', *user_ids)
+        self.invalidate_directory('tag')
+        return result
 
 
     def get_user(self, user_id):
         """
         获取成员
         """
-        access_token = self._check_access_token()
-        return requests.get(url='https://qyapi.weixin.qq.com/cgi-bin/user/get',
-                            params={'access_token': access_token, 'userid': user_id}).json()
+        return self._cached_get('user', user_id, '/user/get', userid=user_id)
 
 
     def get_simple_user(self, **kwargs):
@@ -548,10 +729,7 @@ class WechatEnterprise(OfficialWechat):
         fetch_child 1/0：是否递归获取子部门下面的成员， 如果不需要就不要传
         status 0获取全部成员，1获取已关注成员列表，2获取禁用成员列表，4获取未关注成员列表。status可叠加，未填写则默认为4
         """
-        access_token = self._check_access_token()
-        return requests.get(
-            url='https://qyapi.weixin.qq.com/cgi-bin/user/simplelist?access_token={}'.format(access_token),
-            params=kwargs).json()
+        return self._get('/user/simplelist', **kwargs)
 
 
     def get_user_list(self, **kwargs):
@@ -560,9 +738,38 @@ class WechatEnterprise(OfficialWechat):
         fetch_child 1/0：是否递归获取子部门下面的成员， 如果不需要就不要传
         status 0获取全部成员，1获取已关注成员列表，2获取禁用成员列表，4获取未关注成员列表。status可叠加，未填写则默认为4
         """
-        access_token = self._check_access_token()
-        return requests.get(url='https://qyapi.weixin.qq.com/cgi-bin/user/list?access_token={}'.format(access_token),
-                            data=kwargs).json()
+        return self._get('/user/list', **kwargs)
+
+    def iter_departments(self, _id=None):
+        """
+        逐个返回部门, 响应边读取边解码
+        params: _id 获取指定部门及其下的子部门, 默认获取全部部门
+        :raises APIError: 接口返回错误
+        """
+        return self._stream('/department/list', 'department', id=_id)
+
+    def iter_users(self, department_id=1, fetch_child=True, status=0, simple=False):
+        """
+        逐个返回部门的成员, 每次只请求一个部门的直属成员并边读取边解码, 内存占用不随通讯录规模增长
+        属于多个部门的成员只返回一次
+        :param department_id: 部门ID
+        :param fetch_child: 是否包含下级部门的成员
+        :param status: 0获取全部成员，1获取已关注成员列表，2获取禁用成员列表，4获取未关注成员列表
+        :param simple: 是否只获取成员的 userid / name / department (user/simplelist)
+        :raises APIError: 接口返回错误
+        """
+        path = '/user/simplelist' if simple else '/user/list'
+        if fetch_child:
+            dept_ids = [dept['id'] for dept in self.iter_departments(department_id)]
+        else:
+            dept_ids = [department_id]
+        walked = frozenset(dept_ids)
+        for dept_id in dept_ids:
+            for user in self._stream(path, 'userlist', department_id=dept_id, fetch_child=0, status=status):
+                # 只在成员所属的第一个部门中返回
+                owner = next((d for d in user.get('department') or () if d in walked), dept_id)
+                if owner == dept_id:
+                    yield user
 
 
     def invite_user(self, user_id):
@@ -572,7 +779,7 @@ class WechatEnterprise(OfficialWechat):
         该方法已过期，微信不支持发送邀请信息
         """
         # data = {'userid': user_id}
-        # return self._post('https://qyapi.weixin.qq.com/cgi-bin/invite/send', data)
+        # return self._post('/invite/send', data)
         pass
 
 
@@ -584,7 +791,7 @@ class WechatEnterprise(OfficialWechat):
            "tagid": id
         }
         """
-        return self._post('https://qyapi.weixin.qq.com/cgi-bin/tag/create', kwargs)
+        return self._post('/tag/create', kwargs)
 
 
     def update_tag(self, **kwargs):
@@ -595,24 +802,24 @@ class WechatEnterprise(OfficialWechat):
            "tagid": id
         }
         """
-        return self._post('https://qyapi.weixin.qq.com/cgi-bin/tag/update', kwargs)
+        result = self._post('/tag/update', kwargs)
+        self.invalidate_directory('tag', kwargs.get('tagid'))
+        return result
 
 
     def delete_tag(self, tag_id):
         """
         删除标签
         """
-        access_token = self._check_access_token()
-        return requests.get(url='https://qyapi.weixin.qq.com/cgi-bin/tag/delete',
-                            params={'access_token': access_token, 'tagid': tag_id}).json()
+        result = self._get('/tag/delete', tagid=tag_id)
+        self.invalidate_directory('tag', tag_id)
+        return result
 
     def get_tag(self, tag_id):
         """
         获取标签
         """
-        access_token = self._check_access_token()
-        return requests.get(url='https://qyapi.weixin.qq.com/cgi-bin/tag/get',
-                            params={'access_token': access_token, 'tagid': tag_id}).json()
+        return self._cached_get('tag', tag_id, '/tag/get', tagid=tag_id)
 
 
     def add_tag_users(self, **kwargs):
@@ -624,7 +831,9 @@ class WechatEnterprise(OfficialWechat):
            "partylist": [4]
         }
         """
-        return self._post("https://qyapi.weixin.qq.com/cgi-bin/tag/addtagusers", kwargs)
+        result = self._post("/tag/addtagusers", kwargs)
+        self.invalidate_directory('tag', kwargs.get('tagid'))
+        return result
 
 
     def delete_tag_users(self, **kwargs):
@@ -636,16 +845,16 @@ class WechatEnterprise(OfficialWechat):
            "partylist":[2,4]
         }
         """
-        return self._post("https://qyapi.weixin.qq.com/cgi-bin/tag/deltagusers", kwargs)
+        result = self._post("/tag/deltagusers", kwargs)
+        self.invalidate_directory('tag', kwargs.get('tagid'))
+        return result
 
 
     def get_tag_list(self):
         """
         获取标签列表
         """
-        access_token = self._check_access_token()
-        return requests.get(url='https://qyapi.weixin.qq.com/cgi-bin/tag/list',
-                            params={'access_token': access_token}).json
+        return self._get('/tag/list')
 
 
     def batch_invite_user(self, **kwargs):
@@ -664,7 +873,7 @@ class WechatEnterprise(OfficialWechat):
             }
         }
         """
-        return self._post("https://qyapi.weixin.qq.com/cgi-bin/batch/inviteuser", kwargs)
+        return self._post("/batch/inviteuser", kwargs)
 
 
     def batch_sync_user(self, **kwargs):
@@ -681,7 +890,10 @@ class WechatEnterprise(OfficialWechat):
             }
         }
         """
-        return self._post('https://qyapi.weixin.qq.com/cgi-bin/batch/syncuser', kwargs)
+        result = self._post('/batch/syncuser', kwargs)
+        self.invalidate_directory('user')
+        self.invalidate_directory('tag')
+        return result
 
 
     def batch_replace_user(self, **kwargs):
@@ -697,7 +909,10 @@ class WechatEnterprise(OfficialWechat):
             }
         }
         """
-        return self._post('https://qyapi.weixin.qq.com/cgi-bin/batch/replaceuser', kwargs)
+        result = self._post('/batch/replaceuser', kwargs)
+        self.invalidate_directory('user')
+        self.invalidate_directory('tag')
+        return result
 
 
     def batch_replace_party(self, **kwargs):
@@ -713,7 +928,36 @@ class WechatEnterprise(OfficialWechat):
             }
         }
         """
-        return self._post("https://qyapi.weixin.qq.com/cgi-bin/batch/replaceparty", kwargs)
+        result = self._post("/batch/replaceparty", kwargs)
+        self.invalidate_directory('department')
+        self.invalidate_directory('user')
+        return result
+
+
+    def sync_users(self, users, callback=None):
+        """
+        生成成员 CSV 并上传, 提交增量更新成员任务
+        :param users: 成员 dict 的可迭代对象, 字段见 batch.USER_COLUMNS
+        :return: batch.BatchJob
+        """
+        return batch.submit(self, 'sync_user', users, callback=callback)
+
+
+    def replace_users(self, users, callback=None):
+        """
+        生成成员 CSV 并上传, 提交全量覆盖成员任务
+        :return: batch.BatchJob
+        """
+        return batch.submit(self, 'replace_user', users, callback=callback)
+
+
+    def replace_parties(self, departments, callback=None):
+        """
+        生成部门 CSV 并上传, 提交全量覆盖部门任务
+        :param departments: 部门 dict 的可迭代对象, 字段见 batch.PARTY_COLUMNS
+        :return: batch.BatchJob
+        """
+        return batch.submit(self, 'replace_party', departments, callback=callback)
 
 
     def get_batch_result(self, job_id):
@@ -722,9 +966,7 @@ class WechatEnterprise(OfficialWechat):
         返回结果根据 type 而定义
         refer: http://qydev.weixin.qq.com/wiki/index.php?title=%E5%BC%82%E6%AD%A5%E4%BB%BB%E5%8A%A1%E6%8E%A5%E5%8F%A3
         """
-        access_token = self._check_access_token()
-        return requests.get(url='https://qyapi.weixin.qq.com/cgi-bin/batch/getresult',
-                            params={'access_token': access_token, 'jobid': job_id}).json()
+        return self._get('/batch/getresult', jobid=job_id)
 
 
     def convert_2_open_id(self, **kwargs):
@@ -735,7 +977,7 @@ class WechatEnterprise(OfficialWechat):
            "agentid": 1
         }
         """
-        return self._post('https://qyapi.weixin.qq.com/cgi-bin/user/convert_to_openid', kwargs)
+        return self._post('/user/convert_to_openid', kwargs)
 
 
     def convert_2_user_id(self, open_id):
@@ -743,16 +985,14 @@ class WechatEnterprise(OfficialWechat):
         open id 转换 user id 
         """
         data = {'openid': open_id}
-        return self._post('https://qyapi.weixin.qq.com/cgi-bin/user/convert_to_userid', data)
+        return self._post('/user/convert_to_userid', data)
 
 
     def get_agent(self, agent_id):
         """
         获取企业号应用
         """
-        access_token = self._check_access_token()
-        return requests.get(url='https://qyapi.weixin.qq.com/cgi-bin/agent/get',
-                            params={'access_token': access_token, 'agentid': agent_id}).json()
+        return self._cached_get('agent', agent_id, '/agent/get', agentid=agent_id)
 
 
     def set_agent(self, **kwargs):
@@ -770,11 +1010,12 @@ class WechatEnterprise(OfficialWechat):
            "home_url":"http://www.qq.com"
         }
         """
-        return self._post('https://qyapi.weixin.qq.com/cgi-bin/agent/set', kwargs)
+        result = self._post('/agent/set', kwargs)
+        self.invalidate_directory('agent', kwargs.get('agentid'))
+        return result
 
     def get_agent_list(self):
         """
         获取应用概况列表
         """
-        access_token = self._check_access_token()
-        return requests.get(url='https://qyapi.weixin.qq.com/cgi-bin/agent/list', params={'access_token': access_token})
+        return self._get('/agent/list')
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+import logging
+from urlparse import parse_qs
+
+from .exceptions import ParseError, DecryptError
+from .router import Router, Route
+from .ingest import deliver
+
+# 回调消息体的默认上限, 加密后的普通消息不超过几 KB
+MAX_BODY = 64 * 1024
+_CHUNK_SIZE = 8192
+
+logger = logging.getLogger(__name__)
+
+_TEXT_HEADERS = [('Content-Type', 'text/plain; charset=utf-8')]
+_XML_HEADERS = [('Content-Type', 'text/xml; charset=utf-8')]
+
+
+def _response(start_response, status, body=b'', headers=_TEXT_HEADERS):
+    start_response(status, headers + [('Content-Length', str(len(body)))])
+    return [body]
+
+
+class _Deferred(object):
+    """
+    空的响应体, 服务器写完响应并调用 close() 后再执行处理函数, 返回值通过 deliver 发送
+    处理失败时记录日志并从 dedupe 中删除消息, 之后再收到该消息时重新处理; 响应已经发出, 微信不会因此重试
+    """
+
+    def __init__(self, func, request, dedupe=None):
+        self._func = func
+        self._request = request
+        self._dedupe = dedupe
+
+    def __iter__(self):
+        return iter((b'',))
+
+    def close(self):
+        request = self._request
+        try:
+            deliver(request.wechat, request.message, self._func(request))
+        except Exception:
+            if self._dedupe is not None:
+                self._dedupe.forget(request.message)
+            logger.exception('Deferred handler failed for message %s', request.message.id)
+
+
+class CallbackApp(object):
+    """
+    企业号回调 WSGI 应用
+    GET 校验回调 URL 并返回 echostr, POST 解密消息后交给注册的处理函数, 处理函数的返回值作为被动回复
+
+    app = CallbackApp(wechat)
+
+    @app.handler('text')
+    def on_text(request):
+        return request.response_text(u'收到')
+
+    # 耗时的处理在响应发出后执行, 返回值通过 message/send 发给用户
+    @app.handler('event', event='click', defer=True)
+    def on_click(request):
+        return u'处理完成'
+
+    指定 ingest 时 defer 的处理函数交给 IngestPool 的工作线程执行, 不占用服务器的请求线程
+    """
+
+    def __init__(self, wechat, max_body=MAX_BODY, router=None, dedupe=None, ingest=None):
+        """
+        :param wechat: WechatEnterprise 对象, 所有请求共用
+        :param max_body: 请求体的最大字节数, 超出时返回 413
+        :param router: Router 对象, 默认新建
+        :param dedupe: Deduplicator 对象, 微信重试的回调直接返回空响应, 默认不去重
+        :param ingest: IngestPool 对象, 执行 defer 的处理函数, 默认在响应发出后由请求线程执行
+        """
+        self.wechat = wechat
+        self.max_body = max_body
+        self.router = router or Router()
+        self.dedupe = dedupe
+        self.ingest = ingest
+        self._default = None
+
+    def register(self, type, func, event=None, defer=False, key=None, agentid=None, prefix=None):
+        """
+        注册消息处理函数
+        :param type: 消息类型, 如 'text', 'image', 'event'
+        :param func: 处理函数, 参数为 CallbackRequest, 返回 response_* 生成的回复, 返回 None 时回复空串
+                     defer 时返回值交给 deliver, 字符串发送文字消息, list 发送图文消息
+        :param event: 事件类型, 仅 type 为 'event' 时有效, 如 'click', None 为所有事件
+        :param defer: 是否先返回 200 空响应, 再执行处理函数
+        :param key: 事件的 EventKey, None 为所有 EventKey
+        :param agentid: 仅处理该应用的消息, None 为所有应用
+        :param prefix: 文本消息内容的前缀, 如 u'/help'
+        """
+        self.router.add(func, type, event=event, key=key, agentid=agentid, prefix=prefix, defer=defer)
+
+    def handler(self, type, **kwargs):
+        """
+        register 的装饰器形式
+        """
+        def decorator(func):
+            self.register(type, func, **kwargs)
+            return func
+        return decorator
+
+    def default(self, func, defer=False):
+        """
+        注册没有匹配处理函数时使用的处理函数, 可用作装饰器
+        """
+        self._default = Route(func, defer)
+        return func
+
+    def find_handler(self, message):
+        """
+        :return: Route (处理函数, defer), 没有匹配时返回 None
+        """
+        return self.router.match(message) or self._default
+
+    def read_body(self, environ):
+        """
+        按 CONTENT_LENGTH 分块读取请求体, 超过 max_body 时返回 None
+        PEP 3333 不保证 wsgi.input 在请求体结束时返回 EOF, 没有 CONTENT_LENGTH 时
+        只在服务器设置了 wsgi.input_terminated (如 chunked 请求) 时读到结尾
+        :raises ValueError: 没有合法的 CONTENT_LENGTH, 且服务器没有设置 wsgi.input_terminated
+        """
+        stream = environ['wsgi.input']
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or -1)
+        except ValueError:
+            length = -1
+        if length > self.max_body:
+            return None
+        if length >= 0:
+            return stream.read(length)
+        if not environ.get('wsgi.input_terminated'):
+            raise ValueError('Content-Length is required')
+        # 没有 Content-Length (如 chunked), 读到 max_body 为止
+        chunks = []
+        size = 0
+        while size <= self.max_body:
+            chunk = stream.read(_CHUNK_SIZE)
+            if not chunk:
+                return b''.join(chunks)
+            chunks.append(chunk)
+            size += len(chunk)
+        return None
+
+    def __call__(self, environ, start_response):
+        query = parse_qs(environ.get('QUERY_STRING', ''))
+        params = [query.get(name, [None])[0] for name in ('msg_signature', 'timestamp', 'nonce')]
+        method = environ['REQUEST_METHOD']
+
+        if method == 'GET':
+            ok, echostr = self.wechat.check_signature(*(params + [query.get('echostr', [None])[0]]))
+            if not ok:
+                return _response(start_response, '403 Forbidden')
+            return _response(start_response, '200 OK', echostr)
+
+        if method != 'POST':
+            return _response(start_response, '405 Method Not Allowed',
+                             headers=_TEXT_HEADERS + [('Allow', 'GET, POST')])
+
+        try:
+            body = self.read_body(environ)
+        except ValueError:
+            return _response(start_response, '411 Length Required')
+        if body is None:
+            return _response(start_response, '413 Request Entity Too Large')
+        try:
+            request = self.wechat.parse_request(body, *params)
+        except (ParseError, DecryptError):
+            return _response(start_response, '400 Bad Request')
+
+        found = self.find_handler(request.message)
+        if found is None:
+            return _response(start_response, '200 OK')
+        if self.dedupe is not None and self.dedupe.is_duplicate(request.message):
+            return _response(start_response, '200 OK')
+        func, defer = found
+        if defer and self.ingest is not None:
+            if not self.ingest.submit(func, request):
+                # 队列已满, 让微信稍后重试
+                if self.dedupe is not None:
+                    self.dedupe.forget(request.message)
+                return _response(start_response, '503 Service Unavailable')
+            return _response(start_response, '200 OK')
+        if defer:
+            start_response('200 OK', _TEXT_HEADERS + [('Content-Length', '0')])
+            return _Deferred(func, request, self.dedupe)
+        try:
+            reply = func(request)
+        except Exception:
+            # 处理失败时允许微信的重试再次处理
+            if self.dedupe is not None:
+                self.dedupe.forget(request.message)
+            raise
+        if not reply:
+            return _response(start_response, '200 OK')
+        return _response(start_response, '200 OK', reply, _XML_HEADERS)
+